@@ -0,0 +1,283 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from impl.video_decoder import BaseVideoDecoder, BaseVideoStream, get_yuv420_frame_size
+from impl.utils.yuv_jpeg_encoding import YUVJpegEncoder
+from impl.utils.pixel_formats import PIXEL_FORMATS, get_frame_size, get_planes
+from impl.utils.native_file_ops import SYNC_POLICIES
+from impl.metrics import new_latency_histogram, add_histograms, get_latency_percentile
+
+# a result is compared with the baseline result of the same configuration
+_config_keys = ('width', 'height', 'num_enc_threads', 'num_io_threads', 'thread_max_queue', 'quality', 'thread_dispatch', 'pixel_format', 'io_backend', 'sync_policy')
+# of the keys missing from older baselines
+_config_defaults = {'pixel_format': 'yuv420', 'io_backend': 'stdio', 'sync_policy': 'none'}
+
+
+def _get_arg_parser():
+    arg_parser = argparse.ArgumentParser(description='Benchmark of the JPEG encoding and writing pipeline, with synthetic frames instead of a video decoder (no GPU required)', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    arg_parser.add_argument('--resolutions', default='1280x720,1920x1080', type=str, help="Frame sizes to sweep (e.g. '1280x720,3840x2160')")
+    arg_parser.add_argument('--num_enc_threads', default='1,2,4', type=str, help="Numbers of jpeg image encoding threads to sweep")
+    arg_parser.add_argument('--num_io_threads', default='1,4', type=str, help="Numbers of jpeg image write threads to sweep")
+    arg_parser.add_argument('--thread_max_queue', default='4', type=str, help="Max queue sizes of the worker threads to sweep")
+    arg_parser.add_argument('--quality', default='85', type=str, help="JPEG encoding qualities to sweep")
+    arg_parser.add_argument('--thread_dispatch', default='round_robin', type=str, help="Dispatch modes of the worker threads to sweep (round_robin, least_loaded, shared)")
+    arg_parser.add_argument('--pixel_formats', default='yuv420', type=str, help="Frame layouts from the decoder to sweep (yuv420, nv12, gray), see main.py --pixel_format")
+    arg_parser.add_argument('--io_backends', default='stdio', type=str, help="File write backends to sweep (stdio, dirfd), see main.py --io_backend")
+    arg_parser.add_argument('--sync_policies', default='none', type=str, help="Sync policies of the dirfd backend to sweep (none, writeback, dontneed, fsync), see main.py --sync_policy")
+    arg_parser.add_argument('--num_frames', default=300, type=int, help="Number of frames per configuration")
+    arg_parser.add_argument('--num_warmup_frames', default=30, type=int, help="Number of frames encoded before measuring")
+    arg_parser.add_argument('--frame_pool_memory', default=256, type=int, help="Memory budget of the raw frame buffers waiting to be encoded (in MB)")
+    arg_parser.add_argument('--output_dir', type=str, help="Where the frames are written, removed after each configuration, default: a temporary directory (use a tmpfs such as /dev/shm to leave the disk out)")
+    arg_parser.add_argument('--libturbojpeg_path', type=str, help="Override the system default path to the turbojpeg shared library")
+    arg_parser.add_argument('--baseline', type=str, help="Write the results to this json file")
+    arg_parser.add_argument('--compare', type=str, help="Compare the results with a baseline json file written by --baseline, exit with 1 on a regression")
+    arg_parser.add_argument('--tolerance', default=0.1, type=float, help="Relative frames/s drop or p99 latency increase reported as a regression by --compare")
+    return arg_parser
+
+
+def _parse_list(value, type_fn=int):
+    return tuple(type_fn(item) for item in value.split(','))
+
+
+def _parse_resolution(value):
+    width, height = value.split('x')
+    return int(width), int(height)
+
+
+def _create_synthetic_frames(width, height, num_frames, seed=0):
+    """textured YUV420 frames, between a flat and a noise frame for the encoder"""
+    random = np.random.default_rng(seed)
+    chroma_width, chroma_height = (width + 1) // 2, (height + 1) // 2
+    x = np.linspace(0, 4 * np.pi, width, dtype=np.float32)[np.newaxis, :]
+    y = np.linspace(0, 4 * np.pi, height, dtype=np.float32)[:, np.newaxis]
+    frames = []
+    for i in range(num_frames):
+        luma = 128 + 60 * np.sin(x + i * 0.2) * np.cos(y - i * 0.1) + random.normal(0, 8, (height, width)).astype(np.float32)
+        u = np.full((chroma_height, chroma_width), 128 + 20 * np.sin(i * 0.3), dtype=np.float32)
+        v = 128 + 30 * np.cos(x[:, ::2][:, :chroma_width] + i * 0.1) * np.ones((chroma_height, 1), dtype=np.float32)
+        frame = np.concatenate([np.clip(plane, 0, 255).astype(np.uint8).ravel() for plane in (luma, u, v)])
+        assert len(frame) == get_yuv420_frame_size(width, height)
+        frames.append(frame)
+    return frames
+
+
+def _convert_synthetic_frame(frame, width, height, pixel_format):
+    """the NV12 or gray frame of a YUV420 frame, as a decoder would download it"""
+    if pixel_format == 'yuv420':
+        return frame
+    luma, u, v = get_planes(frame, width, height)
+    if pixel_format == 'gray':
+        return luma.ravel().copy()
+    return np.concatenate((luma.ravel(), np.stack((u, v), axis=-1).ravel()))
+
+
+class SyntheticVideoDecoder(BaseVideoDecoder):
+    """decodes every source into num_frames frames copied from a few synthetic frames"""
+    def __init__(self, width, height, num_frames, frame_rate=30.):
+        self.width, self.height = width, height
+        self.num_frames = num_frames
+        self.frame_rate = frame_rate
+        self.patterns = _create_synthetic_frames(width, height, 8)
+
+    def open(self, source_file_path):
+        return _SyntheticVideoStream(self)
+
+
+class _SyntheticVideoStream(BaseVideoStream):
+    def __init__(self, decoder):
+        super().__init__(decoder.width, decoder.height, decoder.frame_rate)
+        self.decoder = decoder
+        self.patterns = decoder.patterns
+
+    def set_output_format(self, pixel_format):
+        self.output_format = pixel_format
+        self.patterns = [_convert_synthetic_frame(pattern, self.width, self.height, pixel_format) for pattern in self.decoder.patterns]
+        return True
+
+    def frames(self, frame_buffers, sampler):
+        patterns = self.patterns
+        for index in range(1, self.decoder.num_frames + 1):
+            pts = (index - 1) / self.frame_rate
+            if not sampler.accept(index, pts):
+                continue
+            frame = frame_buffers.get()
+            # stands for the download of a decoded frame
+            frame[:] = patterns[index % len(patterns)]
+            yield index, pts, frame
+
+
+class _TimingWriter:
+    """records when each frame is written"""
+    def __init__(self, writer):
+        self.writer = writer
+        self.end_times = {}
+
+    def write(self, ptr, size, path):
+        self.writer.write(ptr, size, path)
+        self.end_times[path] = time.perf_counter()
+
+    def flush(self, output_dirs=None):
+        self.writer.flush(output_dirs)
+
+
+class _TimingEncoder:
+    """records when each frame is submitted"""
+    def __init__(self, jpeg_encoder):
+        self.jpeg_encoder = jpeg_encoder
+        self.begin_times = {}
+
+    def prepare(self, destination_folder_path, width, height, num_frames=None, pixel_format='yuv420'):
+        self.jpeg_encoder.prepare(destination_folder_path, width, height, num_frames, pixel_format)
+
+    def encode(self, data, width, height, path, release_fn=None, resizer=None, pixel_format='yuv420'):
+        self.begin_times[path] = time.perf_counter()
+        self.jpeg_encoder.encode(data, width, height, path, release_fn, resizer, pixel_format)
+
+
+def run_config(config, num_frames, num_warmup_frames, frame_pool_memory, output_dir, libturbojpeg_path):
+    """runs one configuration, in a fresh process for the peak RSS"""
+    from impl.jpeg_encoder import JpegEncoder
+    from impl.utils.native_file_ops import NativeFileWriter, DirectoryFileWriter
+
+    writer = _TimingWriter(DirectoryFileWriter(config['sync_policy']) if config['io_backend'] == 'dirfd' else NativeFileWriter())
+    jpeg_encoder = JpegEncoder(config['num_enc_threads'], config['num_io_threads'], config['quality'], config['thread_max_queue'],
+                               libturbojpeg_path, writer=writer, dispatch=config['thread_dispatch'])
+    encoder = _TimingEncoder(jpeg_encoder)
+    frame_size = get_frame_size(config['width'], config['height'], config['pixel_format'])
+    os.makedirs(output_dir, exist_ok=True)
+    try:
+        with jpeg_encoder:
+            if num_warmup_frames > 0:
+                SyntheticVideoDecoder(config['width'], config['height'], num_warmup_frames).decode('warmup', output_dir, encoder, frame_pool_memory, pixel_format=config['pixel_format'])
+                jpeg_encoder.join()
+            decoder = SyntheticVideoDecoder(config['width'], config['height'], num_frames)
+            encoder.begin_times.clear()
+            writer.end_times.clear()
+            jpeg_encoder.reset_thread_stats()
+
+            begin = time.perf_counter()
+            decoder.decode('benchmark', output_dir, encoder, frame_pool_memory, pixel_format=config['pixel_format'])
+            jpeg_encoder.join()
+            elapsed = time.perf_counter() - begin
+            thread_stats = jpeg_encoder.get_thread_stats()
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    latencies = np.array([writer.end_times[path] - begin_time for path, begin_time in encoder.begin_times.items()])
+    output_bytes = sum(stats['bytes'] for stats in thread_stats['io'])
+    write_latency = new_latency_histogram()
+    for stats in thread_stats['io']:
+        add_histograms(write_latency, stats['latency'])
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {**config,
+            'frames': num_frames,
+            'seconds': elapsed,
+            'frames_per_s': num_frames / elapsed,
+            'input_mb_per_s': num_frames * frame_size / elapsed / 1e6,
+            'output_mb_per_s': output_bytes / elapsed / 1e6,
+            'latency_p50_ms': float(np.percentile(latencies, 50)) * 1000,
+            'latency_p99_ms': float(np.percentile(latencies, 99)) * 1000,
+            # bucket upper bounds, see impl/metrics.py
+            'write_p50_ms': get_latency_percentile(write_latency, 50) * 1000,
+            'write_p99_ms': get_latency_percentile(write_latency, 99) * 1000,
+            'peak_rss_mb': peak_rss / 1e6,
+            'encode_busy_s': sum(stats['busy_time'] for stats in thread_stats['encode']),
+            'write_busy_s': sum(stats['busy_time'] for stats in thread_stats['io']),
+            'encode_blocked_s': sum(stats['blocked_time'] for stats in thread_stats['encode'])}
+
+
+def _get_environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(),
+            'cpu_count': os.cpu_count(), 'numpy': np.__version__}
+
+
+def _format_result(result):
+    return (f"{result['width']}x{result['height']} enc {result['num_enc_threads']} io {result['num_io_threads']} queue {result['thread_max_queue']} "
+            f"q{result['quality']} {result['thread_dispatch']} {result['pixel_format']} {result['io_backend']} {result['sync_policy']}: {result['frames_per_s']:.1f} frames/s, "
+            f"{result['input_mb_per_s']:.1f} MB/s in, {result['output_mb_per_s']:.1f} MB/s out, p50 {result['latency_p50_ms']:.1f} ms, p99 {result['latency_p99_ms']:.1f} ms, "
+            f"write p50 {result['write_p50_ms']:.2g} ms, p99 {result['write_p99_ms']:.2g} ms, peak RSS {result['peak_rss_mb']:.0f} MB")
+
+
+def compare_results(results, baseline_results, tolerance):
+    """returns the lines describing the changes from the baseline, and whether any is a regression"""
+    baseline_by_config = {tuple(result.get(key, _config_defaults.get(key)) for key in _config_keys): result for result in baseline_results}
+    lines = []
+    has_regression = False
+    for result in results:
+        baseline = baseline_by_config.get(tuple(result[key] for key in _config_keys))
+        if baseline is None:
+            continue
+        fps_change = result['frames_per_s'] / baseline['frames_per_s'] - 1
+        p99_change = result['latency_p99_ms'] / baseline['latency_p99_ms'] - 1
+        is_regression = fps_change < -tolerance or p99_change > tolerance
+        has_regression |= is_regression
+        lines.append(f"{'REGRESSION ' if is_regression else ''}{result['width']}x{result['height']} enc {result['num_enc_threads']} io {result['num_io_threads']} "
+                     f"queue {result['thread_max_queue']} q{result['quality']} {result['thread_dispatch']} {result['pixel_format']} {result['io_backend']} {result['sync_policy']}: frames/s {fps_change:+.1%}, p99 latency {p99_change:+.1%}")
+    return lines, has_regression
+
+
+def main():
+    args = _get_arg_parser().parse_args()
+    multiprocessing.set_start_method('spawn', force=True)
+    resolutions = _parse_list(args.resolutions, _parse_resolution)
+    sweep = itertools.product(resolutions, _parse_list(args.num_enc_threads), _parse_list(args.num_io_threads),
+                              _parse_list(args.thread_max_queue), _parse_list(args.quality), _parse_list(args.thread_dispatch, str),
+                              _parse_list(args.pixel_formats, str), _parse_list(args.io_backends, str), _parse_list(args.sync_policies, str))
+    # the sync policies apply to the dirfd backend only
+    configs = [{'width': width, 'height': height, 'num_enc_threads': num_enc_threads, 'num_io_threads': num_io_threads,
+                'thread_max_queue': thread_max_queue, 'quality': quality, 'thread_dispatch': thread_dispatch, 'pixel_format': pixel_format,
+                'io_backend': io_backend, 'sync_policy': sync_policy}
+               for (width, height), num_enc_threads, num_io_threads, thread_max_queue, quality, thread_dispatch, pixel_format, io_backend, sync_policy in sweep
+               if io_backend == 'dirfd' or sync_policy == 'none']
+    assert all(config['width'] > 0 and config['height'] > 0 for config in configs)
+    assert all(config['num_enc_threads'] > 0 and config['num_io_threads'] > 0 and config['thread_max_queue'] > 0 for config in configs)
+    assert all(1 <= config['quality'] <= 100 for config in configs)
+    assert all(config['thread_dispatch'] in ('round_robin', 'least_loaded', 'shared') for config in configs)
+    assert all(config['pixel_format'] in PIXEL_FORMATS for config in configs)
+    assert all(config['io_backend'] in ('stdio', 'dirfd') and config['sync_policy'] in SYNC_POLICIES for config in configs)
+    assert len(configs) > 0
+    assert args.num_frames > 0
+    assert args.num_warmup_frames >= 0
+    # fails here rather than in the encoder threads
+    YUVJpegEncoder(args.libturbojpeg_path)
+    if args.compare is not None:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline_results = json.load(f)['results']
+
+    temp_dir = tempfile.mkdtemp(prefix='vid2jpg_benchmark_', dir=args.output_dir)
+    results = []
+    try:
+        for i, config in enumerate(configs):
+            # a fresh process per configuration, for the peak RSS and a cold encoder
+            with ProcessPoolExecutor(1) as executor:
+                result = executor.submit(run_config, config, args.num_frames, args.num_warmup_frames, args.frame_pool_memory * 1024 * 1024,
+                                         os.path.join(temp_dir, str(i)), args.libturbojpeg_path).result()
+            print(_format_result(result), flush=True)
+            results.append(result)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'environment': _get_environment(), 'time': time.time(), 'num_frames': args.num_frames, 'results': results}, f, indent=2)
+    if args.compare is not None:
+        lines, has_regression = compare_results(results, baseline_results, args.tolerance)
+        for line in lines:
+            print(line)
+        if has_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import time
+
+
+class StageTuner:
+    """
+    Grows or shrinks the threads and the queue size of a RoundRobinWorkerThreads within bounds.
+    A stage grows by a thread when its threads are busy and its producer is blocked on its full queues
+    or tasks are piling up, by doubling the queues when the producer is blocked otherwise (bursts).
+    It shrinks when drained, by one thread if the others would keep a margin, and by halving the queues
+    if they were never half full.
+    """
+    grow_blocked_fraction = 0.05
+    shrink_blocked_fraction = 0.01
+    busy_fraction = 0.85
+    shrink_margin = 1.25
+
+    def __init__(self, name, worker_threads, max_threads, max_queue, min_threads=1, min_queue=1, downstream=None):
+        """downstream: the RoundRobinWorkerThreads the tasks are put to, the time blocked on it is not counted as busy"""
+        assert 0 < min_threads <= max_threads and 0 < min_queue <= max_queue
+        self.name = name
+        self.worker_threads = worker_threads
+        self.downstream = downstream
+        self.min_threads, self.max_threads = min_threads, max_threads
+        self.min_queue, self.max_queue = min_queue, max_queue
+        self.reset()
+
+    def reset(self):
+        self.grow_totals = self.shrink_totals = (0., 0.)
+        self.max_queued = 0
+        self.queued_sum = self.num_samples = 0
+
+    def _get_totals(self):
+        stats = self.worker_threads.get_stats()
+        busy_time = sum(thread_stats['busy_time'] for thread_stats in stats)
+        if self.downstream is not None:
+            busy_time -= sum(thread_stats['blocked_time'] for thread_stats in self.downstream.get_stats())
+        return busy_time, sum(thread_stats['blocked_time'] for thread_stats in stats)
+
+    def _get_delta(self, totals, previous_totals):
+        # the thread stats are reset at the beginning of each job
+        if totals[0] < previous_totals[0] or totals[1] < previous_totals[1]:
+            return totals
+        return totals[0] - previous_totals[0], totals[1] - previous_totals[1]
+
+    def sample(self):
+        queued = self.worker_threads.get_num_queued()
+        self.max_queued = max(self.max_queued, queued)
+        self.queued_sum += queued
+        self.num_samples += 1
+
+    def _log(self, message):
+        print(f'auto tuning: {self.name} {message}')
+
+    def grow(self, elapsed):
+        """called periodically while running, returns True if changed"""
+        totals = self._get_totals()
+        busy_time, blocked_time = self._get_delta(totals, self.grow_totals)
+        self.grow_totals = totals
+        average_queued = self.queued_sum / max(self.num_samples, 1)
+        self.queued_sum = self.num_samples = 0
+        num_threads, max_queue = self.worker_threads.num_threads, self.worker_threads.max_queue
+        blocked_fraction = blocked_time / elapsed
+        busy_fraction = busy_time / (elapsed * num_threads)
+        is_blocked = blocked_fraction > self.grow_blocked_fraction
+        # the frame pool may run out before the queues are full
+        is_piling_up = average_queued >= num_threads
+        if not (is_blocked or is_piling_up):
+            return False
+        reason = f'(producer blocked {blocked_fraction:.0%} of {elapsed:.1f}s, {average_queued:.1f} tasks queued, threads {busy_fraction:.0%} busy)'
+        if busy_fraction > self.busy_fraction and num_threads < self.max_threads:
+            self._log(f'threads {num_threads} -> {num_threads + 1} {reason}')
+            self.worker_threads.set_num_threads(num_threads + 1)
+            return True
+        if is_blocked and max_queue < self.max_queue:
+            new_max_queue = min(max_queue * 2, self.max_queue)
+            self._log(f'queue {max_queue} -> {new_max_queue} {reason}')
+            self.worker_threads.set_max_queue(new_max_queue)
+            return True
+        return False
+
+    def shrink(self, elapsed):
+        """called with no task in flight, returns True if changed"""
+        totals = self._get_totals()
+        busy_time, blocked_time = self._get_delta(totals, self.shrink_totals)
+        self.shrink_totals = self.grow_totals = totals
+        max_queued, self.max_queued = self.max_queued, 0
+        num_threads, max_queue = self.worker_threads.num_threads, self.worker_threads.max_queue
+        blocked_fraction = blocked_time / elapsed
+        if blocked_fraction >= self.shrink_blocked_fraction:
+            return False
+        busy_threads = busy_time / elapsed
+        changed = False
+        if num_threads > self.min_threads and busy_threads * self.shrink_margin <= num_threads - 1:
+            self._log(f'threads {num_threads} -> {num_threads - 1} ({busy_threads:.1f} threads busy on average over {elapsed:.1f}s)')
+            self.worker_threads.set_num_threads(num_threads - 1)
+            changed = True
+        if max_queue > self.min_queue and max_queued * 2 < max_queue * num_threads:
+            new_max_queue = max(max_queue // 2, self.min_queue)
+            self._log(f'queue {max_queue} -> {new_max_queue} (at most {max_queued} tasks queued)')
+            self.worker_threads.set_max_queue(new_max_queue)
+            changed = True
+        return changed
+
+
+class AutoTuner:
+    """tunes the encoding and the write threads of a JpegEncoder, grows every interval seconds, shrinks on join()"""
+    def __init__(self, encode_workers, io_threads, max_encoder_threads, max_io_threads, max_queue, interval=1., clock=time.perf_counter):
+        self.stages = (StageTuner('encode', encode_workers, max_encoder_threads, max_queue, downstream=io_threads),
+                       StageTuner('write', io_threads, max_io_threads, max_queue))
+        self.interval = interval
+        self.clock = clock
+        self.grow_begin = self.shrink_begin = clock()
+
+    def reset(self):
+        """called when the thread stats are reset"""
+        for stage in self.stages:
+            stage.reset()
+        self.grow_begin = self.shrink_begin = self.clock()
+
+    def update(self):
+        """called by the producer for each task, returns True if changed"""
+        for stage in self.stages:
+            stage.sample()
+        now = self.clock()
+        elapsed = now - self.grow_begin
+        if elapsed < self.interval:
+            return False
+        self.grow_begin = now
+        changed = False
+        for stage in self.stages:
+            changed |= stage.grow(elapsed)
+        return changed
+
+    def shrink(self):
+        now = self.clock()
+        elapsed = now - self.shrink_begin
+        self.grow_begin = self.shrink_begin = now
+        if elapsed <= 0:
+            return False
+        changed = False
+        for stage in self.stages:
+            changed |= stage.shrink(elapsed)
+        return changed
@@ -0,0 +1,49 @@
+import os
+from .round_robin_worker_threads import TaskGroup
+from .metrics import Stopwatch
+
+
+class EncoderSession:
+    """
+    The encoder of one of the concurrent decode sessions of a worker (--sessions_per_device), on the threads of a JpegEncoder
+    or RawFrameEncoder shared by all of them. Same interface as the shared encoder, but join() waits for the frames
+    of this session only and completes its outputs, the thread stats are the ones of its frames.
+    """
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.tasks = TaskGroup()
+        self.destination_folder_paths = set()
+        # 'encode' and 'io', or 'io' only without jpeg encoding
+        self.stages = tuple(encoder.get_thread_stats())
+
+    def prepare(self, destination_folder_path, width, height, num_frames=None, pixel_format='yuv420'):
+        self.destination_folder_paths.add(destination_folder_path)
+        self.encoder.prepare(destination_folder_path, width, height, num_frames, pixel_format)
+
+    def encode(self, data, width, height, path, release_fn=None, resizer=None, pixel_format='yuv420'):
+        self.destination_folder_paths.add(os.path.dirname(path))
+        clock = Stopwatch()
+        self.tasks.add()
+        self.encoder.encode(data, width, height, path, release_fn, resizer, pixel_format, self.tasks)
+        # the decoder waiting on the queues shared with the other sessions
+        self.tasks.add_stats(self.stages[0], blocked_time=clock.lap(), tasks=0)
+
+    def join(self):
+        try:
+            self.tasks.join()
+        finally:
+            destination_folder_paths, self.destination_folder_paths = self.destination_folder_paths, set()
+            self.encoder.flush(destination_folder_paths)
+
+    def reset_thread_stats(self):
+        self.tasks.reset_stats()
+
+    def get_thread_stats(self):
+        return {stage: self.tasks.get_stats(stage) for stage in self.stages}
+
+    def get_thread_config(self):
+        return self.encoder.get_thread_config()
+
+    def get_buffer_pool_stats(self):
+        # the pool is shared, its counters include the frames of the other sessions
+        return self.encoder.get_buffer_pool_stats()
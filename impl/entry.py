@@ -1,5 +1,11 @@
+import contextlib
+import copy
 import os
 import sys
+import threading
+import time
+import traceback
+from .metrics import StageMetrics
 
 
 def touch(fname):
@@ -9,24 +15,218 @@ def touch(fname):
         open(fname, 'a').close()
 
 
-def entry(gpu_id, video_file, output_dir, log_dir, num_jpeg_encoding_threads, num_io_threads, jpeg_encoding_quality, interval, thread_max_queue, libjpegturbo_path):
+# seconds between the progress heartbeats sent to the parent, see PersistentWorker
+HEARTBEAT_INTERVAL = 2.
+
+
+class _ProgressHeartbeat:
+    """sends ('progress', (frames through any stage, expected frames)) to the parent every interval seconds while a job runs"""
+    def __init__(self, send, metrics, encoders, interval=HEARTBEAT_INTERVAL):
+        self.send = send
+        self.metrics = metrics
+        self.encoders = encoders
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._entry, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop_event.set()
+        self.thread.join()
+
+    def get_progress(self):
+        # a stage moving is progress, e.g. the encoders draining while the decoder waits
+        frames = sum(counters['frames'] for counters in list(self.metrics.stages.values()))
+        for encoder in self.encoders:
+            for thread_stats in encoder.get_thread_stats().values():
+                frames += sum(stats['tasks'] for stats in thread_stats)
+        return frames
+
+    def _entry(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.send(('progress', (self.get_progress(), self.metrics.expected_frames)))
+            except (OSError, RuntimeError):
+                # the parent is gone, or a stage was added while reading
+                pass
+
+
+def worker_entry(connections, device, num_jpeg_encoding_threads, num_io_threads, jpeg_encoding_quality, sampler, thread_max_queue, libjpegturbo_path, num_cpu_decode_threads, jpeg_buffer_pool_size, output_mode, max_shard_size, frame_pool_memory, thread_dispatch, output_name, resize=None, crop=None, auto_tune_limits=None, raw_format='yuv420', frame_filter=None, renditions=(), pixel_format='yuv420', io_backend='stdio', sync_policy='none', sync_batch_size=64, frame_pool_overflow=0):
+    """
+    connections: one per decode session, the sessions share the encoding and write threads, see impl/encoder_session.py,
+    io_backend, sync_policy, sync_batch_size: how the jpg files are written, see DirectoryFileWriter in impl/utils/native_file_ops.py,
+    frame_pool_overflow: frame buffers allocated over the budget instead of stalling, see FrameBufferPool
+    """
+    from .video_decoder import create_decoder
+
+    def create_encoder(quality):
+        from .jpeg_encoder import JpegEncoder
+        if output_mode == 'shards':
+            from .shard_writer import ShardedOutputWriter
+            writer = ShardedOutputWriter(max_shard_size)
+        elif io_backend == 'dirfd':
+            from .utils.native_file_ops import DirectoryFileWriter
+            writer = DirectoryFileWriter(sync_policy, sync_batch_size)
+        else:
+            writer = None
+        if output_mode == 'raw':
+            from .raw_writer import RawFrameEncoder
+            # same interface, no jpeg encoding
+            return RawFrameEncoder(num_io_threads, thread_max_queue, raw_format, thread_dispatch)
+        return JpegEncoder(num_jpeg_encoding_threads, num_io_threads, quality, thread_max_queue, libjpegturbo_path, jpeg_buffer_pool_size, writer, thread_dispatch, auto_tune_limits)
+
+    jpeg_encoder = create_encoder(jpeg_encoding_quality)
+    # each rendition has its own encoding and write threads
+    rendition_encoders = tuple((rendition, create_encoder(rendition.quality)) for rendition in renditions)
+    # the frame buffer budget is split between the sessions
+    session_frame_pool_memory = frame_pool_memory // len(connections)
+
+    def serve(connection, jpeg_encoder, rendition_encoders, sampler, frame_filter):
+        decoder = create_decoder(device, num_cpu_decode_threads)
+        encoders = (jpeg_encoder, *(encoder for _, encoder in rendition_encoders))
+        # the heartbeats and the results are sent by different threads
+        send_lock = threading.Lock()
+
+        def send(message):
+            with send_lock:
+                connection.send(message)
+
+        while True:
+            job = connection.recv()
+            if job is None:
+                break
+            video_file, output_dir, log_dir, resume, video_name = job
+            metrics = StageMetrics()
+            with _ProgressHeartbeat(send, metrics, encoders):
+                result = run_job(decoder, jpeg_encoder, video_file, output_dir, log_dir, session_frame_pool_memory, sampler, output_mode, resume, output_name, resize, crop, frame_filter, rendition_encoders, metrics, pixel_format, video_name, frame_pool_overflow)
+            send(('result', result))
+
+    with contextlib.ExitStack() as exit_stack:
+        for encoder in (jpeg_encoder, *(encoder for _, encoder in rendition_encoders)):
+            exit_stack.enter_context(encoder)
+        if len(connections) == 1:
+            serve(connections[0], jpeg_encoder, rendition_encoders, sampler, frame_filter)
+            return
+        from .encoder_session import EncoderSession
+        # the sessions print at the same time, the output of each job goes to its own log
+        sys.stdout, sys.stderr = SessionOutput(sys.stdout), SessionOutput(sys.stderr)
+        # the samplers and the frame filter are stateful, each session has its own
+        threads = [threading.Thread(target=serve, args=(connection, EncoderSession(jpeg_encoder), tuple((copy.deepcopy(rendition), EncoderSession(encoder)) for rendition, encoder in rendition_encoders),
+                                                        copy.deepcopy(sampler), copy.deepcopy(frame_filter)))
+                   for connection in connections]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+def _prepare_output_dir(video_file, output_dir, output_mode, resume):
+    """returns the frames already written by an interrupted run, to skip"""
+    from .manifest import scan_written_frames, remove_shards
+    if output_mode == 'shards':
+        # shards are not appendable, start over, the shards of any previous run would outlive a run writing fewer
+        remove_shards(output_dir)
+        return None
+    if not resume:
+        return None
+    if output_mode == 'raw':
+        from .raw_writer import remove_raw_frames
+        remove_raw_frames(output_dir)
+    else:
+        skip_frames = scan_written_frames(output_dir)
+        if len(skip_frames) > 0:
+            print(f'{video_file}: resuming, {len(skip_frames)} frames already written in {output_dir}')
+        return skip_frames
+    return None
+
+
+def run_job(decoder, jpeg_encoder, video_file, output_dir, log_dir, frame_pool_memory, sampler, output_mode='files', resume=False, output_name='index', resize=None, crop=None, frame_filter=None, rendition_encoders=(), metrics=None, pixel_format='yuv420', video_name=None, frame_pool_overflow=0):
+    """
+    rendition_encoders: (Rendition, encoder) of the additional outputs, see impl/renditions.py, metrics: StageMetrics of the job, pixel_format: see BaseVideoDecoder.decode(),
+    video_name: output directory name of the video under the rendition directories (see impl/input_list.py), the one of output_dir by default,
+    frame_pool_overflow: see FrameBufferPool
+    """
+    from .video_decoder import DecodeOutput
     if log_dir is not None:
-        sys.stdout = TeeStdOut(os.path.join(log_dir, 'stdout'))
-        sys.stderr = TeeStdErr(os.path.join(log_dir, 'stdout'))
+        if isinstance(sys.stdout, SessionOutput):
+            logfile = open(os.path.join(log_dir, 'stdout'), 'a')
+            sys.stdout.set_logfile(logfile)
+            sys.stderr.set_logfile(logfile)
+        else:
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = TeeStdOut(os.path.join(log_dir, 'stdout'))
+            sys.stderr = TeeStdErr(os.path.join(log_dir, 'stdout'))
         success_file = os.path.join(log_dir, 'success')
         if os.path.exists(success_file):
             os.remove(success_file)
 
-    from .jpeg_encoder import JpegEncoder
-    from impl.nv_vpf_decoder import nv_vpf_decode_video_with_ffmpeg_demuxer
-
-    jpeg_encoder = JpegEncoder(num_jpeg_encoding_threads, num_io_threads, jpeg_encoding_quality, thread_max_queue, libjpegturbo_path)
+    if metrics is None:
+        metrics = StageMetrics()
+    begin = time.perf_counter()
+    encoders = (jpeg_encoder, *(encoder for _, encoder in rendition_encoders))
+    for encoder in encoders:
+        encoder.reset_thread_stats()
+    # the jpeg buffer pools outlive the job, their counters are diffed
+    buffer_pool_stats = [encoder.get_buffer_pool_stats() for encoder in encoders]
+    frame_pool = None
+    try:
+        skip_frames = _prepare_output_dir(video_file, output_dir, output_mode, resume)
+        renditions = []
+        for rendition, encoder in rendition_encoders:
+            rendition_output_dir = os.path.join(rendition.output_dir, video_name if video_name is not None else os.path.basename(output_dir))
+            os.makedirs(rendition_output_dir, exist_ok=True)
+            rendition_skip_frames = _prepare_output_dir(video_file, rendition_output_dir, output_mode, resume)
+            renditions.append(DecodeOutput(rendition_output_dir, encoder, rendition.sampler, rendition_skip_frames, rendition.resize, rendition.crop))
+        try:
+            frame_pool = decoder.decode(video_file, output_dir, jpeg_encoder, frame_pool_memory, sampler, skip_frames, output_name, resize, crop, metrics, frame_filter, renditions, pixel_format, frame_pool_overflow)
+        finally:
+            # drain the pipelines, the encoder threads are reused by the next job
+            for encoder in encoders:
+                encoder.join()
+        frame_pool_stats = frame_pool.get_stats()
+        if frame_pool_stats['stalls'] > 0 or frame_pool_stats['overflow_allocations'] > 0:
+            print(f"{video_file}: decoder stalled on {frame_pool_stats['stalls']}/{frame_pool_stats['gets']} frames ({frame_pool_stats['stall_time']:.2f}s) waiting for the encoders, {frame_pool_stats['max_buffers']} frame buffers"
+                  f", {frame_pool_stats['overflow_allocations']} buffers allocated over the budget")
+        if log_dir is not None:
+            touch(success_file)
+        return True, _get_job_metrics(metrics, encoders, frame_pool, begin, buffer_pool_stats)
+    except Exception:
+        traceback.print_exc()
+        return False, _get_job_metrics(metrics, encoders, frame_pool, begin, buffer_pool_stats)
+    finally:
+        if log_dir is not None:
+            if isinstance(sys.stdout, SessionOutput):
+                sys.stdout.set_logfile(None)
+                sys.stderr.set_logfile(None)
+                logfile.close()
+            else:
+                sys.stdout.close()
+                sys.stderr.close()
+                sys.stdout, sys.stderr = stdout, stderr
 
-    with jpeg_encoder:
-        nv_vpf_decode_video_with_ffmpeg_demuxer(gpu_id, video_file, output_dir, jpeg_encoder, thread_max_queue * num_jpeg_encoding_threads, interval)
 
-    if log_dir is not None:
-        touch(success_file)
+def _get_job_metrics(metrics, encoders, frame_pool, begin, buffer_pool_stats):
+    if frame_pool is not None:
+        frame_pool_stats = frame_pool.get_stats()
+        # the decoder waiting for a free frame buffer
+        metrics.add('frame_pool', 0., frames=frame_pool_stats['gets'])
+        metrics.add_blocked('frame_pool', frame_pool_stats['stall_time'])
+    # the stages of the renditions are summed up with the main ones
+    for encoder in encoders:
+        thread_stats = encoder.get_thread_stats()
+        # blocked_time: the decoder waiting on the encode queues, the encoders waiting on the write queues
+        if 'encode' in thread_stats:
+            metrics.add_thread_stats('encode', thread_stats['encode'])
+        metrics.add_thread_stats('write', thread_stats['io'])
+    for encoder, begin_stats in zip(encoders, buffer_pool_stats):
+        if begin_stats is not None:
+            # the encoders reusing a jpeg output buffer (hits) or allocating one
+            end_stats = encoder.get_buffer_pool_stats()
+            metrics.add_buffer_pool_stats('jpeg_buffers', end_stats['hits'] - begin_stats['hits'], end_stats['misses'] - begin_stats['misses'])
+    return {'wall_time': time.perf_counter() - begin, 'stages': metrics.to_dict(), 'threads': encoders[0].get_thread_config()}
 
 
 class TeeStdOut:
@@ -42,6 +242,9 @@ class TeeStdOut:
         self.terminal.flush()
         self.logfile.flush()
 
+    def close(self):
+        self.logfile.close()
+
 
 class TeeStdErr:
     def __init__(self, filename):
@@ -55,3 +258,28 @@ class TeeStdErr:
     def flush(self):
         self.terminal.flush()
         self.logfile.flush()
+
+    def close(self):
+        self.logfile.close()
+
+
+class SessionOutput:
+    """sys.stdout or sys.stderr of a worker running several jobs at once, what a thread writes also goes to the log file of its job"""
+    def __init__(self, terminal):
+        self.terminal = terminal
+        self.local = threading.local()
+
+    def set_logfile(self, logfile):
+        self.local.logfile = logfile
+
+    def write(self, message):
+        self.terminal.write(message)
+        logfile = getattr(self.local, 'logfile', None)
+        if logfile is not None:
+            logfile.write(message)
+
+    def flush(self):
+        self.terminal.flush()
+        logfile = getattr(self.local, 'logfile', None)
+        if logfile is not None:
+            logfile.flush()
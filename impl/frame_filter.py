@@ -0,0 +1,58 @@
+import os
+import json
+import numpy as np
+
+KEPT_FRAMES_FILE_NAME = 'kept_frames.json'
+
+
+class DuplicateFrameFilter:
+    """
+    Drops the near-duplicate frames of a video (static scenes, slides, surveillance), before they are encoded.
+    The signature of a frame is the mean luma of grid x grid blocks, sampled on a sparse grid of pixels,
+    a frame is kept if the mean absolute difference to the signature of the last kept frame reaches threshold (in luma levels, 0-255).
+    """
+    # pixels sampled per block side
+    block_samples = 8
+
+    def __init__(self, threshold, grid=16):
+        assert threshold >= 0 and grid > 0
+        self.threshold = threshold
+        self.grid = grid
+        self.reset()
+
+    def reset(self):
+        self.last_signature = None
+        self.kept = []
+        self.num_dropped = 0
+
+    def get_signature(self, frame, width, height):
+        luma = frame[:width * height].reshape(height, width)
+        samples = self.grid * self.block_samples
+        step_y, step_x = max(height // samples, 1), max(width // samples, 1)
+        luma = luma[::step_y, ::step_x]
+        block_height, block_width = max(luma.shape[0] // self.grid, 1), max(luma.shape[1] // self.grid, 1)
+        grid_height, grid_width = min(self.grid, luma.shape[0]), min(self.grid, luma.shape[1])
+        blocks = luma[:grid_height * block_height, :grid_width * block_width].reshape(grid_height, block_height, grid_width, block_width)
+        return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+    def accept(self, frame, width, height, key):
+        """frame: planar YUV420, key: frame index or timestamp recorded in the kept frame index"""
+        signature = self.get_signature(frame, width, height)
+        if self.last_signature is not None and np.abs(signature - self.last_signature).mean() < self.threshold:
+            self.num_dropped += 1
+            return False
+        self.last_signature = signature
+        self.kept.append(key)
+        return True
+
+    def write_index(self, destination_folder_path, previous_keys=None, kept=None, num_dropped=None):
+        """
+        writes destination/kept_frames.json, previous_keys: the frames kept by an interrupted run,
+        kept, num_dropped: of an output sampling part of the frames (a rendition), all the frames by default
+        """
+        if kept is None:
+            kept, num_dropped = self.kept, self.num_dropped
+        kept = sorted(set(kept).union(previous_keys)) if previous_keys else kept
+        index = {'threshold': self.threshold, 'grid': self.grid, 'kept': kept, 'dropped': num_dropped}
+        with open(os.path.join(destination_folder_path, KEPT_FRAMES_FILE_NAME), 'w', encoding='utf-8') as f:
+            json.dump(index, f)
@@ -0,0 +1,179 @@
+import ctypes
+import queue
+import threading
+import numpy as np
+from .frame_filter import DuplicateFrameFilter
+from .frame_pool import FrameBufferPool
+from .sampling import IntervalSampler
+from .video_decoder import create_decoder, get_yuv420_frame_size, set_up_resizing
+from .utils.yuv_resize import parse_resize, parse_crop
+from .utils.yuv_rgb import yuv420_to_rgb
+
+OUTPUT_FORMATS = ('yuv420', 'rgb', 'jpeg')
+
+# put() checks the stop event this often while the consumer is not reading
+_PUT_POLL_INTERVAL = 0.1
+
+
+class Frame:
+    """
+    index starts from 1, pts is in seconds or None if unknown.
+    data is owned by the consumer: a planar YUV420 uint8 array (see impl/raw_writer.py get_yuv420_planes()),
+    a height x width x 3 RGB uint8 array, or the bytes of a jpg file.
+    """
+    __slots__ = ('index', 'pts', 'data', 'width', 'height')
+
+    def __init__(self, index, pts, data, width, height):
+        self.index = index
+        self.pts = pts
+        self.data = data
+        self.width = width
+        self.height = height
+
+    def __repr__(self):
+        return f'Frame(index={self.index}, pts={self.pts}, width={self.width}, height={self.height})'
+
+
+class _Error:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_END = object()
+
+
+class FrameIterator:
+    """
+    Iterates the frames of a video decoded, resized and converted by a background thread, at most prefetch frames ahead.
+    Use as a context manager or call close(), the background thread stops as soon as the consumer stops early.
+    """
+    def __init__(self, decoder, source_file_path, sampler=None, resize=None, crop=None, output_format='yuv420', prefetch=8,
+                 frame_pool_memory=64 * 1024 * 1024, jpeg_quality=85, libjpegturbo_path=None, frame_filter=None):
+        assert output_format in OUTPUT_FORMATS and prefetch > 0
+        self.decoder = decoder
+        self.source_file_path = source_file_path
+        self.sampler = sampler if sampler is not None else IntervalSampler(1)
+        self.resize = resize
+        self.crop = crop
+        self.output_format = output_format
+        self.frame_pool_memory = frame_pool_memory
+        self.jpeg_quality = jpeg_quality
+        self.libjpegturbo_path = libjpegturbo_path
+        self.frame_filter = frame_filter
+        self.frames = queue.Queue(prefetch)
+        self.stop_event = threading.Event()
+        self.is_finished = False
+        self.thread = threading.Thread(target=self._decode_entry, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Frame:
+        if self.is_finished:
+            raise StopIteration
+        item = self.frames.get()
+        if item is _END or isinstance(item, _Error):
+            self.is_finished = True
+            self.thread.join()
+            if item is _END:
+                raise StopIteration
+            raise item.exception
+        return item
+
+    def _put(self, item):
+        """returns False once stopped"""
+        while not self.stop_event.is_set():
+            try:
+                self.frames.put(item, timeout=_PUT_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _create_converter(self):
+        if self.output_format == 'rgb':
+            return lambda frame, width, height: yuv420_to_rgb(frame, width, height, np.empty((height, width, 3), dtype=np.uint8))
+        if self.output_format == 'jpeg':
+            from .utils.yuv_jpeg_encoding import YUVJpegEncoder
+            jpeg_encoder = YUVJpegEncoder(self.libjpegturbo_path)
+
+            def compress(frame, width, height):
+                compressed = jpeg_encoder.compress(frame, width, height, quality=self.jpeg_quality)
+                try:
+                    return ctypes.string_at(compressed.get_ptr(), compressed.get_size())
+                finally:
+                    compressed.dispose()
+            return compress
+        return lambda frame, width, height: frame.copy()
+
+    def _decode_entry(self):
+        try:
+            convert = self._create_converter()
+            self.sampler.reset()
+            if self.frame_filter is not None:
+                self.frame_filter.reset()
+            with self.decoder.open(self.source_file_path) as stream:
+                resizer = set_up_resizing(stream, self.resize, self.crop)
+                width, height = stream.output_width, stream.output_height
+                frame_pool = FrameBufferPool(get_yuv420_frame_size(width, height), self.frame_pool_memory)
+                # the buffers of the pool are reused, the consumer gets its own copy
+                resized = None
+                for index, pts, frame in stream.frames(frame_pool, self.sampler):
+                    try:
+                        if self.frame_filter is not None and not self.frame_filter.accept(frame, width, height, index):
+                            continue
+                        if resizer is not None:
+                            if resized is None:
+                                resized = np.empty(resizer.output_size, dtype=np.uint8)
+                            data = convert(resizer(frame, resized), resizer.output_width, resizer.output_height)
+                            output_width, output_height = resizer.output_width, resizer.output_height
+                        else:
+                            data = convert(frame, width, height)
+                            output_width, output_height = width, height
+                    finally:
+                        frame_pool.release(frame)
+                    if not self._put(Frame(index, pts, data, output_width, output_height)):
+                        return
+        except Exception as e:
+            self._put(_Error(e))
+            return
+        self._put(_END)
+
+    def close(self):
+        """stops the decoding, the frames not consumed yet are dropped"""
+        self.stop_event.set()
+        self.is_finished = True
+        while self.thread.is_alive():
+            # unblocks a pending put()
+            try:
+                while True:
+                    self.frames.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(_PUT_POLL_INTERVAL)
+
+
+def iterate_frames(source_file_path, device='cpu', sampler=None, resize=None, crop=None, output_format='yuv420', prefetch=8,
+                   frame_pool_memory=64 * 1024 * 1024, num_cpu_decode_threads=0, jpeg_quality=85, libjpegturbo_path=None, dedup_threshold=None):
+    """
+    Decodes a video in process, e.g. in a dataloader, device is a gpu id or 'cpu', resize and crop are specs as --resize and --crop
+    (see impl/utils/yuv_resize.py), dedup_threshold drops the near-duplicate frames (see impl/frame_filter.py). Returns a FrameIterator of Frame:
+
+        with iterate_frames('video.mp4', device=0, sampler=create_sampler(fps=1), resize='256', crop='224x224', output_format='rgb') as frames:
+            for frame in frames:
+                ...
+    """
+    if isinstance(resize, str):
+        resize = parse_resize(resize)
+    if isinstance(crop, str):
+        crop = parse_crop(crop)
+    frame_filter = DuplicateFrameFilter(dedup_threshold) if dedup_threshold is not None else None
+    return FrameIterator(create_decoder(device, num_cpu_decode_threads), source_file_path, sampler, resize, crop, output_format, prefetch,
+                         frame_pool_memory, jpeg_quality, libjpegturbo_path, frame_filter)
@@ -0,0 +1,70 @@
+import threading
+import time
+import numpy as np
+
+
+class FrameBufferPool:
+    """
+    Reference-counted raw frame buffers, sized by a memory budget.
+    get() leases a buffer with one reference, retain() adds one, the buffer returns to the pool when release() drops
+    the last one. get() blocks while the budget is used up, unless max_overflow extra buffers are allowed, these are
+    dropped on release.
+    """
+    def __init__(self, frame_size, memory_budget, min_buffers=2, max_overflow=0):
+        self.frame_size = frame_size
+        self.max_buffers = max(min_buffers, memory_budget // frame_size)
+        self.max_overflow = max_overflow
+        self.free_buffers = []
+        self.ref_counts = {}
+        self.num_allocated = 0
+        self.num_overflow = 0
+        self.num_gets = 0
+        self.num_stalls = 0
+        self.stall_time = 0.
+        self.num_overflow_allocations = 0
+        self.condition = threading.Condition()
+
+    def get(self):
+        with self.condition:
+            self.num_gets += 1
+            if len(self.free_buffers) == 0 and self.num_allocated >= self.max_buffers:
+                if self.num_overflow < self.max_overflow:
+                    self.num_overflow += 1
+                    self.num_overflow_allocations += 1
+                    buffer = np.empty(self.frame_size, dtype=np.uint8)
+                    self.ref_counts[id(buffer)] = [1, buffer, True]
+                    return buffer
+                self.num_stalls += 1
+                begin = time.perf_counter()
+                while len(self.free_buffers) == 0:
+                    self.condition.wait()
+                self.stall_time += time.perf_counter() - begin
+            if len(self.free_buffers) > 0:
+                buffer = self.free_buffers.pop()
+            else:
+                buffer = np.empty(self.frame_size, dtype=np.uint8)
+                self.num_allocated += 1
+            self.ref_counts[id(buffer)] = [1, buffer, False]
+            return buffer
+
+    def retain(self, buffer):
+        with self.condition:
+            self.ref_counts[id(buffer)][0] += 1
+
+    def release(self, buffer):
+        with self.condition:
+            entry = self.ref_counts[id(buffer)]
+            entry[0] -= 1
+            if entry[0] > 0:
+                return
+            del self.ref_counts[id(buffer)]
+            if entry[2]:
+                self.num_overflow -= 1
+            else:
+                self.free_buffers.append(buffer)
+                self.condition.notify()
+
+    def get_stats(self):
+        with self.condition:
+            return {'gets': self.num_gets, 'stalls': self.num_stalls, 'stall_time': self.stall_time,
+                    'overflow_allocations': self.num_overflow_allocations, 'buffers': self.num_allocated, 'max_buffers': self.max_buffers}
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import sys
+import numpy as np
+
+# how the output directory of a video is named, see OutputNames
+OUTPUT_NAMINGS = ('basename', 'relative', 'hash')
+
+
+def read_input_list(path):
+    """yields the video paths of a list file, one per line, optionally double-quoted, lazily, '-' reads stdin"""
+    f = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8')
+    try:
+        for line in f:
+            line = line.strip()
+            if line.startswith('"') and line.endswith('"'):
+                line = line[1: -1]
+            if len(line) > 0:
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _hash64(value: str):
+    # 0 marks an empty slot of HashedSet
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+
+class HashedSet:
+    """
+    Set of strings kept as 64-bit hashes in an open-addressing table, 8 to 32 bytes per string instead of ~150 for a set of str.
+    Two strings with the same hash are taken for the same one, about one chance in 400000 among 10 million strings.
+    """
+    def __init__(self, capacity=1024):
+        assert capacity > 0 and capacity & (capacity - 1) == 0
+        self.table = np.zeros(capacity, dtype=np.uint64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, value):
+        table, key = self.table, _hash64(value)
+        mask = len(table) - 1
+        index = key & mask
+        while True:
+            slot = int(table[index])
+            if slot == 0:
+                return False
+            if slot == key:
+                return True
+            index = (index + 1) & mask
+
+    def add(self, value):
+        """returns False if value is already in the set"""
+        # at most half full, the probes stay short
+        if (self.size + 1) * 2 > len(self.table):
+            self._grow()
+        return self._insert(_hash64(value))
+
+    def _insert(self, key):
+        table = self.table
+        mask = len(table) - 1
+        index = key & mask
+        while True:
+            slot = int(table[index])
+            if slot == 0:
+                table[index] = key
+                self.size += 1
+                return True
+            if slot == key:
+                return False
+            index = (index + 1) & mask
+
+    def _grow(self):
+        keys = self.table[self.table != 0].tolist()
+        self.table = np.zeros(len(self.table) * 2, dtype=np.uint64)
+        self.size = 0
+        for key in keys:
+            self._insert(key)
+
+
+def unique(video_files):
+    """yields the first occurrence of each path, in order"""
+    seen = HashedSet()
+    for video_file in video_files:
+        if seen.add(video_file):
+            yield video_file
+
+
+def get_hashed_name(video_file):
+    """the base name and a stable hash of the absolute path, e.g. clip.mp4_3f2a9c01b4e7"""
+    digest = hashlib.blake2b(os.path.abspath(video_file).encode('utf-8'), digest_size=6).hexdigest()
+    return f'{os.path.basename(video_file)}_{digest}'
+
+
+def get_relative_name(video_file, input_root):
+    """the path relative to input_root, None if the video is not under it"""
+    try:
+        relative_path = os.path.relpath(os.path.abspath(video_file), os.path.abspath(input_root))
+    except ValueError:
+        # another drive
+        return None
+    if relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep):
+        return None
+    return relative_path
+
+
+class OutputNames:
+    """
+    Output directory name of each video, under output_dir, log_dir and the rendition directories:
+        'basename': the file name, a video whose file name was already used by a previous one in the list gets the hashed name
+        'relative': the path relative to input_root (a mirrored tree), the hashed name outside of input_root
+        'hash': the file name and a hash of the absolute path, see get_hashed_name()
+    add() is called on the videos in list order before they are processed, the names depend on the order with 'basename' only.
+    """
+    def __init__(self, naming='basename', input_root=None):
+        assert naming in OUTPUT_NAMINGS
+        self.naming = naming
+        self.input_root = input_root if input_root is not None else os.getcwd()
+        self.basenames = HashedSet() if naming == 'basename' else None
+        # the videos not named by the naming rule, few
+        self.renamed = {}
+
+    def add(self, video_file):
+        if self.naming == 'basename' and not self.basenames.add(os.path.basename(video_file)):
+            self.renamed[video_file] = get_hashed_name(video_file)
+            print(f'{video_file}: {os.path.basename(video_file)} already used by another video, output to {self.renamed[video_file]}')
+
+    def get(self, video_file):
+        name = self.renamed.get(video_file)
+        if name is not None:
+            return name
+        if self.naming == 'basename':
+            return os.path.basename(video_file)
+        if self.naming == 'relative':
+            relative_name = get_relative_name(video_file, self.input_root)
+            if relative_name is not None:
+                return relative_name
+        return get_hashed_name(video_file)
@@ -0,0 +1,235 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+def get_default_node_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class SQLiteJobQueue:
+    """
+    Queue of videos shared by several nodes (hosts or processes) in a SQLite database, e.g. on shared storage.
+    A node claims a job with a lease, renewed by heartbeat(), a job whose lease expired is claimed again by any node.
+    A failed job is retried, preferably by another node, up to max_attempts claims.
+    The lease times use the wall clock of the nodes, the clock skew must be much shorter than lease_time.
+    """
+    def __init__(self, path, node_id=None, lease_time=300., max_attempts=3, clock=time.time):
+        assert lease_time > 0 and max_attempts > 0
+        self.path = path
+        self.node_id = node_id if node_id is not None else get_default_node_id()
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.clock = clock
+        # transactions are explicit, a connection is shared by the threads of the node
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self._transaction() as cursor:
+            cursor.execute('CREATE TABLE IF NOT EXISTS jobs (video TEXT PRIMARY KEY, cost REAL, seq INTEGER, status TEXT, node TEXT, '
+                           'lease_expiry REAL, attempts INTEGER, last_failed_node TEXT, updated REAL)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, cost)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS nodes (node TEXT PRIMARY KEY, last_heartbeat REAL, done INTEGER, failed INTEGER)')
+            cursor.execute('INSERT OR IGNORE INTO nodes VALUES (?, ?, 0, 0)', (self.node_id, self.clock()))
+
+    def _transaction(self):
+        return _Transaction(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_jobs(self, jobs, costs):
+        """the jobs already in the queue are left as they are, returns the number of jobs added"""
+        now = self.clock()
+        with self._transaction() as cursor:
+            seq = cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM jobs').fetchone()[0]
+            num_jobs = cursor.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+            cursor.executemany("INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, 'pending', NULL, NULL, 0, NULL, ?)",
+                               ((job, cost, seq + index + 1, now) for index, (job, cost) in enumerate(zip(jobs, costs))))
+            return cursor.execute('SELECT COUNT(*) FROM jobs').fetchone()[0] - num_jobs
+
+    def claim(self):
+        """leases the longest pending or expired job, returns None if there is none"""
+        now = self.clock()
+        with self._transaction() as cursor:
+            # expired too many times, the node running it was likely killed by it
+            cursor.execute("UPDATE jobs SET status = 'failed', node = NULL, updated = ? WHERE status = 'running' AND lease_expiry < ? AND attempts >= ?",
+                           (now, now, self.max_attempts))
+            row = cursor.execute("SELECT video FROM jobs WHERE status = 'pending' OR (status = 'running' AND lease_expiry < ?) "
+                                 "ORDER BY last_failed_node IS ?, cost DESC, seq LIMIT 1", (now, self.node_id)).fetchone()
+            if row is None:
+                return None
+            cursor.execute("UPDATE jobs SET status = 'running', node = ?, lease_expiry = ?, attempts = attempts + 1, updated = ? WHERE video = ?",
+                           (self.node_id, now + self.lease_time, now, row[0]))
+            return row[0]
+
+    def heartbeat(self, jobs):
+        """renews the leases of the jobs, returns the jobs whose lease was lost to another node"""
+        now = self.clock()
+        lost = []
+        with self._transaction() as cursor:
+            cursor.execute('UPDATE nodes SET last_heartbeat = ? WHERE node = ?', (now, self.node_id))
+            for job in jobs:
+                cursor.execute("UPDATE jobs SET lease_expiry = ? WHERE video = ? AND node = ? AND status = 'running'", (now + self.lease_time, job, self.node_id))
+                if cursor.rowcount == 0:
+                    lost.append(job)
+        return lost
+
+    def complete(self, job, is_success):
+        now = self.clock()
+        with self._transaction() as cursor:
+            if is_success:
+                cursor.execute("UPDATE jobs SET status = 'done', node = ?, lease_expiry = NULL, updated = ? WHERE video = ?", (self.node_id, now, job))
+                cursor.execute('UPDATE nodes SET done = done + 1, last_heartbeat = ? WHERE node = ?', (now, self.node_id))
+                return
+            # retried by another node if possible, unless the lease was lost
+            cursor.execute("UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, node = NULL, lease_expiry = NULL, "
+                           "last_failed_node = ?, updated = ? WHERE video = ? AND node = ? AND status = 'running'",
+                           (self.max_attempts, self.node_id, now, job, self.node_id))
+            if cursor.rowcount == 1:
+                cursor.execute('UPDATE nodes SET failed = failed + 1, last_heartbeat = ? WHERE node = ?', (now, self.node_id))
+
+    def release(self, job):
+        """gives a leased job back without counting the attempt"""
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE jobs SET status = 'pending', node = NULL, lease_expiry = NULL, attempts = MAX(attempts - 1, 0), updated = ? "
+                           "WHERE video = ? AND node = ? AND status = 'running'", (self.clock(), job, self.node_id))
+
+    def has_unfinished(self):
+        """pending or running jobs, expired or not"""
+        with self._transaction() as cursor:
+            return cursor.execute("SELECT EXISTS (SELECT 1 FROM jobs WHERE status IN ('pending', 'running'))").fetchone()[0] == 1
+
+    def get_progress(self):
+        """number of jobs by status, and {node: (done, failed, seconds since the last heartbeat)}"""
+        now = self.clock()
+        with self._transaction() as cursor:
+            progress = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0}
+            progress.update(cursor.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            progress['total'] = sum(progress.values())
+            progress['nodes'] = {node: (done, failed, now - last_heartbeat) for node, last_heartbeat, done, failed in cursor.execute('SELECT * FROM nodes')}
+            return progress
+
+    def close(self):
+        self.connection.close()
+
+
+class _Transaction:
+    def __init__(self, job_queue):
+        self.job_queue = job_queue
+
+    def __enter__(self):
+        self.job_queue.lock.acquire()
+        try:
+            # takes the write lock upfront, concurrent claims never deadlock on a lock upgrade
+            self.cursor = self.job_queue.connection.execute('BEGIN IMMEDIATE')
+        except BaseException:
+            self.job_queue.lock.release()
+            raise
+        return self.cursor
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.job_queue.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        finally:
+            self.job_queue.lock.release()
+
+
+class DistributedScheduler:
+    """
+    Scheduler (see impl/scheduler.py) whose jobs are claimed from a SQLiteJobQueue shared by several nodes.
+    The leases of the running jobs are renewed every lease_time / 3 seconds, an idle worker polls the queue
+    until every job of every node is finished, the jobs of a dead node are claimed once their lease expires.
+    """
+    def __init__(self, job_queue, workers, poll_interval=10.):
+        self.job_queue = job_queue
+        self.workers = tuple(workers)
+        self.poll_interval = poll_interval
+        # (job, allowed devices or None), the job is still leased by this node
+        self._retries = []
+        self._held = set()
+        self._num_running = 0
+        self._cancelled = False
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_entry, daemon=True)
+
+    def __enter__(self):
+        self._heartbeat_thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._retries)
+
+    def _heartbeat_entry(self):
+        while not self._stop_event.wait(self.job_queue.lease_time / 3):
+            with self._condition:
+                held = tuple(self._held)
+            try:
+                for job in self.job_queue.heartbeat(held):
+                    print(f'{job}: lease lost, it may be processed by another node too')
+            except sqlite3.Error as e:
+                print(f'heartbeat failed: {e}')
+
+    def add_job(self, job, cost=0, devices=None):
+        with self._condition:
+            self._retries.append((job, devices))
+            self._condition.notify_all()
+
+    def cancel(self):
+        with self._condition:
+            self._cancelled = True
+            self._retries.clear()
+            self._condition.notify_all()
+
+    def _start(self, job):
+        self._num_running += 1
+        return job
+
+    def next_job(self, worker_index):
+        device = self.workers[worker_index]
+        while True:
+            with self._condition:
+                if self._cancelled:
+                    return None
+                for index, (job, devices) in enumerate(self._retries):
+                    if devices is None or device in devices:
+                        del self._retries[index]
+                        return self._start(job)
+            job = self.job_queue.claim()
+            with self._condition:
+                if job is not None:
+                    self._held.add(job)
+                    return self._start(job)
+                # running jobs may be retried here, or requeued when their node dies
+                if self._num_running == 0 and len(self._retries) == 0 and not self.job_queue.has_unfinished():
+                    return None
+                self._condition.wait(self.poll_interval)
+
+    def job_done(self, worker_index):
+        with self._condition:
+            self._num_running -= 1
+            self._condition.notify_all()
+
+    def complete(self, job, is_success):
+        """records the final result of a job"""
+        self.job_queue.complete(job, is_success)
+        with self._condition:
+            self._held.discard(job)
+            self._condition.notify_all()
+
+    def close(self):
+        self._stop_event.set()
+        if self._heartbeat_thread.is_alive():
+            self._heartbeat_thread.join()
+        # interrupted, the other nodes don't wait for the leases to expire
+        for job in self._held:
+            self.job_queue.release(job)
+        self._held.clear()
@@ -1,35 +1,121 @@
+import numpy as np
 from .round_robin_worker_threads import RoundRobinWorkerThreads, BaseWorkerThreadHandler
-from impl.utils.yuv_jpeg_encoding import YUVJpegEncoder, JPEGEncoded
-from .utils.native_file_ops import native_write
+from impl.utils.yuv_jpeg_encoding import YUVJpegEncoder, JPEGEncoded, JPEGBufferPool, TJSAMP_420, TJSAMP_GRAY
+from .utils.pixel_formats import deinterleave_nv12_chroma
+from .utils.native_file_ops import NativeFileWriter
+from .auto_tuner import AutoTuner
+from .metrics import Stopwatch
 
 
 class IOWorkerThread(BaseWorkerThreadHandler):
-    def __call__(self, compressed: JPEGEncoded, path: str):
-        native_write(compressed.get_ptr(), compressed.get_size(), path)
-        compressed.dispose()
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __call__(self, compressed: JPEGEncoded, path: str, task_group=None):
+        clock = Stopwatch()
+        try:
+            size = compressed.get_size()
+            self.writer.write(compressed.get_ptr(), size, path)
+        except Exception as e:
+            if task_group is None:
+                raise
+            task_group.done(e)
+            return None
+        finally:
+            compressed.dispose()
+        if task_group is not None:
+            task_group.add_stats('io', clock.lap(), size)
+            task_group.done()
+        return size
 
 
 class JPEGEncoderWorkerThread(BaseWorkerThreadHandler):
-    def __init__(self, quality, io_threads, libjpegturbo_path):
+    def __init__(self, quality, io_threads, libjpegturbo_path, buffer_pool):
         self.quality = quality
         self.io_threads = io_threads
         self.libjpegturbo_path = libjpegturbo_path
+        self.buffer_pool = buffer_pool
 
     def __enter__(self):
         self.jpeg_encoder = YUVJpegEncoder(self.libjpegturbo_path)
+        self.resized = None
+        self.chroma = None
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         del self.jpeg_encoder
 
-    def __call__(self, data, width, height, path):
-        compressed = self.jpeg_encoder.compress(data, width, height, quality=self.quality)
-        self.io_threads.put(compressed, path)
+    def _resize(self, data, resizer):
+        if self.resized is None or len(self.resized) != resizer.output_size:
+            self.resized = np.empty(resizer.output_size, dtype=np.uint8)
+        return resizer(data, self.resized)
+
+    def _compress_nv12(self, data, width, height):
+        # the luma plane is encoded in place, the chroma is deinterleaved to the U and V planes
+        chroma_width, chroma_height = (width + 1) // 2, (height + 1) // 2
+        if self.chroma is None or self.chroma.shape != (2, chroma_height, chroma_width):
+            self.chroma = np.empty((2, chroma_height, chroma_width), dtype=np.uint8)
+        u, v = self.chroma
+        deinterleave_nv12_chroma(data, width, height, u, v)
+        return self.jpeg_encoder.compress_planes((data, u, v), (width, chroma_width, chroma_width), width, height, TJSAMP_420, quality=self.quality, buffer_pool=self.buffer_pool)
+
+    def _compress(self, data, width, height, release_fn, resizer, pixel_format):
+        try:
+            if resizer is not None:
+                resized = self._resize(data, resizer)
+                if release_fn is not None:
+                    release_fn(data)
+                    release_fn = None
+                data, width, height, pixel_format = resized, resizer.output_width, resizer.output_height, resizer.output_format
+            if pixel_format == 'nv12':
+                return self._compress_nv12(data, width, height)
+            subsample = TJSAMP_GRAY if pixel_format == 'gray' else TJSAMP_420
+            return self.jpeg_encoder.compress(data, width, height, subsample, quality=self.quality, buffer_pool=self.buffer_pool)
+        finally:
+            if release_fn is not None:
+                release_fn(data)
+
+    def __call__(self, data, width, height, path, release_fn=None, resizer=None, pixel_format='yuv420', task_group=None):
+        """task_group: see TaskGroup in impl/round_robin_worker_threads.py, gets the error of the task instead of the thread"""
+        clock = Stopwatch()
+        try:
+            compressed = self._compress(data, width, height, release_fn, resizer, pixel_format)
+        except Exception as e:
+            if task_group is None:
+                raise
+            task_group.done(e)
+            return None
+        size = compressed.get_size()
+        if task_group is not None:
+            task_group.add_stats('encode', clock.lap(), size)
+        self.io_threads.put(compressed, path, task_group)
+        if task_group is not None:
+            # the encoder thread waiting on the write queues
+            task_group.add_stats('io', blocked_time=clock.lap(), tasks=0)
+        return size
+
+
+def _get_default_buffer_pool_size(num_encoder_threads, num_io_threads, thread_max_queue):
+    # enough to keep every io thread and its queue busy
+    return num_io_threads * (thread_max_queue + 1) + num_encoder_threads
 
 
 class JpegEncoder:
-    def __init__(self, num_encoder_threads, num_io_threads, quality, thread_max_queue, libjpegturbo_path):
-        self.io_threads = RoundRobinWorkerThreads(num_io_threads, IOWorkerThread, max_queue=thread_max_queue)
-        self.encode_workers = RoundRobinWorkerThreads(num_encoder_threads, JPEGEncoderWorkerThread, (quality, self.io_threads, libjpegturbo_path), max_queue=thread_max_queue)
+    def __init__(self, num_encoder_threads, num_io_threads, quality, thread_max_queue, libjpegturbo_path, buffer_pool_size=None, writer=None, dispatch='round_robin', auto_tune_limits=None):
+        """auto_tune_limits: (max encoder threads, max io threads, max queue size), the threads and queues are tuned at runtime, see impl/auto_tuner.py"""
+        self.is_default_buffer_pool_size = buffer_pool_size is None
+        if buffer_pool_size is None:
+            buffer_pool_size = _get_default_buffer_pool_size(num_encoder_threads, num_io_threads, thread_max_queue)
+        self.buffer_pool = JPEGBufferPool(buffer_pool_size)
+        if writer is None:
+            writer = NativeFileWriter()
+        self.writer = writer
+        self.io_threads = RoundRobinWorkerThreads(num_io_threads, IOWorkerThread, (writer,), max_queue=thread_max_queue, dispatch=dispatch)
+        self.encode_workers = RoundRobinWorkerThreads(num_encoder_threads, JPEGEncoderWorkerThread, (quality, self.io_threads, libjpegturbo_path, self.buffer_pool), max_queue=thread_max_queue, dispatch=dispatch)
+        if auto_tune_limits is not None:
+            max_encoder_threads, max_io_threads, max_queue = auto_tune_limits
+            self.tuner = AutoTuner(self.encode_workers, self.io_threads, max(max_encoder_threads, num_encoder_threads), max(max_io_threads, num_io_threads), max(max_queue, thread_max_queue))
+        else:
+            self.tuner = None
 
     def __enter__(self):
         self.io_threads.__enter__()
@@ -40,9 +126,50 @@ class JpegEncoder:
         self.encode_workers.__exit__(exc_type, exc_val, exc_tb)
         self.io_threads.__exit__(exc_type, exc_val, exc_tb)
 
-    def encode(self, data, width, height, path):
-        self.encode_workers.put(data, width, height, path)
+    def prepare(self, destination_folder_path, width, height, num_frames=None, pixel_format='yuv420'):
+        """called before the frames of a video"""
+        pass
+
+    def encode(self, data, width, height, path, release_fn=None, resizer=None, pixel_format='yuv420', task_group=None):
+        """
+        release_fn(data) is called once data is no longer used, resizer (see impl/utils/yuv_resize.py) is applied before encoding,
+        pixel_format: layout of data, see impl/utils/pixel_formats.py, gray frames are encoded as grayscale jpg files,
+        task_group: TaskGroup of the task once encoded and written, see impl/encoder_session.py
+        """
+        self.encode_workers.put(data, width, height, path, release_fn, resizer, pixel_format, task_group)
+        if self.tuner is not None and self.tuner.update():
+            self._update_buffer_pool_size()
+
+    def _update_buffer_pool_size(self):
+        if self.is_default_buffer_pool_size:
+            self.buffer_pool.set_max_buffers(_get_default_buffer_pool_size(self.encode_workers.num_threads, self.io_threads.num_threads, self.io_threads.max_queue))
 
     def join(self):
-        self.encode_workers.join()
-        self.io_threads.join()
+        try:
+            self.encode_workers.join()
+            self.io_threads.join()
+            # no task in flight, the threads can be removed
+            if self.tuner is not None and self.tuner.shrink():
+                self._update_buffer_pool_size()
+        finally:
+            self.writer.flush()
+
+    def flush(self, destination_folder_paths):
+        """completes the output of the videos written to destination_folder_paths, once their tasks are done"""
+        self.writer.flush(destination_folder_paths)
+
+    def reset_thread_stats(self):
+        self.encode_workers.reset_stats()
+        self.io_threads.reset_stats()
+        if self.tuner is not None:
+            self.tuner.reset()
+
+    def get_thread_config(self):
+        return {'encode_threads': self.encode_workers.num_threads, 'encode_queue': self.encode_workers.max_queue,
+                'io_threads': self.io_threads.num_threads, 'io_queue': self.io_threads.max_queue}
+
+    def get_thread_stats(self):
+        return {'encode': self.encode_workers.get_stats(), 'io': self.io_threads.get_stats()}
+
+    def get_buffer_pool_stats(self):
+        return {'hits': self.buffer_pool.hits, 'misses': self.buffer_pool.misses, 'in_use': self.buffer_pool.num_in_use, 'max': self.buffer_pool.max_buffers}
@@ -0,0 +1,120 @@
+import os
+import re
+import glob
+import json
+import hashlib
+import threading
+
+
+def get_input_fingerprint(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_settings_hash(settings: dict):
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+class Manifest:
+    """
+    Durable record of the processed videos, one json object per line, appended and fsync-ed.
+    A video is 'started' when dispatched and 'done' once all of its frames are written, the last record of a video wins.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn write of a killed run
+                        continue
+                    self.records[record['video']] = record
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _matches(self, video_file, status, fingerprint, settings_hash):
+        record = self.records.get(video_file)
+        return record is not None and record['status'] == status and record['fingerprint'] == fingerprint and record['settings'] == settings_hash
+
+    def is_done(self, video_file, fingerprint, settings_hash):
+        return self._matches(video_file, 'done', fingerprint, settings_hash)
+
+    def is_started(self, video_file, fingerprint, settings_hash):
+        return self._matches(video_file, 'started', fingerprint, settings_hash)
+
+    def _append(self, video_file, status, fingerprint, settings_hash):
+        record = {'video': video_file, 'status': status, 'fingerprint': fingerprint, 'settings': settings_hash}
+        with self.lock:
+            self.records[video_file] = record
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def mark_started(self, video_file, fingerprint, settings_hash):
+        self._append(video_file, 'started', fingerprint, settings_hash)
+
+    def mark_done(self, video_file, fingerprint, settings_hash):
+        self._append(video_file, 'done', fingerprint, settings_hash)
+
+    def close(self):
+        self.file.close()
+
+
+_frame_file_name_pattern = re.compile(r'^(\d+)\.jpg$')
+
+
+def _is_complete_jpeg(path):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < 4:
+                return False
+            f.seek(-2, os.SEEK_END)
+            # EOI marker
+            return f.read(2) == b'\xff\xd9'
+    except OSError:
+        return False
+
+
+def scan_written_frames(output_dir):
+    """returns the indices of the complete frames in output_dir, truncated frames left by a killed worker are removed"""
+    written_frames = set()
+    for entry in os.scandir(output_dir):
+        match = _frame_file_name_pattern.match(entry.name)
+        if match is None:
+            continue
+        if _is_complete_jpeg(entry.path):
+            written_frames.add(int(match.group(1)))
+        else:
+            os.remove(entry.path)
+    return written_frames
+
+
+def remove_shards(output_dir):
+    from .shard_writer import SHARD_LIST_FILE_NAME
+    for path in glob.glob(os.path.join(glob.escape(output_dir), 'shard_*.tar*')):
+        os.remove(path)
+    list_path = os.path.join(output_dir, SHARD_LIST_FILE_NAME)
+    if os.path.exists(list_path):
+        os.remove(list_path)
+
+
+def remove_partial_output(output_dir):
+    """removes the frames, shards and indices written in output_dir by a failed run"""
+    from .raw_writer import RAW_FRAMES_FILE_NAME, RAW_METADATA_FILE_NAME
+    from .frame_filter import KEPT_FRAMES_FILE_NAME
+    if not os.path.isdir(output_dir):
+        return
+    remove_shards(output_dir)
+    for entry in os.scandir(output_dir):
+        if _frame_file_name_pattern.match(entry.name) or entry.name in (RAW_FRAMES_FILE_NAME, RAW_METADATA_FILE_NAME, KEPT_FRAMES_FILE_NAME):
+            os.remove(entry.path)
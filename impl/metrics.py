@@ -0,0 +1,229 @@
+import bisect
+import os
+import json
+import threading
+import time
+
+# upper bounds of the buckets of the task latency histograms, 10us to 10s by factors of sqrt(2), then an unbounded bucket
+LATENCY_BUCKETS = tuple(1e-5 * 2 ** (i / 2) for i in range(41))
+
+
+def new_latency_histogram():
+    return [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+def add_latency(histogram, seconds):
+    histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+def add_histograms(histogram, other):
+    for i, count in enumerate(other):
+        histogram[i] += count
+
+
+def get_latency_percentile(histogram, percent):
+    """upper bound of the bucket of the percentile, inf in the unbounded bucket, None if empty"""
+    total = sum(histogram)
+    if total == 0:
+        return None
+    rank = total * percent / 100
+    count = 0
+    for bucket, bucket_count in enumerate(histogram):
+        count += bucket_count
+        if count >= rank and bucket_count > 0:
+            break
+    return LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else float('inf')
+
+
+class StageMetrics:
+    """
+    Per-stage counters of a video job: frames, bytes, busy_time (seconds spent in the stage)
+    and blocked_time (seconds the stage waited on the next one, e.g. a full queue),
+    the stages of worker threads also have a histogram of their task times, latency (see LATENCY_BUCKETS).
+    Not thread-safe, each stage is updated by a single thread.
+    """
+    def __init__(self):
+        self.stages = {}
+        # frames of the video being decoded, None if unknown
+        self.expected_frames = None
+
+    def _get(self, stage):
+        counters = self.stages.get(stage)
+        if counters is None:
+            counters = self.stages[stage] = {'frames': 0, 'bytes': 0, 'busy_time': 0., 'blocked_time': 0.}
+        return counters
+
+    def add(self, stage, busy_time, frames=1, num_bytes=0):
+        counters = self._get(stage)
+        counters['frames'] += frames
+        counters['bytes'] += num_bytes
+        counters['busy_time'] += busy_time
+
+    def add_blocked(self, stage, blocked_time):
+        self._get(stage)['blocked_time'] += blocked_time
+
+    def add_buffer_pool_stats(self, stage, hits, misses):
+        """buffers of a pool reused (hits) or allocated (misses), counted as the frames of the stage"""
+        counters = self._get(stage)
+        counters['frames'] += hits + misses
+        counters['hits'] = counters.get('hits', 0) + hits
+        counters['misses'] = counters.get('misses', 0) + misses
+
+    def add_thread_stats(self, stage, thread_stats):
+        """adds the stats of the worker threads of a stage, see RoundRobinWorkerThreads.get_stats()"""
+        counters = self._get(stage)
+        for stats in thread_stats:
+            counters['frames'] += stats['tasks']
+            counters['bytes'] += stats['bytes']
+            counters['busy_time'] += stats['busy_time']
+            counters['blocked_time'] += stats['blocked_time']
+            if 'latency' in stats:
+                add_histograms(counters.setdefault('latency', new_latency_histogram()), stats['latency'])
+
+    def to_dict(self):
+        return {stage: dict(counters) for stage, counters in self.stages.items()}
+
+
+class Stopwatch:
+    __slots__ = ('begin',)
+
+    def __init__(self):
+        self.begin = time.perf_counter()
+
+    def lap(self):
+        """seconds since the last lap"""
+        now = time.perf_counter()
+        elapsed, self.begin = now - self.begin, now
+        return elapsed
+
+
+def _format_labels(labels):
+    return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels)
+
+
+def _format_hits(counters):
+    if 'hits' not in counters or counters['frames'] == 0:
+        return ''
+    return f" hits {counters['hits'] / counters['frames']:.0%}"
+
+
+def _format_percentiles(histogram, percents=(50, 99)):
+    if histogram is None or sum(histogram) == 0:
+        return ''
+    return ''.join(f' p{percent} {get_latency_percentile(histogram, percent) * 1000:.2g}ms' for percent in percents)
+
+
+class MetricsRecorder:
+    """
+    Collects the stage metrics sent back by the workers.
+    Each video is appended to log_dir/metrics.jsonl, the totals per device are kept and,
+    if textfile_path is given, exported in the Prometheus text format (node_exporter textfile collector).
+    The throughput of a device is its written frames over the time from its first job start to its last job end,
+    the jobs of a device may overlap (several workers or sessions), their wall times add up to more.
+    """
+    prefix = 'vid2jpg'
+
+    def __init__(self, log_dir=None, textfile_path=None, clock=time.monotonic):
+        self.clock = clock
+        self.textfile_path = textfile_path
+        self.file = open(os.path.join(log_dir, 'metrics.jsonl'), 'a', encoding='utf-8') if log_dir is not None else None
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def record(self, video_file, device, is_success, metrics):
+        """metrics: {'wall_time': seconds, 'stages': StageMetrics.to_dict()} or None if the worker crashed or timed out"""
+        with self.lock:
+            now = self.clock()
+            totals = self.devices.setdefault(device, {'videos': {'success': 0, 'fail': 0}, 'wall_time': 0., 'stages': {}, 'begin': now, 'end': now})
+            totals['videos']['success' if is_success else 'fail'] += 1
+            totals['end'] = now
+            if metrics is not None:
+                totals['wall_time'] += metrics['wall_time']
+                totals['begin'] = min(totals['begin'], now - metrics['wall_time'])
+                for stage, counters in metrics['stages'].items():
+                    stage_totals = totals['stages'].setdefault(stage, {})
+                    for key, value in counters.items():
+                        if key == 'latency':
+                            add_histograms(stage_totals.setdefault(key, new_latency_histogram()), value)
+                        else:
+                            stage_totals[key] = stage_totals.get(key, 0) + value
+            if self.file is not None:
+                self.file.write(json.dumps({'video': video_file, 'device': device, 'success': bool(is_success), 'time': time.time(), 'metrics': metrics}) + '\n')
+                self.file.flush()
+            if self.textfile_path is not None:
+                self._write_textfile()
+
+    def _write_textfile(self):
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append(f'# HELP {self.prefix}_{name} {help_text}')
+            lines.append(f'# TYPE {self.prefix}_{name} {metric_type}')
+            for labels, value in samples:
+                lines.append(f'{self.prefix}_{name}{{{_format_labels(labels)}}} {value}')
+
+        devices = sorted(self.devices.items(), key=lambda item: str(item[0]))
+        add_metric('videos_total', 'counter', 'Processed videos.',
+                   [((('device', device), ('status', status)), count) for device, totals in devices for status, count in totals['videos'].items()])
+        add_metric('job_seconds_total', 'counter', 'Wall time of the video jobs.',
+                   [((('device', device),), totals['wall_time']) for device, totals in devices])
+        add_metric('frames_per_second', 'gauge', 'Frames written per second by a device, over its active time.',
+                   [((('device', device),), self._get_throughput(totals)) for device, totals in devices])
+        for key, name, help_text in (('frames', 'stage_frames_total', 'Frames processed by a pipeline stage.'),
+                                     ('bytes', 'stage_bytes_total', 'Bytes produced by a pipeline stage.'),
+                                     ('busy_time', 'stage_busy_seconds_total', 'Time spent in a pipeline stage.'),
+                                     ('blocked_time', 'stage_blocked_seconds_total', 'Time a pipeline stage waited on the next one.')):
+            add_metric(name, 'counter', help_text,
+                       [((('device', device), ('stage', stage)), counters[key]) for device, totals in devices for stage, counters in totals['stages'].items()])
+        name = f'{self.prefix}_stage_task_seconds'
+        lines.append(f'# HELP {name} Time of a task of a pipeline stage, a frame encoded or written.')
+        lines.append(f'# TYPE {name} histogram')
+        for device, totals in devices:
+            for stage, counters in totals['stages'].items():
+                if 'latency' not in counters:
+                    continue
+                labels = (('device', device), ('stage', stage))
+                count = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS + (float('inf'),), counters['latency']):
+                    count += bucket_count
+                    lines.append(f"{name}_bucket{{{_format_labels((*labels, ('le', f'{bound:.6g}' if bound != float('inf') else '+Inf')))}}} {count}")
+                # the busy time is the sum of the task times
+                lines.append(f"{name}_sum{{{_format_labels(labels)}}} {counters['busy_time']}")
+                lines.append(f'{name}_count{{{_format_labels(labels)}}} {count}')
+        add_metric('stage_buffers_total', 'counter', 'Buffers of a pipeline stage pool, reused (hit) or allocated (miss).',
+                   [((('device', device), ('stage', stage), ('result', result)), counters[key])
+                    for device, totals in devices for stage, counters in totals['stages'].items() if 'hits' in counters
+                    for result, key in (('hit', 'hits'), ('miss', 'misses'))])
+
+        # atomic replace, the collector never reads a partial file
+        temp_path = self.textfile_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.textfile_path)
+
+    @staticmethod
+    def _get_throughput(totals):
+        frames = totals['stages'].get('write', {}).get('frames', 0)
+        elapsed = totals['end'] - totals['begin']
+        return frames / elapsed if elapsed > 0 else 0.
+
+    def get_summary(self):
+        """one line per device, the throughput, the busy time of each stage and the task time percentiles of the thread stages"""
+        with self.lock:
+            summary = []
+            for device, totals in sorted(self.devices.items(), key=lambda item: str(item[0])):
+                stages = [f"{stage} {counters['busy_time']:.1f}s" + (f" (blocked {counters['blocked_time']:.1f}s)" if counters['blocked_time'] > 0 else '') + _format_percentiles(counters.get('latency')) + _format_hits(counters)
+                          for stage, counters in totals['stages'].items()]
+                throughput = f"{totals['stages'].get('write', {}).get('frames', 0)} frames in {totals['end'] - totals['begin']:.1f}s, {self._get_throughput(totals):.1f} frames/s"
+                summary.append(f"device {device}: " + ', '.join([f"{totals['videos']['success']} succeeded, {totals['videos']['fail']} failed in {totals['wall_time']:.1f}s", throughput] + stages))
+            return summary
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
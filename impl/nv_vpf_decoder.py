@@ -1,94 +1,206 @@
-import os
 import pycuda.driver as cuda
 import PyNvCodec as nvc
 import numpy as np
+from .video_decoder import BaseVideoDecoder, BaseVideoStream
+from .sampling import IntervalSampler
+from .metrics import Stopwatch
+
+
+class NvVpfDecoder(BaseVideoDecoder):
+    def __init__(self, gpu_id):
+        cuda.init()
+        self.cuda_ctx = cuda.Device(gpu_id).retain_primary_context()
+        self.cuda_ctx.push()
+        self.cuda_stream = cuda.Stream()
+        self.cuda_ctx.pop()
+
+    def open(self, source_file_path):
+        return _NvVpfVideoStream(self.cuda_ctx, self.cuda_stream, source_file_path)
+
+
+def nv_vpf_decode_video_with_ffmpeg_demuxer(gpu_id, source_file_path, destination_folder_path, encoder, frame_pool_memory, interval=1):
+    NvVpfDecoder(gpu_id).decode(source_file_path, destination_folder_path, encoder, frame_pool_memory, IntervalSampler(interval))
+
+
+class _NvVpfVideoStream(BaseVideoStream):
+    def __init__(self, cuda_ctx, cuda_stream, source_file_path):
+        nvDmx = nvc.PyFFmpegDemuxer(source_file_path)
+        frame_rate = nvDmx.Framerate()
+        # from the container, not in every VPF build
+        num_frames = nvDmx.Numframes() if hasattr(nvDmx, 'Numframes') else 0
+        super().__init__(nvDmx.Width(), nvDmx.Height(), frame_rate if frame_rate > 0 else None, num_frames if num_frames > 0 else None)
+        self.nvDmx = nvDmx
+        self.time_base = nvDmx.Timebase()
+        self.start_pts = None
+        self.can_seek = self.frame_rate is not None and hasattr(nvc, 'SeekContext')
+        self.cuda_ctx, self.cuda_stream = cuda_ctx, cuda_stream
+        self.nvDec = nvc.PyNvDecoder(nvDmx.Width(), nvDmx.Height(), nvDmx.Format(), nvDmx.Codec(), cuda_ctx.handle, cuda_stream.handle)
+        self.nvRes = None
+        self._create_converter(nvDmx.Width(), nvDmx.Height())
+
+        # Determine colorspace conversion parameters.
+        # Some video streams don't specify these parameters so default values
+        # are most widespread bt601 and mpeg.
+        cspace, crange = nvDmx.ColorSpace(), nvDmx.ColorRange()
+        if nvc.ColorSpace.UNSPEC == cspace:
+            cspace = nvc.ColorSpace.BT_601
+        if nvc.ColorRange.UDEF == crange:
+            crange = nvc.ColorRange.MPEG
+        self.cc_ctx = nvc.ColorspaceConversionContext(cspace, crange)
+
+    def _create_converter(self, width, height):
+        cuda_ctx, cuda_stream = self.cuda_ctx, self.cuda_stream
+        self.nvCvt, self.nvDwn = None, None
+        if self.output_format == 'yuv420':
+            self.nvCvt = nvc.PySurfaceConverter(width, height, self.nvDmx.Format(), nvc.PixelFormat.YUV420, cuda_ctx.handle, cuda_stream.handle)
+            self.nvDwn = nvc.PySurfaceDownloader(width, height, self.nvCvt.Format(), cuda_ctx.handle, cuda_stream.handle)
+        elif self.output_format == 'nv12':
+            # decoded surfaces are downloaded as is, the encoder threads deinterleave the chroma
+            self.nvDwn = nvc.PySurfaceDownloader(width, height, self.nvDmx.Format(), cuda_ctx.handle, cuda_stream.handle)
+
+    def set_output_format(self, pixel_format):
+        # the luma plane of NV12 surfaces is the gray frame, 10 bit surfaces need the conversion
+        if pixel_format not in ('nv12', 'gray') or self.nvDmx.Format() != nvc.PixelFormat.NV12:
+            return False
+        self.output_format = pixel_format
+        self._create_converter(self.output_width, self.output_height)
+        return True
+
+    def set_output_size(self, width, height):
+        if not hasattr(nvc, 'PySurfaceResizer'):
+            return False
+        self.nvRes = nvc.PySurfaceResizer(width, height, self.nvDmx.Format(), self.cuda_ctx.handle, self.cuda_stream.handle)
+        self._create_converter(width, height)
+        self.output_width, self.output_height = width, height
+        return True
+
+    def _download(self, surface_nv12, frame):
+        clock = Stopwatch()
+        if self.nvRes is not None:
+            surface_nv12 = self.nvRes.Execute(surface_nv12)
+            if surface_nv12.Empty():
+                return False
+        surface = surface_nv12
+        if self.nvCvt is not None:
+            surface = self.nvCvt.Execute(surface_nv12, self.cc_ctx)
+            if surface.Empty():
+                return False
+        self.metrics.add('convert', clock.lap())
+        if self.output_format == 'gray':
+            success = self._download_luma(surface, frame)
+        else:
+            success = self.nvDwn.DownloadSingleSurface(surface, frame)
+        # waits for the conversion to finish on the cuda stream
+        self.metrics.add('download', clock.lap(), num_bytes=frame.nbytes)
+        return success
+
+    def _download_luma(self, surface_nv12, frame):
+        # the first output_height rows of the pitched NV12 plane
+        plane = surface_nv12.PlanePtr()
+        copy = cuda.Memcpy2D()
+        copy.set_src_device(plane.GpuMem())
+        copy.src_pitch = plane.Pitch()
+        copy.set_dst_host(frame)
+        copy.dst_pitch = copy.width_in_bytes = self.output_width
+        copy.height = self.output_height
+        self.cuda_ctx.push()
+        try:
+            copy(self.cuda_stream)
+            self.cuda_stream.synchronize()
+        finally:
+            self.cuda_ctx.pop()
+        return True
+
+    def _get_pts(self, packet_data):
+        if self.start_pts is None:
+            self.start_pts = packet_data.pts
+        return (packet_data.pts - self.start_pts) * self.time_base
+
+    def _seek(self, seek_time, packet, packet_data):
+        # demuxer returns the packet of the keyframe before seek_time
+        try:
+            seek_ctx = nvc.SeekContext(seek_frame=int(seek_time * self.frame_rate), mode=nvc.SeekMode.PREV_KEY_FRAME)
+            if not self.nvDmx.Seek(seek_ctx, packet):
+                return False
+        except (AttributeError, TypeError):
+            # not supported by this VPF build
+            self.can_seek = False
+            return False
+        self.nvDmx.LastPacketData(packet_data)
+        return True
+
+    def frames(self, frame_buffers, sampler):
+        nvDmx, nvDec = self.nvDmx, self.nvDec
+        packet = np.ndarray(shape=(0), dtype=np.uint8)
+        pdata_in, pdata_out = nvc.PacketData(), nvc.PacketData()
+
+        count = 0
+        index_from_pts = sampler.keyframes_only
+        has_packet = False
+
+        metrics = self.metrics
+        clock = Stopwatch()
+        while True:
+            if not has_packet:
+                # Demuxer has sync design, it returns packet every time it's called.
+                # If demuxer can't return packet it usually means EOF.
+                if not nvDmx.DemuxSinglePacket(packet):
+                    break
+
+                # Get last packet data to obtain frame timestamp
+                nvDmx.LastPacketData(pdata_in)
+                metrics.add('demux', clock.lap(), num_bytes=len(packet))
+            has_packet = False
+
+            if sampler.keyframes_only and not pdata_in.key:
+                continue
 
-
-class _RingBuffer:
-    def __init__(self, size, num):
-        self.buffers = tuple(np.empty(size, dtype=np.uint8) for _ in range(num))
-        self.index = 0
-
-    def get(self):
-        buffer = self.buffers[self.index]
-        return buffer
-
-    def forward(self):
-        self.index += 1
-        if self.index >= len(self.buffers):
-            self.index = 0
-
-
-def nv_vpf_decode_video_with_ffmpeg_demuxer(gpu_id, source_file_path, destination_folder_path, encoder, raw_frame_buffer_size, interval=1):
-    cuda.init()
-    cuda_ctx = cuda.Device(gpu_id).retain_primary_context()
-    cuda_ctx.push()
-    cuda_stream = cuda.Stream()
-    cuda_ctx.pop()
-
-    nvDmx = nvc.PyFFmpegDemuxer(source_file_path)
-    nvDec = nvc.PyNvDecoder(nvDmx.Width(), nvDmx.Height(), nvDmx.Format(), nvDmx.Codec(), cuda_ctx.handle, cuda_stream.handle)
-    nvCvt = nvc.PySurfaceConverter(nvDmx.Width(), nvDmx.Height(), nvDmx.Format(), nvc.PixelFormat.YUV420, cuda_ctx.handle, cuda_stream.handle)
-    nvDwn = nvc.PySurfaceDownloader(nvDmx.Width(), nvDmx.Height(), nvCvt.Format(), cuda_ctx.handle, cuda_stream.handle)
-
-    packet = np.ndarray(shape=(0), dtype=np.uint8)
-    frameSize = int(nvDmx.Width() * nvDmx.Height() * 3 / 2)
-
-    raw_frames = _RingBuffer(frameSize, raw_frame_buffer_size)
-
-    pdata_in, pdata_out = nvc.PacketData(), nvc.PacketData()
-
-    # Determine colorspace conversion parameters.
-    # Some video streams don't specify these parameters so default values
-    # are most widespread bt601 and mpeg.
-    cspace, crange = nvDmx.ColorSpace(), nvDmx.ColorRange()
-    if nvc.ColorSpace.UNSPEC == cspace:
-        cspace = nvc.ColorSpace.BT_601
-    if nvc.ColorRange.UDEF == crange:
-        crange = nvc.ColorRange.MPEG
-    cc_ctx = nvc.ColorspaceConversionContext(cspace, crange)
-
-    count = 0
-
-    while True:
-        # Demuxer has sync design, it returns packet every time it's called.
-        # If demuxer can't return packet it usually means EOF.
-        if not nvDmx.DemuxSinglePacket(packet):
-            break
-
-        # Get last packet data to obtain frame timestamp
-        nvDmx.LastPacketData(pdata_in)
-
-        # Decoder is async by design.
-        # As it consumes packets from demuxer one at a time it may not return
-        # decoded surface every time the decoding function is called.
-        surface_nv12 = nvDec.DecodeSurfaceFromPacket(pdata_in, packet, pdata_out)
-        if not surface_nv12.Empty():
-            count += 1
-            if (count - 1) % interval != 0:
+            # Decoder is async by design.
+            # As it consumes packets from demuxer one at a time it may not return
+            # decoded surface every time the decoding function is called.
+            surface_nv12 = nvDec.DecodeSurfaceFromPacket(pdata_in, packet, pdata_out)
+            if surface_nv12.Empty():
+                metrics.add('decode', clock.lap(), frames=0)
                 continue
-            surface_yuv420 = nvCvt.Execute(surface_nv12, cc_ctx)
-            if surface_yuv420.Empty():
+            metrics.add('decode', clock.lap())
+            pts = self._get_pts(pdata_out)
+            count += 1
+            if index_from_pts:
+                count = self._get_index_from_pts(pts, count)
+            # frames not accepted are neither converted nor downloaded
+            if sampler.accept(count, pts):
+                frame = frame_buffers.get()
+                if not self._download(surface_nv12, frame):
+                    frame_buffers.release(frame)
+                    return
+                yield count, pts, frame
+            if sampler.is_done():
+                return
+            if self.can_seek:
+                seek_time = self._get_seek_time(sampler, pts)
+                clock.lap()
+                if seek_time is not None and self._seek(seek_time, packet, pdata_in):
+                    metrics.add('demux', clock.lap(), num_bytes=len(packet))
+                    has_packet = True
+                    index_from_pts = True
+            clock.lap()
+
+        # Now we flush decoder to emtpy decoded frames queue.
+        clock.lap()
+        while True:
+            surface_nv12 = nvDec.FlushSingleSurface(pdata_out)
+            if surface_nv12.Empty():
                 break
-            if not nvDwn.DownloadSingleSurface(surface_yuv420, raw_frames.get()):
+            metrics.add('decode', clock.lap())
+            pts = self._get_pts(pdata_out)
+            count += 1
+            if index_from_pts:
+                count = self._get_index_from_pts(pts, count)
+            if not sampler.accept(count, pts):
+                continue
+            frame = frame_buffers.get()
+            if not self._download(surface_nv12, frame):
+                frame_buffers.release(frame)
                 break
-
-            encoder.encode(raw_frames.get(), nvDmx.Width(), nvDmx.Height(), os.path.join(destination_folder_path, f'{count:06d}.jpg'))
-            raw_frames.forward()
-
-    # Now we flush decoder to emtpy decoded frames queue.
-    while True:
-        count += 1
-        if (count - 1) % interval != 0:
-            continue
-        surface_nv12 = nvDec.FlushSingleSurface()
-        if surface_nv12.Empty():
-            break
-        surface_yuv420 = nvCvt.Execute(surface_nv12, cc_ctx)
-        if surface_yuv420.Empty():
-            break
-        if not nvDwn.DownloadSingleSurface(surface_yuv420, raw_frames.get()):
-            break
-
-        encoder.encode(raw_frames.get(), nvDmx.Width(), nvDmx.Height(), os.path.join(destination_folder_path, f'{count:06d}.jpg'))
-        raw_frames.forward()
+            yield count, pts, frame
+            clock.lap()
@@ -0,0 +1,139 @@
+import os
+import json
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from .manifest import get_input_fingerprint
+
+# the codecs and the pixel formats NVDEC decodes, see PyNvDecoder, 10 bit 4:2:0 surfaces go through the converter of _NvVpfVideoStream
+NVDEC_CODECS = ('h264', 'hevc', 'mpeg1video', 'mpeg2video', 'mpeg4', 'vc1', 'vp8', 'vp9', 'av1', 'mjpeg')
+NVDEC_PIXEL_FORMATS = ('yuv420p', 'yuvj420p', 'nv12', 'yuv420p10le', 'p010le')
+
+# AVColorSpace and AVColorRange, the fields nvDmx.ColorSpace() and nvDmx.ColorRange() read
+_COLOR_SPACES = {0: 'rgb', 1: 'bt709', 2: 'unspecified', 4: 'fcc', 5: 'bt470bg', 6: 'smpte170m', 7: 'smpte240m', 9: 'bt2020nc', 10: 'bt2020c'}
+_COLOR_RANGES = {0: 'unspecified', 1: 'mpeg', 2: 'jpeg'}
+
+
+def probe_video(path):
+    """container metadata of the first video stream, 'error' is set if the video can't be decoded"""
+    import av
+    info = {'codec': None, 'width': None, 'height': None, 'pixel_format': None, 'num_frames': None, 'duration': None,
+            'frame_rate': None, 'color_space': None, 'color_range': None, 'error': None}
+    try:
+        with av.open(path) as container:
+            if len(container.streams.video) == 0:
+                info['error'] = 'no video stream'
+                return info
+            stream = container.streams.video[0]
+            codec_context = stream.codec_context
+            frame_rate = float(stream.average_rate) if stream.average_rate else None
+            if stream.duration is not None:
+                duration = float(stream.duration * stream.time_base)
+            elif container.duration is not None:
+                duration = container.duration / 1000000
+            else:
+                duration = None
+            num_frames = stream.frames
+            if num_frames == 0 and duration is not None and frame_rate is not None:
+                num_frames = int(duration * frame_rate + 0.5)
+            info.update(codec=codec_context.name, width=codec_context.width, height=codec_context.height, pixel_format=codec_context.pix_fmt,
+                        num_frames=num_frames if num_frames > 0 else None, duration=duration, frame_rate=frame_rate,
+                        color_space=_COLOR_SPACES.get(int(codec_context.colorspace), str(codec_context.colorspace)),
+                        color_range=_COLOR_RANGES.get(int(codec_context.color_range), str(codec_context.color_range)))
+    except Exception as e:
+        info['error'] = f'{type(e).__name__}: {e}'
+    return info
+
+
+def get_probe_error(info):
+    """reason why the video can't be processed at all, None if it can"""
+    if info['error'] is not None:
+        return info['error']
+    if not info['width'] or not info['height']:
+        return 'unknown resolution'
+    if info['num_frames'] is None and info['duration'] is None:
+        return 'unknown length'
+    if info['num_frames'] == 0 or info['duration'] == 0:
+        return 'empty video'
+    return None
+
+
+def is_nvdec_supported(info):
+    return info['codec'] in NVDEC_CODECS and info['pixel_format'] in NVDEC_PIXEL_FORMATS
+
+
+def get_probed_frames(info):
+    """number of decoded frames, estimated from the duration if not in the container"""
+    if info['num_frames'] is not None:
+        return info['num_frames']
+    if info['duration'] is not None and info['frame_rate'] is not None:
+        return int(info['duration'] * info['frame_rate'] + 0.5)
+    return None
+
+
+class ProbeIndex:
+    """
+    On-disk cache of probe_video(), one json object per line keyed by path and (size, mtime),
+    a video is probed again when it changes, the last record of a video wins.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn write of a killed run
+                        continue
+                    self.records[record['video']] = record
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, video_file, fingerprint):
+        record = self.records.get(video_file)
+        if record is None or record['fingerprint'] != fingerprint:
+            return None
+        return record['info']
+
+    def add(self, video_file, fingerprint, info):
+        record = {'video': video_file, 'fingerprint': fingerprint, 'info': info}
+        with self.lock:
+            self.records[video_file] = record
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def probe_videos(video_files, probe_index, num_processes):
+    """returns {video: probe_video() info}, the videos missing from probe_index are probed in parallel on num_processes processes"""
+    infos = {}
+    to_probe = []
+    num_cached = 0
+    for video_file in video_files:
+        try:
+            fingerprint = get_input_fingerprint(video_file)
+        except OSError as e:
+            infos[video_file] = {'error': f'{type(e).__name__}: {e}'}
+            continue
+        info = probe_index.get(video_file, fingerprint)
+        if info is not None:
+            infos[video_file] = info
+            num_cached += 1
+        else:
+            to_probe.append((video_file, fingerprint))
+    if len(to_probe) > 0:
+        print(f'Probing {len(to_probe)} videos, {num_cached} cached in {probe_index.path}')
+        with ProcessPoolExecutor(num_processes) as executor:
+            for (video_file, fingerprint), info in zip(to_probe, executor.map(probe_video, (video_file for video_file, _ in to_probe), chunksize=4)):
+                probe_index.add(video_file, fingerprint, info)
+                infos[video_file] = info
+    return infos
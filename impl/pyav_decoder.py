@@ -0,0 +1,101 @@
+import av
+import numpy as np
+from .video_decoder import BaseVideoDecoder, BaseVideoStream
+from .metrics import Stopwatch
+
+# the ffmpeg pixel format of each output format of the stream,
+# gray frames are the Y plane of yuv420p, ffmpeg 'gray' is full range and would rescale the luma
+_AV_FORMATS = {'yuv420': 'yuv420p', 'nv12': 'nv12', 'gray': 'yuv420p'}
+
+
+def _copy_plane(plane, destination, width, height):
+    source = np.frombuffer(plane, dtype=np.uint8, count=plane.line_size * height).reshape(height, plane.line_size)
+    destination.reshape(height, width)[:] = source[:, :width]
+
+
+class PyAVDecoder(BaseVideoDecoder):
+    def __init__(self, num_threads=0):
+        self.num_threads = num_threads
+
+    def open(self, source_file_path):
+        return _PyAVVideoStream(source_file_path, self.num_threads)
+
+
+class _PyAVVideoStream(BaseVideoStream):
+    def __init__(self, source_file_path, num_threads):
+        self.container = av.open(source_file_path)
+        try:
+            self.stream = self.container.streams.video[0]
+            self.stream.thread_type = 'AUTO'
+            self.stream.codec_context.thread_count = num_threads
+        except Exception:
+            self.container.close()
+            raise
+        frame_rate = float(self.stream.average_rate) if self.stream.average_rate else None
+        num_frames = self.stream.frames
+        if num_frames == 0 and self.stream.duration is not None and frame_rate is not None:
+            num_frames = int(self.stream.duration * self.stream.time_base * frame_rate + 0.5)
+        super().__init__(self.stream.codec_context.width, self.stream.codec_context.height, frame_rate, num_frames if num_frames > 0 else None)
+        self.time_base = self.stream.time_base
+        self.start_time = self.stream.start_time if self.stream.start_time is not None else 0
+
+    def set_output_size(self, width, height):
+        self.output_width, self.output_height = width, height
+        return True
+
+    def set_output_format(self, pixel_format):
+        self.output_format = pixel_format
+        return True
+
+    def _copy_frame(self, video_frame, frame):
+        width, height = self.output_width, self.output_height
+        chroma_width, chroma_height = (width + 1) // 2, (height + 1) // 2
+        luma_size, chroma_size = width * height, chroma_width * chroma_height
+
+        av_format = _AV_FORMATS[self.output_format]
+        if video_frame.format.name != av_format or video_frame.width != width or video_frame.height != height:
+            video_frame = video_frame.reformat(width, height, av_format, interpolation='AREA')
+        _copy_plane(video_frame.planes[0], frame[: luma_size], width, height)
+        if self.output_format == 'nv12':
+            _copy_plane(video_frame.planes[1], frame[luma_size: luma_size + 2 * chroma_size], 2 * chroma_width, chroma_height)
+        elif self.output_format == 'yuv420':
+            _copy_plane(video_frame.planes[1], frame[luma_size: luma_size + chroma_size], chroma_width, chroma_height)
+            _copy_plane(video_frame.planes[2], frame[luma_size + chroma_size: luma_size + 2 * chroma_size], chroma_width, chroma_height)
+
+    def frames(self, frame_buffers, sampler):
+        if sampler.keyframes_only:
+            self.stream.codec_context.skip_frame = 'NONKEY'
+        index_from_pts = sampler.keyframes_only
+
+        metrics = self.metrics
+        count = 0
+        while True:
+            seek_time = None
+            clock = Stopwatch()
+            # demuxing and decoding run in the iterator
+            for video_frame in self.container.decode(self.stream):
+                metrics.add('decode', clock.lap())
+                pts = float((video_frame.pts - self.start_time) * self.time_base) if video_frame.pts is not None else None
+                count += 1
+                if index_from_pts:
+                    count = self._get_index_from_pts(pts, count)
+                if sampler.accept(count, pts):
+                    frame = frame_buffers.get()
+                    clock.lap()
+                    self._copy_frame(video_frame, frame)
+                    metrics.add('convert', clock.lap(), num_bytes=frame.nbytes)
+                    yield count, pts, frame
+                if sampler.is_done():
+                    return
+                seek_time = self._get_seek_time(sampler, pts)
+                if seek_time is not None:
+                    break
+                clock.lap()
+            if seek_time is None:
+                return
+            # lands on the keyframe before seek_time, decoder buffers are flushed
+            self.container.seek(int((seek_time / self.time_base) + self.start_time), backward=True, any_frame=False, stream=self.stream)
+            index_from_pts = True
+
+    def close(self):
+        self.container.close()
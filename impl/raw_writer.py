@@ -0,0 +1,246 @@
+import os
+import json
+import threading
+import numpy as np
+from .round_robin_worker_threads import RoundRobinWorkerThreads, BaseWorkerThreadHandler
+from .utils.yuv_rgb import yuv420_to_rgb
+from .video_decoder import get_yuv420_frame_size
+from .utils.pixel_formats import nv12_to_yuv420
+from .metrics import Stopwatch
+
+RAW_FRAMES_FILE_NAME = 'frames.npy'
+RAW_METADATA_FILE_NAME = 'frames.json'
+
+
+class RawFrameFile:
+    """
+    .npy array of the frames of a video, preallocated for capacity frames and grown by doubling,
+    the rows are written in place with pwrite() by any thread, the shape is set by close().
+    """
+    # fixed header, rewritten in place with the final shape
+    header_size = 128
+
+    def __init__(self, path, frame_shape, capacity):
+        self.path = path
+        self.frame_shape = tuple(frame_shape)
+        self.frame_size = int(np.prod(self.frame_shape))
+        self.capacity = max(capacity, 1)
+        self.keys = []
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            self._write_header(0)
+            self._allocate(self.capacity)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def _write_header(self, num_frames):
+        header = "{{'descr': '|u1', 'fortran_order': False, 'shape': {}, }}".format((num_frames, *self.frame_shape))
+        header = header.ljust(self.header_size - 10 - 1) + '\n'
+        assert len(header) + 10 == self.header_size
+        os.pwrite(self.fd, b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1'), 0)
+
+    def _allocate(self, capacity):
+        size = self.header_size + capacity * self.frame_size
+        if hasattr(os, 'posix_fallocate'):
+            # reserves the blocks, the file is not fragmented and a full disk fails early
+            os.posix_fallocate(self.fd, 0, size)
+        else:
+            os.ftruncate(self.fd, size)
+
+    def allocate_row(self, key):
+        """returns the row of the next frame, key is the frame index or timestamp of the frame"""
+        with self.lock:
+            row = len(self.keys)
+            self.keys.append(key)
+            if row >= self.capacity:
+                self.capacity *= 2
+                self._allocate(self.capacity)
+            return row
+
+    def write(self, row, data: np.ndarray):
+        assert data.nbytes == self.frame_size
+        view = memoryview(data.reshape(-1))
+        offset = self.header_size + row * self.frame_size
+        while len(view) > 0:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def close(self):
+        """shrinks the file to the written frames and sets the shape"""
+        try:
+            os.ftruncate(self.fd, self.header_size + len(self.keys) * self.frame_size)
+            self._write_header(len(self.keys))
+        finally:
+            os.close(self.fd)
+
+
+class RawOutputWorkerThread(BaseWorkerThreadHandler):
+    def __init__(self, raw_format):
+        self.raw_format = raw_format
+
+    def __enter__(self):
+        self.resized = None
+        self.yuv420 = None
+        self.rgb = None
+
+    def __call__(self, raw_file, row, data, width, height, release_fn=None, resizer=None, pixel_format='yuv420', task_group=None):
+        """task_group: see TaskGroup in impl/round_robin_worker_threads.py, gets the error of the task instead of the thread"""
+        clock = Stopwatch()
+        try:
+            num_bytes = self._write(raw_file, row, data, width, height, release_fn, resizer, pixel_format)
+        except Exception as e:
+            if task_group is None:
+                raise
+            task_group.done(e)
+            return None
+        if task_group is not None:
+            task_group.add_stats('io', clock.lap(), num_bytes)
+            task_group.done()
+        return num_bytes
+
+    def _write(self, raw_file, row, data, width, height, release_fn, resizer, pixel_format):
+        frame = data
+        # data is no longer used once it is copied
+        is_copied = False
+        try:
+            if resizer is not None:
+                if self.resized is None or len(self.resized) != resizer.output_size:
+                    self.resized = np.empty(resizer.output_size, dtype=np.uint8)
+                frame = resizer(frame, self.resized)
+                width, height, pixel_format = resizer.output_width, resizer.output_height, resizer.output_format
+                is_copied = True
+            if pixel_format == 'gray':
+                frame = frame[:width * height]
+            elif pixel_format == 'nv12':
+                frame_size = get_yuv420_frame_size(width, height)
+                if self.yuv420 is None or len(self.yuv420) != frame_size:
+                    self.yuv420 = np.empty(frame_size, dtype=np.uint8)
+                frame = nv12_to_yuv420(frame, width, height, self.yuv420)
+                is_copied = True
+            if self.raw_format == 'rgb' and pixel_format != 'gray':
+                if self.rgb is None or self.rgb.shape != (height, width, 3):
+                    self.rgb = np.empty((height, width, 3), dtype=np.uint8)
+                frame = yuv420_to_rgb(frame, width, height, self.rgb)
+                is_copied = True
+            if is_copied and release_fn is not None:
+                release_fn(data)
+                release_fn = None
+            raw_file.write(row, frame)
+        finally:
+            if release_fn is not None:
+                release_fn(data)
+        return frame.nbytes
+
+
+class RawFrameEncoder:
+    """
+    Same interface as JpegEncoder, writes the frames of each video to destination/frames.npy instead of jpg files,
+    as (frames, YUV420 frame size) or (frames, height, width, 3) RGB uint8, or (frames, height, width) gray frames, see open_raw_frames().
+    """
+    def __init__(self, num_io_threads, thread_max_queue, raw_format='yuv420', dispatch='round_robin'):
+        assert raw_format in ('yuv420', 'rgb')
+        self.raw_format = raw_format
+        self.io_threads = RoundRobinWorkerThreads(num_io_threads, RawOutputWorkerThread, (raw_format,), max_queue=thread_max_queue, dispatch=dispatch)
+        self.files = {}
+        # the files of concurrent decode sessions, see impl/encoder_session.py
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.io_threads.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.io_threads.__exit__(exc_type, exc_val, exc_tb)
+        self._close_files()
+
+    def _get_frame_shape(self, width, height, pixel_format):
+        if pixel_format == 'gray':
+            return height, width
+        if self.raw_format == 'rgb':
+            return height, width, 3
+        return get_yuv420_frame_size(width, height),
+
+    def prepare(self, destination_folder_path, width, height, num_frames=None, pixel_format='yuv420'):
+        """preallocates the output of a video of num_frames width x height frames, num_frames may be an estimate or None"""
+        self._open(destination_folder_path, width, height, pixel_format, num_frames)
+
+    def _open(self, destination_folder_path, width, height, pixel_format, num_frames=None):
+        with self.lock:
+            raw_file = self.files.get(destination_folder_path)
+            if raw_file is None:
+                raw_file = RawFrameFile(os.path.join(destination_folder_path, RAW_FRAMES_FILE_NAME), self._get_frame_shape(width, height, pixel_format), num_frames if num_frames else 256)
+                raw_file.width, raw_file.height = width, height
+                raw_file.format = 'gray' if pixel_format == 'gray' else self.raw_format
+                self.files[destination_folder_path] = raw_file
+            return raw_file
+
+    def encode(self, data, width, height, path, release_fn=None, resizer=None, pixel_format='yuv420', task_group=None):
+        """release_fn(data) is called once data is no longer used, path is the jpg path the frame would have in files output mode"""
+        destination_folder_path, file_name = os.path.split(path)
+        output_format = 'gray' if pixel_format == 'gray' else 'yuv420'
+        if resizer is not None:
+            raw_file = self._open(destination_folder_path, resizer.output_width, resizer.output_height, output_format)
+        else:
+            raw_file = self._open(destination_folder_path, width, height, output_format)
+        row = raw_file.allocate_row(int(os.path.splitext(file_name)[0]))
+        self.io_threads.put(raw_file, row, data, width, height, release_fn, resizer, pixel_format, task_group)
+
+    def _close_files(self, destination_folder_paths=None):
+        with self.lock:
+            if destination_folder_paths is None:
+                destination_folder_paths = tuple(self.files)
+            files = {path: self.files.pop(path) for path in destination_folder_paths if path in self.files}
+        for destination_folder_path, raw_file in files.items():
+            raw_file.close()
+            metadata = {'format': raw_file.format, 'width': raw_file.width, 'height': raw_file.height, 'shape': [len(raw_file.keys), *raw_file.frame_shape], 'keys': raw_file.keys}
+            with open(os.path.join(destination_folder_path, RAW_METADATA_FILE_NAME), 'w', encoding='utf-8') as f:
+                json.dump(metadata, f)
+
+    def join(self):
+        try:
+            self.io_threads.join()
+        finally:
+            self._close_files()
+
+    def flush(self, destination_folder_paths):
+        """completes the frames.npy of destination_folder_paths, once their tasks are done"""
+        self._close_files(destination_folder_paths)
+
+    def reset_thread_stats(self):
+        self.io_threads.reset_stats()
+
+    def get_thread_stats(self):
+        return {'io': self.io_threads.get_stats()}
+
+    def get_thread_config(self):
+        return {'io_threads': self.io_threads.num_threads, 'io_queue': self.io_threads.max_queue}
+
+    def get_buffer_pool_stats(self):
+        # no jpeg output buffers
+        return None
+
+
+def open_raw_frames(output_dir):
+    """returns the frames written by RawFrameEncoder as a read-only memory map, and their metadata ('keys' are the frame indices or timestamps)"""
+    with open(os.path.join(output_dir, RAW_METADATA_FILE_NAME), 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+    return np.load(os.path.join(output_dir, RAW_FRAMES_FILE_NAME), mmap_mode='r'), metadata
+
+
+def get_yuv420_planes(frame, width, height):
+    """Y, U, V views of a YUV420 frame of open_raw_frames()"""
+    chroma_width, chroma_height = (width + 1) // 2, (height + 1) // 2
+    luma_size, chroma_size = width * height, chroma_width * chroma_height
+    return (frame[:luma_size].reshape(height, width),
+            frame[luma_size: luma_size + chroma_size].reshape(chroma_height, chroma_width),
+            frame[luma_size + chroma_size: luma_size + 2 * chroma_size].reshape(chroma_height, chroma_width))
+
+
+def remove_raw_frames(output_dir):
+    for file_name in (RAW_FRAMES_FILE_NAME, RAW_METADATA_FILE_NAME):
+        path = os.path.join(output_dir, file_name)
+        if os.path.exists(path):
+            os.remove(path)
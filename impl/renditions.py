@@ -0,0 +1,38 @@
+import copy
+from .sampling import create_sampler
+from .utils.yuv_resize import parse_resize, parse_crop
+
+_RENDITION_KEYS = ('output_dir', 'quality', 'resize', 'crop', 'interval', 'fps')
+
+
+class Rendition:
+    """an additional output of the same decoded frames, with its own output root, JPEG quality, resize, crop and sampler"""
+    def __init__(self, output_dir, quality, sampler, resize=None, crop=None):
+        assert 1 <= quality <= 100
+        self.output_dir = output_dir
+        self.quality = quality
+        self.sampler = sampler
+        self.resize = resize
+        self.crop = crop
+
+
+def parse_rendition(spec: str, default_quality, default_sampler):
+    """
+    'output_dir=/data/train,quality=80,resize=256,crop=224x224,interval=5', output_dir is required,
+    quality and sampling (interval or fps) default to the main output ones, resize and crop to none
+    """
+    options = {}
+    for item in spec.split(','):
+        key, separator, value = item.partition('=')
+        key = key.strip()
+        assert separator and key in _RENDITION_KEYS, f'invalid rendition option {item}, expected one of {_RENDITION_KEYS}'
+        options[key] = value.strip()
+    assert 'output_dir' in options, f'rendition {spec} has no output_dir'
+    if 'interval' in options or 'fps' in options:
+        sampler = create_sampler(int(options.get('interval', 1)), float(options['fps']) if 'fps' in options else None)
+    else:
+        # samplers are stateful, each output has its own
+        sampler = copy.deepcopy(default_sampler)
+    resize = parse_resize(options['resize']) if 'resize' in options else None
+    crop = parse_crop(options['crop']) if 'crop' in options else None
+    return Rendition(options['output_dir'], int(options.get('quality', default_quality)), sampler, resize, crop)
@@ -1,51 +1,147 @@
 from queue import Queue
 import threading
+import time
+from .metrics import new_latency_histogram, add_latency
+
+
+_blocked_time_lock = threading.Lock()
+
+
+def _set_max_size(task_queue, max_size):
+    with task_queue.mutex:
+        task_queue.maxsize = max_size
+        task_queue.not_full.notify_all()
+
+
+def _put(task_queue, task, stats):
+    if not task_queue.full():
+        task_queue.put(task)
+        return
+    blocked_begin = time.perf_counter()
+    task_queue.put(task)
+    # several producers may be blocked at once
+    with _blocked_time_lock:
+        stats.blocked_time += time.perf_counter() - blocked_begin
 
 
 class WorkerThread:
-    def __init__(self, handler_cls, handler_init_params=(), worker_id=None, max_queue=16):
+    def __init__(self, handler_cls, handler_init_params=(), worker_id=None, max_queue=16, shared_queue=None):
         self.handler_cls = handler_cls
         self.handler_init_params = handler_init_params
         self.worker_id = worker_id
         self.max_queue = max_queue
+        self.shared_queue = shared_queue
+        self.error = None
+        self.reset_stats()
 
     def start(self):
-        self.task_queue = Queue(self.max_queue)
+        if self.shared_queue is not None:
+            self.task_queue = self.shared_queue
+        else:
+            self.task_queue = Queue(self.max_queue)
         self.thread = threading.Thread(target=self._worker_entry)
         self.thread.start()
 
     def stop(self):
+        self._signal_stop()
+        self._wait_stop()
+
+    def _signal_stop(self):
         if not hasattr(self, 'thread'):
             return
         self.task_queue.put(None)
+
+    def _wait_stop(self):
+        if not hasattr(self, 'thread'):
+            return
         self.thread.join()
         del self.thread
         del self.task_queue
 
     def put(self, *args, **kwargs):
-        self.task_queue.put((args, kwargs))
+        _put(self.task_queue, (args, kwargs), self)
+
+    def set_max_queue(self, max_queue):
+        self.max_queue = max_queue
+        if self.shared_queue is None and hasattr(self, 'task_queue'):
+            _set_max_size(self.task_queue, max_queue)
+
+    def get_queued(self):
+        # waiting tasks
+        return self.task_queue.qsize()
+
+    def get_load(self):
+        # queued + running tasks
+        return self.task_queue.unfinished_tasks
 
     def join(self):
         self.task_queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def reset_stats(self):
+        self.num_tasks = 0
+        self.num_bytes = 0
+        self.busy_time = 0.
+        self.idle_time = 0.
+        # time the producers waited on a full queue
+        self.blocked_time = 0.
+        # of the task times, see impl/metrics.py
+        self.latency = new_latency_histogram()
+
+    def get_stats(self):
+        return {'tasks': self.num_tasks, 'bytes': self.num_bytes, 'busy_time': self.busy_time, 'idle_time': self.idle_time, 'blocked_time': self.blocked_time,
+                'latency': list(self.latency)}
 
     def _worker_entry(self):
         handler = self.handler_cls(*self.handler_init_params)
         handler.set_worker_id(self.worker_id)
         with handler:
             while True:
+                idle_begin = time.perf_counter()
                 job = self.task_queue.get()
+                busy_begin = time.perf_counter()
+                self.idle_time += busy_begin - idle_begin
                 if job is None:
                     self.task_queue.task_done()
                     break
                 args, kwargs = job
-                handler(*args, **kwargs)
-                self.task_queue.task_done()
+                try:
+                    num_bytes = handler(*args, **kwargs)
+                    if num_bytes is not None:
+                        self.num_bytes += num_bytes
+                except Exception as e:
+                    # keep the thread alive, the error is raised on the next join()
+                    if self.error is None:
+                        self.error = e
+                finally:
+                    self.task_queue.task_done()
+                    busy_time = time.perf_counter() - busy_begin
+                    self.busy_time += busy_time
+                    add_latency(self.latency, busy_time)
+                    self.num_tasks += 1
 
 
 class RoundRobinWorkerThreads:
-    def __init__(self, num_threads, handler_cls, handler_init_params=(), max_queue=16):
+    """
+    dispatch:
+        'round_robin': each thread has its own queue, tasks are put to the threads in turn
+        'least_loaded': each thread has its own queue, tasks are put to the thread with the fewest unfinished tasks
+        'shared': all threads take tasks from one queue
+    """
+    def __init__(self, num_threads, handler_cls, handler_init_params=(), max_queue=16, dispatch='round_robin'):
+        assert dispatch in ('round_robin', 'least_loaded', 'shared')
         self.num_threads = num_threads
-        self.threads = [WorkerThread(handler_cls, handler_init_params, i, max_queue) for i in range(num_threads)]
+        self.handler_cls = handler_cls
+        self.handler_init_params = handler_init_params
+        self.max_queue = max_queue
+        self.dispatch = dispatch
+        if dispatch == 'shared':
+            self.shared_queue = Queue(max_queue * num_threads)
+        else:
+            self.shared_queue = None
+        self.threads = [WorkerThread(handler_cls, handler_init_params, i, max_queue, self.shared_queue) for i in range(num_threads)]
         self.index = 0
 
     def __enter__(self):
@@ -59,17 +155,131 @@ class RoundRobinWorkerThreads:
         for thread in self.threads:
             thread.start()
 
+    def set_num_threads(self, num_threads):
+        """threads are added at any time, removing threads requires no task in flight (after join())"""
+        assert num_threads > 0
+        if num_threads > self.num_threads:
+            new_threads = [WorkerThread(self.handler_cls, self.handler_init_params, i, self.max_queue, self.shared_queue) for i in range(self.num_threads, num_threads)]
+            for thread in new_threads:
+                thread.start()
+            # producers on other threads see either list
+            self.threads = self.threads + new_threads
+        elif num_threads < self.num_threads:
+            # with a shared queue any thread may take a stop signal, all are restarted
+            self._stop()
+            self.threads = self.threads[:num_threads]
+            self._start()
+        self.num_threads = num_threads
+        self.index %= num_threads
+        if self.shared_queue is not None:
+            _set_max_size(self.shared_queue, self.max_queue * num_threads)
+
+    def set_max_queue(self, max_queue):
+        assert max_queue > 0
+        self.max_queue = max_queue
+        if self.shared_queue is not None:
+            _set_max_size(self.shared_queue, max_queue * self.num_threads)
+        for thread in self.threads:
+            thread.set_max_queue(max_queue)
+
+    def get_num_queued(self):
+        """number of tasks waiting in the queues"""
+        if self.shared_queue is not None:
+            return self.shared_queue.qsize()
+        return sum(thread.get_queued() for thread in self.threads)
+
     def put(self, *args, **kwargs):
-        self.threads[self.index].put(*args, **kwargs)
-        self.index = (self.index + 1) % self.num_threads
+        if self.dispatch == 'shared':
+            # blocked time is accounted to the first thread
+            _put(self.shared_queue, (args, kwargs), self.threads[0])
+            return
+        if self.dispatch == 'least_loaded':
+            index = self.index
+            min_load = None
+            for i in range(self.num_threads):
+                candidate = (self.index + i) % self.num_threads
+                load = self.threads[candidate].get_load()
+                if min_load is None or load < min_load:
+                    index, min_load = candidate, load
+        else:
+            index = self.index
+        self.threads[index].put(*args, **kwargs)
+        self.index = (index + 1) % self.num_threads
 
     def join(self):
+        error = None
         for thread in self.threads:
-            thread.join()
+            try:
+                thread.join()
+            except Exception as e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+
+    def reset_stats(self):
+        for thread in self.threads:
+            thread.reset_stats()
+
+    def get_stats(self):
+        return [thread.get_stats() for thread in self.threads]
 
     def _stop(self):
+        # signal all first, with a shared queue any thread may take any stop signal
         for thread in self.threads:
-            thread.stop()
+            thread._signal_stop()
+        for thread in self.threads:
+            thread._wait_stop()
+
+
+class TaskGroup:
+    """
+    The tasks of one producer on worker threads shared with other producers, e.g. a decode session:
+    the handlers report to it the completion, errors and stats of its tasks, join() waits for its own tasks only.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.num_pending = 0
+        self.error = None
+        self.reset_stats()
+
+    def add(self):
+        with self.condition:
+            self.num_pending += 1
+
+    def done(self, error=None):
+        with self.condition:
+            self.num_pending -= 1
+            if error is not None and self.error is None:
+                self.error = error
+            if self.num_pending == 0:
+                self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.num_pending == 0)
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def add_stats(self, stage, busy_time=0., num_bytes=0, blocked_time=0., tasks=1):
+        with self.condition:
+            stats = self.stats.setdefault(stage, {'tasks': 0, 'bytes': 0, 'busy_time': 0., 'idle_time': 0., 'blocked_time': 0., 'latency': new_latency_histogram()})
+            stats['tasks'] += tasks
+            stats['bytes'] += num_bytes
+            stats['busy_time'] += busy_time
+            stats['blocked_time'] += blocked_time
+            if tasks == 1:
+                add_latency(stats['latency'], busy_time)
+
+    def reset_stats(self):
+        with self.condition:
+            self.stats = {}
+
+    def get_stats(self, stage):
+        """same format as RoundRobinWorkerThreads.get_stats(), the tasks of the group only"""
+        with self.condition:
+            return [{**self.stats[stage], 'latency': list(self.stats[stage]['latency'])}] if stage in self.stats else []
 
 
 class BaseWorkerThreadHandler:
@@ -83,4 +293,5 @@ class BaseWorkerThreadHandler:
         self.worker_id = id
 
     def __call__(self, *args, **kwargs):
+        """returns the number of bytes processed, or None"""
         pass
@@ -0,0 +1,197 @@
+import math
+
+_EPSILON = 1e-6
+
+
+class FrameSampler:
+    """
+    Decides which decoded frames are kept, before they are converted and downloaded.
+    index starts from 1, pts is in seconds or None if unknown.
+    """
+    keyframes_only = False
+
+    def reset(self):
+        pass
+
+    def accept(self, index, pts):
+        return True
+
+    def next_wanted_time(self, frame_rate=None):
+        """the earliest pts still wanted, the decoder may seek to it, None if unknown, frame_rate: of the stream, locates the frames wanted by index"""
+        return None
+
+    def estimate_count(self, num_frames, frame_rate):
+        """expected number of accepted frames of a video of num_frames frames, None if unknown"""
+        return num_frames
+
+    def is_done(self):
+        return False
+
+
+class IntervalSampler(FrameSampler):
+    def __init__(self, interval):
+        assert interval > 0
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.last_index = 0
+
+    def accept(self, index, pts):
+        self.last_index = index
+        return (index - 1) % self.interval == 0
+
+    def next_wanted_time(self, frame_rate=None):
+        if frame_rate is None or self.interval == 1:
+            return None
+        # the first index after the last one seen with (index - 1) % interval == 0
+        next_index = (self.last_index + self.interval - 1) // self.interval * self.interval + 1
+        return (next_index - 1) / frame_rate
+
+    def estimate_count(self, num_frames, frame_rate):
+        if num_frames is None:
+            return None
+        return (num_frames + self.interval - 1) // self.interval
+
+
+class FpsSampler(FrameSampler):
+    def __init__(self, fps):
+        assert fps > 0
+        self.fps = fps
+        self.reset()
+
+    def reset(self):
+        self.next_time = 0.
+
+    def accept(self, index, pts):
+        if pts is None or pts < self.next_time - _EPSILON:
+            return False
+        self.next_time = (math.floor(pts * self.fps + _EPSILON) + 1) / self.fps
+        return True
+
+    def next_wanted_time(self, frame_rate=None):
+        return self.next_time
+
+    def estimate_count(self, num_frames, frame_rate):
+        if num_frames is None or frame_rate is None:
+            return None
+        return min(num_frames, math.ceil(num_frames / frame_rate * self.fps) + 1)
+
+
+class TimestampSampler(FrameSampler):
+    """keeps the first frame at or after each of the timestamps (in seconds)"""
+    def __init__(self, timestamps):
+        self.timestamps = sorted(timestamps)
+        self.reset()
+
+    def reset(self):
+        self.position = 0
+
+    def accept(self, index, pts):
+        if pts is None or self.is_done() or pts < self.timestamps[self.position] - _EPSILON:
+            return False
+        while not self.is_done() and self.timestamps[self.position] <= pts + _EPSILON:
+            self.position += 1
+        return True
+
+    def next_wanted_time(self, frame_rate=None):
+        if self.is_done():
+            return None
+        return self.timestamps[self.position]
+
+    def estimate_count(self, num_frames, frame_rate):
+        return len(self.timestamps)
+
+    def is_done(self):
+        return self.position >= len(self.timestamps)
+
+
+class KeyframeSampler(FrameSampler):
+    keyframes_only = True
+
+    def estimate_count(self, num_frames, frame_rate):
+        return None
+
+
+class SkipFramesSampler(FrameSampler):
+    """wraps a sampler, rejects the frames whose key (see get_frame_key) is in skip_frames"""
+    def __init__(self, sampler, skip_frames, output_name):
+        self.sampler = sampler
+        self.skip_frames = skip_frames
+        self.output_name = output_name
+        self.keyframes_only = sampler.keyframes_only
+
+    def reset(self):
+        self.sampler.reset()
+
+    def accept(self, index, pts):
+        return self.sampler.accept(index, pts) and get_frame_key(index, pts, self.output_name) not in self.skip_frames
+
+    def next_wanted_time(self, frame_rate=None):
+        return self.sampler.next_wanted_time(frame_rate)
+
+    def estimate_count(self, num_frames, frame_rate):
+        return self.sampler.estimate_count(num_frames, frame_rate)
+
+    def is_done(self):
+        return self.sampler.is_done()
+
+
+class UnionSampler(FrameSampler):
+    """accepts the frames accepted by any of samplers, accepted[i] tells if samplers[i] accepted the last frame"""
+    def __init__(self, samplers):
+        assert len(samplers) > 0
+        self.samplers = tuple(samplers)
+        # a keyframe sampler accepts every frame it is given
+        assert len(set(sampler.keyframes_only for sampler in self.samplers)) == 1, 'keyframe sampling cannot be combined with other samplings'
+        self.keyframes_only = self.samplers[0].keyframes_only
+        self.accepted = [False] * len(self.samplers)
+
+    def reset(self):
+        for sampler in self.samplers:
+            sampler.reset()
+
+    def accept(self, index, pts):
+        # every sampler sees every frame, they are stateful
+        self.accepted = [sampler.accept(index, pts) for sampler in self.samplers]
+        return any(self.accepted)
+
+    def next_wanted_time(self, frame_rate=None):
+        wanted_times = [sampler.next_wanted_time(frame_rate) for sampler in self.samplers if not sampler.is_done()]
+        if len(wanted_times) == 0 or None in wanted_times:
+            return None
+        return min(wanted_times)
+
+    def estimate_count(self, num_frames, frame_rate):
+        counts = [sampler.estimate_count(num_frames, frame_rate) for sampler in self.samplers]
+        if None in counts:
+            return None
+        return min(sum(counts), num_frames) if num_frames is not None else sum(counts)
+
+    def is_done(self):
+        return all(sampler.is_done() for sampler in self.samplers)
+
+
+def create_sampler(interval=1, fps=None, timestamps=None, keyframes_only=False):
+    assert sum((interval != 1, fps is not None, timestamps is not None, keyframes_only)) <= 1, 'only one sampling method can be used'
+    if fps is not None:
+        return FpsSampler(fps)
+    if timestamps is not None:
+        return TimestampSampler(timestamps)
+    if keyframes_only:
+        return KeyframeSampler()
+    return IntervalSampler(interval)
+
+
+def get_frame_key(index, pts, output_name='index'):
+    """'index': frame index, 'timestamp': pts in milliseconds"""
+    if output_name == 'timestamp' and pts is not None:
+        return int(round(pts * 1000))
+    return index
+
+
+def get_frame_file_name(index, pts, output_name='index', extension='.jpg'):
+    key = get_frame_key(index, pts, output_name)
+    if output_name == 'timestamp' and pts is not None:
+        return f'{key:09d}{extension}'
+    return f'{key:06d}{extension}'
@@ -0,0 +1,195 @@
+import bisect
+import os
+import threading
+import time
+from queue import Queue
+
+
+def get_file_size_cost(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class Scheduler:
+    """
+    hands the longest pending job to whichever worker frees up first, workers[i] is the device of worker i,
+    more jobs can be streamed in with add_input_job() between open_input() and close_input()
+    """
+    def __init__(self, jobs, costs, workers, device_weights=None, clock=time.monotonic):
+        self.workers = tuple(workers)
+        if device_weights is None:
+            device_weights = {}
+        self.weights = tuple(device_weights.get(device, 1.) for device in self.workers)
+        assert all(weight > 0 for weight in self.weights)
+        self.clock = clock
+
+        # ascending by cost, ties are resolved in input order; jobs are popped from the end
+        pending = sorted(((cost, -index, job) for index, (job, cost) in enumerate(zip(jobs, costs))), key=lambda x: x[:2])
+        self._costs = [cost for cost, _, _ in pending]
+        self._jobs = [job for _, _, job in pending]
+        # jobs queued ahead of the pending ones, (job, cost, allowed devices or None)
+        self._retries = []
+        # (start time, cost) of the job each worker is running
+        self._running = [None] * len(self.workers)
+        self._num_running = 0
+        self._done_cost = 0.
+        self._done_weighted_time = 0.
+        # jobs may still come from add_input_job()
+        self._is_input_open = False
+        self._is_cancelled = False
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cancel()
+
+    def __len__(self):
+        return len(self._jobs) + len(self._retries)
+
+    def _rate(self):
+        if self._done_cost == 0 or self._done_weighted_time == 0:
+            return None
+        return self._done_cost / self._done_weighted_time
+
+    def add_job(self, job, cost=0, devices=None):
+        with self._condition:
+            self._retries.append((job, cost, devices))
+            self._condition.notify_all()
+
+    def open_input(self):
+        with self._condition:
+            self._is_input_open = True
+
+    def add_input_job(self, job, cost=0, max_pending=None):
+        """
+        adds a job after the pending jobs of the same cost, blocks while max_pending jobs are pending,
+        returns False if the scheduler was cancelled
+        """
+        with self._condition:
+            while max_pending is not None and len(self._jobs) >= max_pending and not self._is_cancelled:
+                self._condition.wait()
+            if self._is_cancelled:
+                return False
+            # jobs are popped from the end, the first added of the same cost first
+            index = bisect.bisect_left(self._costs, cost)
+            self._costs.insert(index, cost)
+            self._jobs.insert(index, job)
+            self._condition.notify_all()
+            return True
+
+    def close_input(self):
+        with self._condition:
+            self._is_input_open = False
+            self._condition.notify_all()
+
+    def cancel(self):
+        with self._condition:
+            self._is_cancelled = True
+            self._is_input_open = False
+            self._costs.clear()
+            self._jobs.clear()
+            self._retries.clear()
+            self._condition.notify_all()
+
+    def _max_cost_for(self, worker_index, now):
+        # a slower device skips the jobs a faster busy device is expected to finish earlier
+        rate = self._rate()
+        if rate is None:
+            return None
+        weight = self.weights[worker_index]
+        max_cost = None
+        for other_index, running in enumerate(self._running):
+            other_weight = self.weights[other_index]
+            if running is None or other_weight <= weight:
+                continue
+            start_time, cost = running
+            remaining = max(0., start_time + cost / (rate * other_weight) - now)
+            # cost / (rate * weight) <= remaining + cost / (rate * other_weight)
+            threshold = remaining * rate / (1. / weight - 1. / other_weight)
+            if max_cost is None or threshold < max_cost:
+                max_cost = threshold
+        return max_cost
+
+    def _start(self, worker_index, job, cost, now):
+        self._running[worker_index] = (now, cost)
+        self._num_running += 1
+        return job
+
+    def next_job(self, worker_index):
+        # blocks while other workers are running, they may still add jobs for this device
+        device = self.workers[worker_index]
+        with self._condition:
+            while True:
+                now = self.clock()
+                for index, (job, cost, devices) in enumerate(self._retries):
+                    if devices is None or device in devices:
+                        del self._retries[index]
+                        return self._start(worker_index, job, cost, now)
+                if len(self._jobs) > 0:
+                    max_cost = self._max_cost_for(worker_index, now)
+                    if max_cost is None:
+                        index = len(self._jobs) - 1
+                    else:
+                        index = bisect.bisect_right(self._costs, max_cost) - 1
+                        if index < 0:
+                            index = 0
+                    job, cost = self._jobs.pop(index), self._costs.pop(index)
+                    # room for add_input_job()
+                    self._condition.notify_all()
+                    return self._start(worker_index, job, cost, now)
+                if self._num_running == 0 and not self._is_input_open:
+                    return None
+                self._condition.wait()
+
+    def job_done(self, worker_index):
+        with self._condition:
+            start_time, cost = self._running[worker_index]
+            self._running[worker_index] = None
+            self._num_running -= 1
+            elapsed = self.clock() - start_time
+            if cost > 0 and elapsed > 0:
+                self._done_cost += cost
+                self._done_weighted_time += elapsed * self.weights[worker_index]
+            self._condition.notify_all()
+
+
+def run_scheduled(scheduler, func):
+    """runs func(job, device) on one thread per worker, yields the results in completion order"""
+    results = Queue()
+
+    def _worker(worker_index):
+        device = scheduler.workers[worker_index]
+        while True:
+            job = scheduler.next_job(worker_index)
+            if job is None:
+                break
+            try:
+                results.put((func(job, device), None))
+            except Exception as e:
+                results.put((None, e))
+            finally:
+                scheduler.job_done(worker_index)
+        results.put(None)
+
+    threads = [threading.Thread(target=_worker, args=(index,)) for index in range(len(scheduler.workers))]
+    for thread in threads:
+        thread.start()
+    try:
+        num_running = len(threads)
+        while num_running > 0:
+            result = results.get()
+            if result is None:
+                num_running -= 1
+                continue
+            result, error = result
+            if error is not None:
+                raise error
+            yield result
+    finally:
+        scheduler.cancel()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,182 @@
+import os
+import glob
+import tarfile
+import threading
+import time
+from ctypes import c_ubyte
+
+_TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+# the shards of the last complete run in a directory, one name per line
+SHARD_LIST_FILE_NAME = 'shards.txt'
+
+
+def _shard_name(shard_index):
+    return f'shard_{shard_index:05d}.tar'
+
+
+class ShardWriter:
+    """
+    Appends files into tar-compatible shards under output_dir, shard_00000.tar, shard_00001.tar, ...
+    Each shard has a sidecar index shard_xxxxx.tar.idx, one 'name<TAB>offset<TAB>length' line per file,
+    offset and length locate the file content inside the shard.
+    close() lists the shards of the run in SHARD_LIST_FILE_NAME, a reader ignores the other shards of the directory.
+    """
+    def __init__(self, output_dir, max_shard_size=None, batch_size=4 * 1024 * 1024):
+        self.output_dir = output_dir
+        self.max_shard_size = max_shard_size
+        self.batch_size = batch_size
+        self.shard_index = -1
+        self.shard_fd = None
+        self.index_file = None
+        self.lock = threading.Lock()
+
+    def _open_next_shard(self):
+        self._close_shard()
+        if self.shard_index < 0:
+            # the list of a previous run no longer matches the shards
+            list_path = os.path.join(self.output_dir, SHARD_LIST_FILE_NAME)
+            if os.path.exists(list_path):
+                os.remove(list_path)
+        self.shard_index += 1
+        shard_path = os.path.join(self.output_dir, _shard_name(self.shard_index))
+        self.shard_fd = os.open(shard_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+        self.index_file = open(shard_path + '.idx', 'w', encoding='utf-8')
+        self.shard_size = 0
+        self.batch = bytearray()
+        self.batch_index = []
+
+    def _flush_batch(self):
+        written = 0
+        with memoryview(self.batch) as view:
+            while written < len(view):
+                written += os.write(self.shard_fd, view[written:])
+        self.batch.clear()
+        # the index only refers to the data already written
+        for name, offset, length in self.batch_index:
+            self.index_file.write(f'{name}\t{offset}\t{length}\n')
+        self.index_file.flush()
+        self.batch_index.clear()
+
+    def _close_shard(self):
+        if self.shard_fd is None:
+            return
+        self.batch += bytes(_TAR_BLOCK_SIZE * 2)
+        self._flush_batch()
+        os.close(self.shard_fd)
+        self.index_file.close()
+        self.shard_fd = None
+        self.index_file = None
+
+    def write(self, ptr, size, name):
+        tar_info = tarfile.TarInfo(name)
+        tar_info.size = size
+        tar_info.mtime = int(time.time())
+        tar_info.mode = 0o644
+        header = tar_info.tobuf(tarfile.USTAR_FORMAT, 'utf-8', 'surrogateescape')
+        padding = -size % _TAR_BLOCK_SIZE
+        member_size = len(header) + size + padding
+
+        with self.lock:
+            if self.shard_fd is None or (self.max_shard_size is not None and self.shard_size > 0 and self.shard_size + member_size > self.max_shard_size):
+                self._open_next_shard()
+            offset = self.shard_size + len(header)
+            self.batch += header
+            self.batch += (c_ubyte * size).from_address(ptr.value)
+            self.batch += bytes(padding)
+            self.batch_index.append((name, offset, size))
+            self.shard_size += member_size
+            if len(self.batch) >= self.batch_size:
+                self._flush_batch()
+
+    def close(self):
+        with self.lock:
+            self._close_shard()
+            if self.shard_index < 0:
+                return
+            list_path = os.path.join(self.output_dir, SHARD_LIST_FILE_NAME)
+            with open(list_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.writelines(_shard_name(shard_index) + '\n' for shard_index in range(self.shard_index + 1))
+            os.replace(list_path + '.tmp', list_path)
+
+
+class ShardedOutputWriter:
+    """writer for the io threads, files under the same directory go into the shards of that directory"""
+    def __init__(self, max_shard_size=None):
+        self.max_shard_size = max_shard_size
+        self.shard_writers = {}
+        self.lock = threading.Lock()
+
+    def write(self, ptr, size, path):
+        output_dir, name = os.path.split(path)
+        with self.lock:
+            shard_writer = self.shard_writers.get(output_dir)
+            if shard_writer is None:
+                shard_writer = ShardWriter(output_dir, self.max_shard_size)
+                self.shard_writers[output_dir] = shard_writer
+        shard_writer.write(ptr, size, name)
+
+    def flush(self, output_dirs=None):
+        """closes the shards of output_dirs, or of every directory"""
+        with self.lock:
+            if output_dirs is None:
+                output_dirs = tuple(self.shard_writers)
+            shard_writers = tuple(self.shard_writers.pop(output_dir) for output_dir in output_dirs if output_dir in self.shard_writers)
+        for shard_writer in shard_writers:
+            shard_writer.close()
+
+
+class ShardReader:
+    """random access to the files stored by ShardWriter in output_dir, the shards listed in SHARD_LIST_FILE_NAME, or all of them without a list"""
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.index = {}
+        self.shard_fds = {}
+        list_path = os.path.join(output_dir, SHARD_LIST_FILE_NAME)
+        if os.path.exists(list_path):
+            with open(list_path, 'r', encoding='utf-8') as f:
+                shard_paths = [os.path.join(output_dir, line.strip()) for line in f if line.strip()]
+        else:
+            shard_paths = sorted(index_path[: -len('.idx')] for index_path in glob.glob(os.path.join(glob.escape(output_dir), 'shard_*.tar.idx')))
+        for shard_path in shard_paths:
+            with open(shard_path + '.idx', 'r', encoding='utf-8') as f:
+                for line in f:
+                    name, offset, length = line.rstrip('\n').split('\t')
+                    self.index[name] = (shard_path, int(offset), int(length))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def read(self, name):
+        shard_path, offset, length = self.index[name]
+        fd = self.shard_fds.get(shard_path)
+        if fd is None:
+            fd = os.open(shard_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            self.shard_fds[shard_path] = fd
+        if hasattr(os, 'pread'):
+            data = os.pread(fd, length, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            data = os.read(fd, length)
+        if len(data) != length:
+            raise IOError(f'{shard_path} is truncated')
+        return data
+
+    def read_frame(self, frame_index, extension='.jpg'):
+        return self.read(f'{frame_index:06d}{extension}')
+
+    def close(self):
+        for fd in self.shard_fds.values():
+            os.close(fd)
+        self.shard_fds.clear()
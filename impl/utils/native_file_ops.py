@@ -1,4 +1,5 @@
 import os
+import threading
 from ctypes import *
 
 if os.name == 'nt':
@@ -8,12 +9,18 @@ if os.name == 'nt':
     fopen.argtypes = c_wchar_p, c_wchar_p
     fopen.restype = c_void_p
 else:
-    libc = CDLL("libc.so.6")
+    libc = CDLL("libc.so.6", use_errno=True)
 
     fopen = libc.fopen
     fopen.argtypes = c_char_p, c_char_p
     fopen.restype = c_void_p
 
+# Linux only
+sync_file_range = getattr(libc, 'sync_file_range', None)
+if sync_file_range is not None:
+    sync_file_range.argtypes = c_int, c_int64, c_int64, c_uint
+    sync_file_range.restype = c_int
+
 fwrite = libc.fwrite
 fwrite.argtypes = c_void_p, c_size_t, c_size_t, c_void_p
 fwrite.restype = c_size_t
@@ -46,3 +53,147 @@ def native_write(ptr: c_void_p, size: int, path: str):
             raise IOError(_get_native_error_str())
     finally:
         fclose(f)
+
+
+class NativeFileWriter:
+    def write(self, ptr: c_void_p, size: int, path: str):
+        native_write(ptr, size, path)
+
+    def flush(self, output_dirs=None):
+        pass
+
+
+# how DirectoryFileWriter bounds the dirty page cache
+SYNC_POLICIES = ('none', 'writeback', 'dontneed', 'fsync')
+
+_SYNC_FILE_RANGE_WAIT_BEFORE = 1
+_SYNC_FILE_RANGE_WRITE = 2
+_SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def _wait_writeback(fd):
+    if sync_file_range is None:
+        _fdatasync(fd)
+    elif sync_file_range(fd, 0, 0, _SYNC_FILE_RANGE_WAIT_BEFORE | _SYNC_FILE_RANGE_WRITE | _SYNC_FILE_RANGE_WAIT_AFTER) != 0:
+        errno = get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+class _OutputDirectory:
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        self.lock = threading.Lock()
+        # the open files of the batch filling up, and of the previous batch, being written back
+        self.pending = []
+        self.writing = []
+
+
+class DirectoryFileWriter:
+    """
+    Writer for the io threads, POSIX only: each output directory is opened once, its files are created relative to it (openat)
+    and written by os.write straight from the encoder buffer. sync_policy:
+        'none': the files are closed at once, the kernel writes them back when it sees fit
+        'writeback': every batch_size files of a directory, their writeback is started (sync_file_range) and the previous batch is waited for,
+                     the dirty pages stay under 2 batches per directory instead of piling up until the kernel stalls the writers
+        'dontneed': 'writeback', then the written pages are dropped from the page cache (posix_fadvise DONTNEED)
+        'fsync': 'writeback' with fdatasync, and flush() syncs the directories, the frames of a finished video survive a crash
+    The files of a batch stay open until they are synced, flush() completes the batches of its directories and closes them.
+    The batches are sync batches only: every frame still takes its own openat, write and close. A frame is a single buffer,
+    writev would not save a syscall, and creating or writing several files per syscall needs io_uring, not worth a native
+    dependency while the writes go to the page cache.
+    """
+    def __init__(self, sync_policy='none', batch_size=64):
+        assert sync_policy in SYNC_POLICIES
+        assert batch_size > 0
+        assert os.open in os.supports_dir_fd, 'openat is not supported on this platform'
+        assert sync_policy != 'dontneed' or hasattr(os, 'posix_fadvise')
+        self.sync_policy = sync_policy
+        self.batch_size = batch_size
+        self.directories = {}
+        self.lock = threading.Lock()
+
+    def _get_directory(self, output_dir):
+        with self.lock:
+            directory = self.directories.get(output_dir)
+            if directory is None:
+                directory = self.directories[output_dir] = _OutputDirectory(output_dir)
+            return directory
+
+    def write(self, ptr: c_void_p, size: int, path: str):
+        output_dir, name = os.path.split(path)
+        directory = self._get_directory(output_dir)
+        fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o666, dir_fd=directory.fd)
+        try:
+            written = 0
+            with memoryview((c_ubyte * size).from_address(ptr.value)) as view:
+                while written < size:
+                    written += os.write(fd, view[written:])
+        except BaseException:
+            os.close(fd)
+            raise
+        if self.sync_policy == 'none':
+            os.close(fd)
+            return
+        with directory.lock:
+            directory.pending.append(fd)
+            if len(directory.pending) < self.batch_size:
+                return
+            batch, directory.pending = directory.pending, []
+        self._start_writeback(batch)
+        with directory.lock:
+            previous, directory.writing = directory.writing, batch
+        self._complete(previous)
+
+    @staticmethod
+    def _start_writeback(fds):
+        if sync_file_range is None:
+            return
+        for fd in fds:
+            # asynchronous, an error is raised by the wait in _complete()
+            sync_file_range(fd, 0, 0, _SYNC_FILE_RANGE_WRITE)
+
+    def _complete(self, fds):
+        """waits for the files to be written back, or syncs them, and closes them"""
+        error = None
+        for fd in fds:
+            try:
+                if self.sync_policy == 'fsync':
+                    _fdatasync(fd)
+                else:
+                    _wait_writeback(fd)
+                if self.sync_policy == 'dontneed':
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError as e:
+                if error is None:
+                    error = e
+            finally:
+                os.close(fd)
+        if error is not None:
+            raise error
+
+    def flush(self, output_dirs=None):
+        """completes the files of output_dirs, or of every directory, and closes the directories"""
+        with self.lock:
+            if output_dirs is None:
+                output_dirs = tuple(self.directories)
+            directories = tuple(self.directories.pop(output_dir) for output_dir in output_dirs if output_dir in self.directories)
+        error = None
+        for directory in directories:
+            try:
+                self._start_writeback(directory.pending)
+                try:
+                    self._complete(directory.writing)
+                finally:
+                    self._complete(directory.pending)
+                if self.sync_policy == 'fsync':
+                    # the directory entries of the files
+                    os.fsync(directory.fd)
+            except OSError as e:
+                if error is None:
+                    error = e
+            finally:
+                os.close(directory.fd)
+        if error is not None:
+            raise error
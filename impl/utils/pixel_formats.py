@@ -0,0 +1,39 @@
+import numpy as np
+
+# 'yuv420': planar Y, U, V, 'nv12': Y plane then interleaved U and V (NVDEC output), 'gray': Y plane only
+PIXEL_FORMATS = ('yuv420', 'nv12', 'gray')
+
+
+def get_frame_size(width, height, pixel_format='yuv420'):
+    if pixel_format == 'gray':
+        return width * height
+    # nv12 chroma rows are 2 x (width + 1) // 2 bytes, same size as yuv420
+    return width * height + 2 * ((width + 1) // 2) * ((height + 1) // 2)
+
+
+def get_planes(data: np.ndarray, width, height, pixel_format='yuv420'):
+    """views of the planes of a frame: (Y, U, V), (Y, UV) with UV of shape (chroma height, chroma width, 2), or (Y,)"""
+    chroma_width, chroma_height = (width + 1) // 2, (height + 1) // 2
+    luma_size, chroma_size = width * height, chroma_width * chroma_height
+    luma = data[:luma_size].reshape(height, width)
+    if pixel_format == 'gray':
+        return luma,
+    if pixel_format == 'nv12':
+        return luma, data[luma_size: luma_size + 2 * chroma_size].reshape(chroma_height, chroma_width, 2)
+    return (luma,
+            data[luma_size: luma_size + chroma_size].reshape(chroma_height, chroma_width),
+            data[luma_size + chroma_size: luma_size + 2 * chroma_size].reshape(chroma_height, chroma_width))
+
+
+def deinterleave_nv12_chroma(data: np.ndarray, width, height, u: np.ndarray, v: np.ndarray):
+    """copies the interleaved chroma of an nv12 frame to the U and V planes, (chroma height, chroma width) or flat"""
+    _, uv = get_planes(data, width, height, 'nv12')
+    np.copyto(u.reshape(uv.shape[:2]), uv[:, :, 0])
+    np.copyto(v.reshape(uv.shape[:2]), uv[:, :, 1])
+
+
+def nv12_to_yuv420(data: np.ndarray, width, height, output: np.ndarray):
+    luma_size, chroma_size = width * height, ((width + 1) // 2) * ((height + 1) // 2)
+    output[:luma_size] = data[:luma_size]
+    deinterleave_nv12_chroma(data, width, height, output[luma_size: luma_size + chroma_size], output[luma_size + chroma_size: luma_size + 2 * chroma_size])
+    return output
@@ -1,5 +1,6 @@
 from ctypes import *
 from ctypes.util import find_library
+import threading
 import warnings
 import numpy as np
 
@@ -13,6 +14,8 @@ TJSAMP_411 = 5
 TJERR_WARNING = 0
 TJERR_FATAL = 1
 
+TJFLAG_NOREALLOC = 1024
+
 
 def _get_ndarray_address(array: np.ndarray):
     return cast(array.__array_interface__['data'][0], POINTER(c_ubyte))
@@ -39,6 +42,46 @@ class JPEGEncoded:
             self.jpeg_buf = None
 
 
+class JPEGBufferPool:
+    """bounded pool of preallocated jpeg output buffers, acquire() blocks while max_buffers are in use"""
+    def __init__(self, max_buffers):
+        assert max_buffers > 0
+        self.max_buffers = max_buffers
+        self.buffers = []
+        self.num_in_use = 0
+        self.hits = 0
+        self.misses = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            while self.num_in_use >= self.max_buffers:
+                self.condition.wait()
+            self.num_in_use += 1
+            while len(self.buffers) > 0:
+                buffer = self.buffers.pop()
+                if len(buffer) >= size:
+                    self.hits += 1
+                    return buffer
+                # allocated for a smaller resolution, dropped
+            self.misses += 1
+        return np.empty(size, dtype=np.uint8)
+
+    def release(self, buffer):
+        with self.condition:
+            self.buffers.append(buffer)
+            self.num_in_use -= 1
+            self.condition.notify()
+
+    def set_max_buffers(self, max_buffers):
+        assert max_buffers > 0
+        with self.condition:
+            self.max_buffers = max_buffers
+            # idle buffers beyond the new limit are dropped
+            del self.buffers[max_buffers:]
+            self.condition.notify_all()
+
+
 class YUVJpegEncoder:
     def __init__(self, turbojpeg_dll_path=None):
         if turbojpeg_dll_path is None:
@@ -59,10 +102,20 @@ class YUVJpegEncoder:
             POINTER(c_void_p), POINTER(c_ulong), c_int, c_int)
         _tj_compressFromYUV.restype = c_int
 
+        _tj_compressFromYUVPlanes = turbojpeg_dll.tjCompressFromYUVPlanes
+        _tj_compressFromYUVPlanes.argtypes = (
+            c_void_p, POINTER(POINTER(c_ubyte)), c_int, POINTER(c_int), c_int, c_int,
+            POINTER(c_void_p), POINTER(c_ulong), c_int, c_int)
+        _tj_compressFromYUVPlanes.restype = c_int
+
         _tj_free = turbojpeg_dll.tjFree
         _tj_free.argtypes = c_void_p,
         _tj_free.restype = None
 
+        _tj_buf_size = turbojpeg_dll.tjBufSize
+        _tj_buf_size.argtypes = c_int, c_int, c_int
+        _tj_buf_size.restype = c_ulong
+
         _tj_get_error_code = turbojpeg_dll.tjGetErrorCode
         _tj_get_error_code.argtypes = c_void_p,
         _tj_get_error_code.restype = c_int
@@ -74,25 +127,47 @@ class YUVJpegEncoder:
         self._tj_init_compress = _tj_init_compress
         self._tj_destroy = _tj_destroy
         self._tj_compressFromYUV = _tj_compressFromYUV
+        self._tj_compressFromYUVPlanes = _tj_compressFromYUVPlanes
         self._tj_free = _tj_free
+        self._tj_buf_size = _tj_buf_size
         self._tj_get_error_code = _tj_get_error_code
         self._tj_get_error_str = _tj_get_error_str
 
         self.handle = _tj_init_compress()
 
-    def compress(self, data: np.ndarray, width: int, height: int, subsample=TJSAMP_420, quality=85, flags=0):
-        yuv_data_ptr = _get_ndarray_address(data)
+    def _get_output_buffer(self, width, height, subsample, flags, buffer_pool):
+        if buffer_pool is not None:
+            buffer = buffer_pool.acquire(self._tj_buf_size(width, height, subsample))
+            return buffer, c_void_p(buffer.__array_interface__['data'][0]), c_ulong(len(buffer)), flags | TJFLAG_NOREALLOC
+        return None, c_void_p(), c_ulong(), flags
+
+    def _get_encoded(self, status, buffer, jpeg_buf, jpeg_size, buffer_pool):
+        if buffer_pool is not None:
+            encoded = JPEGEncoded(jpeg_buf, jpeg_size.value, lambda _: buffer_pool.release(buffer))
+        else:
+            encoded = JPEGEncoded(jpeg_buf, jpeg_size.value, self._tj_free)
+        assert status == 0, self._get_tj_error_str()
+        assert encoded.get_size() > 0
+        return encoded
 
-        jpeg_buf = c_void_p()
-        jpeg_size = c_ulong()
+    def compress(self, data: np.ndarray, width: int, height: int, subsample=TJSAMP_420, quality=85, flags=0, buffer_pool: JPEGBufferPool = None):
+        """data: planar YUV420, or the luma plane only with TJSAMP_GRAY"""
+        yuv_data_ptr = _get_ndarray_address(data)
+        buffer, jpeg_buf, jpeg_size, flags = self._get_output_buffer(width, height, subsample, flags, buffer_pool)
         status = self._tj_compressFromYUV(
             self.handle, yuv_data_ptr, width, 1, height, subsample, byref(jpeg_buf),
             byref(jpeg_size), quality, flags)
-
-        assert status == 0, self._get_tj_error_str()
-        jpeg_size = jpeg_size.value
-        assert jpeg_size > 0
-        return JPEGEncoded(jpeg_buf, jpeg_size, self._tj_free)
+        return self._get_encoded(status, buffer, jpeg_buf, jpeg_size, buffer_pool)
+
+    def compress_planes(self, planes, strides, width: int, height: int, subsample=TJSAMP_420, quality=85, flags=0, buffer_pool: JPEGBufferPool = None):
+        """planes: the Y, U and V planes (Y only with TJSAMP_GRAY), separate arrays with rows of strides bytes"""
+        plane_ptrs = (POINTER(c_ubyte) * len(planes))(*(_get_ndarray_address(plane) for plane in planes))
+        plane_strides = (c_int * len(strides))(*strides)
+        buffer, jpeg_buf, jpeg_size, flags = self._get_output_buffer(width, height, subsample, flags, buffer_pool)
+        status = self._tj_compressFromYUVPlanes(
+            self.handle, plane_ptrs, width, plane_strides, height, subsample, byref(jpeg_buf),
+            byref(jpeg_size), quality, flags)
+        return self._get_encoded(status, buffer, jpeg_buf, jpeg_size, buffer_pool)
 
     def __del__(self):
         self._tj_destroy(self.handle)
@@ -0,0 +1,144 @@
+import math
+import re
+import numpy as np
+from .pixel_formats import get_planes
+
+
+def _even(value):
+    return max(2, int(round(value / 2)) * 2)
+
+
+def parse_resize(spec: str):
+    """'256': short side, 'max:512': max side (no upscaling), '640x360': exact size"""
+    match = re.fullmatch(r'(\d+)x(\d+)', spec)
+    if match is not None:
+        return 'exact', int(match.group(1)), int(match.group(2))
+    if spec.startswith('max:'):
+        return 'max', int(spec[len('max:'):])
+    return 'short', int(spec)
+
+
+def parse_crop(spec: str):
+    """'224x224': center crop, '224x224+16+8': crop at x=16, y=8"""
+    match = re.fullmatch(r'(\d+)x(\d+)(?:\+(\d+)\+(\d+))?', spec)
+    assert match is not None, f'invalid crop {spec}'
+    width, height = int(match.group(1)), int(match.group(2))
+    if match.group(3) is None:
+        return width, height, None, None
+    return width, height, int(match.group(3)), int(match.group(4))
+
+
+def get_resize_geometry(width, height, resize=None, crop=None):
+    """returns (resized width, resized height, (crop x, crop y, crop width, crop height)), even numbers for YUV420"""
+    if resize is None:
+        resized_width, resized_height = width, height
+    elif resize[0] == 'exact':
+        resized_width, resized_height = _even(resize[1]), _even(resize[2])
+    else:
+        if resize[0] == 'short':
+            scale = resize[1] / min(width, height)
+        else:
+            scale = min(1., resize[1] / max(width, height))
+        resized_width, resized_height = _even(width * scale), _even(height * scale)
+    if crop is None:
+        return resized_width, resized_height, (0, 0, resized_width, resized_height)
+    crop_width, crop_height, crop_x, crop_y = crop
+    crop_width, crop_height = min(_even(crop_width), resized_width), min(_even(crop_height), resized_height)
+    if crop_x is None:
+        crop_x, crop_y = (resized_width - crop_width) // 2, (resized_height - crop_height) // 2
+    crop_x = min(crop_x // 2 * 2, resized_width - crop_width)
+    crop_y = min(crop_y // 2 * 2, resized_height - crop_height)
+    return resized_width, resized_height, (crop_x, crop_y, crop_width, crop_height)
+
+
+def _get_axis_table(plane_size, region_begin, region_size, output_size, factor):
+    # box filter of factor pixels, then linear interpolation between the box centers
+    integer_begin = int(math.floor(region_begin))
+    num_boxes = min((plane_size - integer_begin) // factor, int(math.ceil((region_begin + region_size - integer_begin) / factor)) + 1)
+    centers = region_begin + (np.arange(output_size, dtype=np.float32) + 0.5) * (region_size / output_size)
+    positions = np.clip((centers - integer_begin) / factor - 0.5, 0, num_boxes - 1)
+    lower = np.floor(positions).astype(np.intp)
+    upper = np.minimum(lower + 1, num_boxes - 1)
+    weights = (positions - lower).astype(np.float32)
+    return integer_begin, num_boxes, lower, upper, weights
+
+
+class _PlaneResampler:
+    def __init__(self, plane_width, plane_height, region, output_width, output_height):
+        x, y, width, height = region
+        self.output_width, self.output_height = output_width, output_height
+        self.copy_only = width == output_width and height == output_height and x == int(x) and y == int(y)
+        if self.copy_only:
+            self.x, self.y = int(x), int(y)
+            return
+        self.factor_x = max(1, int(width // output_width))
+        self.factor_y = max(1, int(height // output_height))
+        self.x, self.num_x, self.left, self.right, self.weight_x = _get_axis_table(plane_width, x, width, output_width, self.factor_x)
+        self.y, self.num_y, self.top, self.bottom, self.weight_y = _get_axis_table(plane_height, y, height, output_height, self.factor_y)
+        self.weight_x = self.weight_x[np.newaxis, :]
+        self.weight_y = self.weight_y[:, np.newaxis]
+
+    def __call__(self, plane, output):
+        if self.copy_only:
+            output[:] = plane[self.y: self.y + self.output_height, self.x: self.x + self.output_width]
+            return
+        fx, fy = self.factor_x, self.factor_y
+        region = plane[self.y: self.y + self.num_y * fy, self.x: self.x + self.num_x * fx]
+        if fx > 1 or fy > 1:
+            region = region.reshape(self.num_y, fy, self.num_x, fx).sum(axis=(1, 3), dtype=np.uint32).astype(np.float32)
+            region *= 1. / (fx * fy)
+        else:
+            region = region.astype(np.float32)
+        top, bottom = region[self.top], region[self.bottom]
+        rows = top + (bottom - top) * self.weight_y
+        left, right = rows[:, self.left], rows[:, self.right]
+        result = left + (right - left) * self.weight_x
+        np.rint(result, out=result)
+        output[:] = result
+
+
+class YUV420Resizer:
+    """
+    resamples the region (x, y, width, height) of a frame to output_width x output_height,
+    planar YUV420 or NV12 frames (see impl/utils/pixel_formats.py) to planar YUV420, gray frames to gray
+    """
+    def __init__(self, width, height, region, output_width, output_height, pixel_format='yuv420'):
+        x, y, region_width, region_height = region
+        self.width, self.height = width, height
+        self.pixel_format = pixel_format
+        self.output_format = 'gray' if pixel_format == 'gray' else 'yuv420'
+        self.output_width, self.output_height = output_width, output_height
+        chroma_width, chroma_height = (width + 1) // 2, (height + 1) // 2
+        output_chroma_width, output_chroma_height = (output_width + 1) // 2, (output_height + 1) // 2
+        self.planes = ((width, height), (chroma_width, chroma_height), (chroma_width, chroma_height))
+        self.output_planes = ((output_width, output_height), (output_chroma_width, output_chroma_height), (output_chroma_width, output_chroma_height))
+        self.luma = _PlaneResampler(width, height, region, output_width, output_height)
+        self.chroma = _PlaneResampler(chroma_width, chroma_height, (x / 2, y / 2, region_width / 2, region_height / 2), output_chroma_width, output_chroma_height)
+        if pixel_format == 'gray':
+            self.planes, self.output_planes = self.planes[:1], self.output_planes[:1]
+        self.output_size = sum(w * h for w, h in self.output_planes)
+
+    def _get_planes(self, data):
+        planes = get_planes(data, self.width, self.height, self.pixel_format)
+        if self.pixel_format == 'nv12':
+            luma, uv = planes
+            return luma, uv[:, :, 0], uv[:, :, 1]
+        return planes
+
+    def __call__(self, data: np.ndarray, output: np.ndarray):
+        output_offset = 0
+        for index, (plane, (output_w, output_h)) in enumerate(zip(self._get_planes(data), self.output_planes)):
+            resampler = self.luma if index == 0 else self.chroma
+            resampler(plane, output[output_offset: output_offset + output_w * output_h].reshape(output_h, output_w))
+            output_offset += output_w * output_h
+        return output
+
+
+def create_resizer(width, height, resized_width, resized_height, crop_region, pixel_format='yuv420'):
+    """resizer of a width x height frame to the crop_region of it resized to resized_width x resized_height, None if nothing to do"""
+    crop_x, crop_y, crop_width, crop_height = crop_region
+    if (resized_width, resized_height) == (width, height) and crop_region == (0, 0, width, height):
+        return None
+    scale_x, scale_y = width / resized_width, height / resized_height
+    region = (crop_x * scale_x, crop_y * scale_y, crop_width * scale_x, crop_height * scale_y)
+    return YUV420Resizer(width, height, region, crop_width, crop_height, pixel_format)
@@ -0,0 +1,28 @@
+import numpy as np
+
+# BT.601 limited range, in 1/256 units
+_Y_SCALE = 298
+_V_TO_R, _U_TO_G, _V_TO_G, _U_TO_B = 409, -100, -208, 516
+
+
+def yuv420_to_rgb(data: np.ndarray, width, height, output: np.ndarray):
+    """planar YUV420 frame to a height x width x 3 RGB array (BT.601 limited range, nearest chroma upsampling)"""
+    chroma_width, chroma_height = (width + 1) // 2, (height + 1) // 2
+    luma_size, chroma_size = width * height, chroma_width * chroma_height
+    y = data[:luma_size].reshape(height, width).astype(np.int32)
+    u = data[luma_size: luma_size + chroma_size].reshape(chroma_height, chroma_width).astype(np.int32) - 128
+    v = data[luma_size + chroma_size: luma_size + 2 * chroma_size].reshape(chroma_height, chroma_width).astype(np.int32) - 128
+    y -= 16
+    y *= _Y_SCALE
+    y += 128
+
+    def upsample(plane):
+        return np.repeat(np.repeat(plane, 2, axis=0), 2, axis=1)[:height, :width]
+
+    output = output.reshape(height, width, 3)
+    for channel, chroma in ((0, _V_TO_R * v), (1, _U_TO_G * u + _V_TO_G * v), (2, _U_TO_B * u)):
+        value = y + upsample(chroma)
+        value >>= 8
+        np.clip(value, 0, 255, out=value)
+        output[:, :, channel] = value
+    return output
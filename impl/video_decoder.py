@@ -0,0 +1,175 @@
+import os
+from .frame_pool import FrameBufferPool
+from .sampling import IntervalSampler, SkipFramesSampler, UnionSampler, get_frame_key, get_frame_file_name
+from .utils.yuv_resize import get_resize_geometry, create_resizer
+from .metrics import StageMetrics, Stopwatch
+from .utils.pixel_formats import get_frame_size
+
+
+def get_yuv420_frame_size(width, height):
+    return width * height + 2 * ((width + 1) // 2) * ((height + 1) // 2)
+
+
+class BaseVideoStream:
+    # a wanted frame further than this (in seconds) is reached by seeking to the keyframe before it
+    seek_threshold = 5.
+
+    def __init__(self, width, height, frame_rate=None, num_frames=None):
+        self.width = width
+        self.height = height
+        # probed, may be an estimate or None
+        self.num_frames = num_frames
+        # size of the frames yielded
+        self.output_width = width
+        self.output_height = height
+        # layout of the frames yielded, see impl/utils/pixel_formats.py
+        self.output_format = 'yuv420'
+        self.frame_rate = frame_rate
+        self.metrics = StageMetrics()
+        self._last_seek_time = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def set_output_size(self, width, height):
+        """resizes the frames in the decoder, returns False if not supported"""
+        return False
+
+    def set_output_format(self, pixel_format):
+        """yields 'nv12' or 'gray' frames instead of planar YUV420, returns False if not supported"""
+        return False
+
+    def frames(self, frame_buffers, sampler):
+        """yields (frame index, pts, output_width x output_height output_format buffer leased from frame_buffers.get()) for the frames accepted by sampler, frame index starts from 1"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _get_seek_time(self, sampler, pts):
+        if pts is None:
+            return None
+        wanted_time = sampler.next_wanted_time(self.frame_rate)
+        # a seek may land before pts, never seek twice to the same time
+        if wanted_time is None or wanted_time - pts <= self.seek_threshold or wanted_time == self._last_seek_time:
+            return None
+        self._last_seek_time = wanted_time
+        return wanted_time
+
+    def _get_index_from_pts(self, pts, count):
+        # frame index of the frames reached by seeking or keyframe-only decoding
+        if pts is None or self.frame_rate is None:
+            return count
+        return int(round(pts * self.frame_rate)) + 1
+
+
+def set_up_resizing(stream: BaseVideoStream, resize=None, crop=None):
+    """resizes in the stream if supported, returns the resizer of the rest (see impl/utils/yuv_resize.py) or None"""
+    return set_up_renditions_resizing(stream, ((resize, crop),))[0]
+
+
+def set_up_renditions_resizing(stream: BaseVideoStream, specs, pixel_format='yuv420'):
+    """returns the resizer of pixel_format frames or None of each (resize, crop) of specs, the stream resizes if every spec has the same resized size"""
+    geometries = [get_resize_geometry(stream.width, stream.height, resize, crop) for resize, crop in specs]
+    resized_sizes = set((resized_width, resized_height) for resized_width, resized_height, _ in geometries)
+    # resizing in the decoder saves the conversion and the download, the encoder threads crop or resize the rest
+    if len(resized_sizes) == 1 and resized_sizes != {(stream.width, stream.height)} and stream.set_output_size(*next(iter(resized_sizes))):
+        return [create_resizer(resized_width, resized_height, resized_width, resized_height, crop_region, pixel_format) for resized_width, resized_height, crop_region in geometries]
+    return [create_resizer(stream.width, stream.height, resized_width, resized_height, crop_region, pixel_format) for resized_width, resized_height, crop_region in geometries]
+
+
+class DecodeOutput:
+    """an output of BaseVideoDecoder.decode(), encoder: JpegEncoder or the same interface, see decode()"""
+    def __init__(self, destination_folder_path, encoder, sampler=None, skip_frames=None, resize=None, crop=None):
+        self.destination_folder_path = destination_folder_path
+        self.encoder = encoder
+        self.sampler = sampler if sampler is not None else IntervalSampler(1)
+        self.skip_frames = skip_frames
+        self.resize = resize
+        self.crop = crop
+
+    def get_sampler(self, output_name):
+        if self.skip_frames is not None and len(self.skip_frames) > 0:
+            return SkipFramesSampler(self.sampler, self.skip_frames, output_name)
+        return self.sampler
+
+
+class BaseVideoDecoder:
+    def open(self, source_file_path) -> BaseVideoStream:
+        raise NotImplementedError
+
+    def decode(self, source_file_path, destination_folder_path, encoder, frame_pool_memory, sampler=None, skip_frames=None, output_name='index', resize=None, crop=None, metrics=None, frame_filter=None, renditions=(), pixel_format='yuv420', frame_pool_overflow=0):
+        """
+        metrics: StageMetrics updated with the decoding stages, frame_filter: drops frames before encoding, see impl/frame_filter.py,
+        renditions: DecodeOutput of additional outputs, fed from the same decoded frames, each with its own encoder,
+        pixel_format: 'yuv420', 'nv12' (decoder frames encoded without the conversion to planar YUV420) or 'gray' (luma only),
+        frame_pool_overflow: frame buffers allocated over frame_pool_memory instead of blocking, see FrameBufferPool
+        """
+        outputs = [DecodeOutput(destination_folder_path, encoder, sampler, skip_frames, resize, crop), *renditions]
+        samplers = [output.get_sampler(output_name) for output in outputs]
+        sampler = samplers[0] if len(outputs) == 1 else UnionSampler(samplers)
+        sampler.reset()
+        if frame_filter is not None:
+            frame_filter.reset()
+
+        with self.open(source_file_path) as stream:
+            if metrics is not None:
+                stream.metrics = metrics
+            stream.metrics.expected_frames = stream.num_frames
+            if pixel_format != 'yuv420':
+                stream.set_output_format(pixel_format)
+            # the luma plane comes first in every format, a gray output reads it from any of them
+            frame_format = 'gray' if pixel_format == 'gray' else stream.output_format
+            output_format = 'gray' if pixel_format == 'gray' else 'yuv420'
+            resizers = set_up_renditions_resizing(stream, [(output.resize, output.crop) for output in outputs], frame_format)
+            width, height = stream.output_width, stream.output_height
+            for output, output_sampler, resizer in zip(outputs, samplers, resizers):
+                if resizer is not None:
+                    output.encoder.prepare(output.destination_folder_path, resizer.output_width, resizer.output_height, output_sampler.estimate_count(stream.num_frames, stream.frame_rate), output_format)
+                else:
+                    output.encoder.prepare(output.destination_folder_path, width, height, output_sampler.estimate_count(stream.num_frames, stream.frame_rate), output_format)
+            frame_pool = FrameBufferPool(get_frame_size(width, height, stream.output_format), frame_pool_memory, max_overflow=frame_pool_overflow)
+            targets = list(zip(outputs, resizers))
+            # the kept and dropped frames of each output, the renditions are filtered too
+            kept_keys = [[] for _ in outputs]
+            num_dropped = [0] * len(outputs)
+            for index, pts, frame in stream.frames(frame_pool, sampler):
+                if frame_filter is not None:
+                    clock = Stopwatch()
+                    key = get_frame_key(index, pts, output_name)
+                    is_kept = frame_filter.accept(frame, width, height, key)
+                    stream.metrics.add('filter', clock.lap())
+                    for output_index, is_accepted in enumerate(sampler.accepted if len(outputs) > 1 else (True,)):
+                        if not is_accepted:
+                            continue
+                        if is_kept:
+                            kept_keys[output_index].append(key)
+                        else:
+                            num_dropped[output_index] += 1
+                    if not is_kept:
+                        frame_pool.release(frame)
+                        continue
+                if len(outputs) > 1:
+                    targets = [(output, resizer) for output, resizer, is_accepted in zip(outputs, resizers, sampler.accepted) if is_accepted]
+                    # one reference per output, released by its encoder
+                    for _ in range(len(targets) - 1):
+                        frame_pool.retain(frame)
+                file_name = get_frame_file_name(index, pts, output_name)
+                for output, resizer in targets:
+                    output.encoder.encode(frame, width, height, os.path.join(output.destination_folder_path, file_name), frame_pool.release, resizer, frame_format)
+        if frame_filter is not None:
+            for output, output_kept_keys, output_num_dropped in zip(outputs, kept_keys, num_dropped):
+                frame_filter.write_index(output.destination_folder_path, output.skip_frames, output_kept_keys, output_num_dropped)
+            print(f'{source_file_path}: {frame_filter.num_dropped} near-duplicate frames dropped, {len(frame_filter.kept)} kept')
+        return frame_pool
+
+
+def create_decoder(device, num_cpu_decode_threads=0):
+    if device == 'cpu':
+        from .pyav_decoder import PyAVDecoder
+        return PyAVDecoder(num_cpu_decode_threads)
+    from .nv_vpf_decoder import NvVpfDecoder
+    return NvVpfDecoder(device)
@@ -0,0 +1,148 @@
+import multiprocessing
+import threading
+import time
+from queue import Queue
+
+
+class PersistentWorker:
+    """
+    Runs jobs in a persistent process, func(connections, *args) serves num_sessions jobs at once, one per connection:
+    it receives the jobs and sends back ('progress', (frames, expected frames)) heartbeats and a ('result', result) per job.
+    The process is killed when a job makes no progress for stall_timeout seconds, or runs longer than timeout,
+    or stall_timeout + expected frames * timeout_per_frame once its frame count is known, the jobs of the other sessions fail with it.
+    """
+    def __init__(self, func, args=(), timeout=None, stall_timeout=None, timeout_per_frame=None, clock=time.monotonic, num_sessions=1):
+        self.func = func
+        self.args = args
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.timeout_per_frame = timeout_per_frame
+        self.clock = clock
+        self.num_sessions = num_sessions
+        self.process = None
+        self.connections = None
+        # the sessions run their jobs from different threads
+        self.lock = threading.Lock()
+
+    def _start(self):
+        pipes = [multiprocessing.Pipe() for _ in range(self.num_sessions)]
+        self.process = multiprocessing.Process(target=self.func, args=(tuple(child_connection for _, child_connection in pipes), *self.args))
+        self.process.start()
+        for _, child_connection in pipes:
+            child_connection.close()
+        self.connections = tuple(parent_connection for parent_connection, _ in pipes)
+
+    def _terminate(self):
+        if self.process is None:
+            return
+        try:
+            self.process.kill()
+        except Exception:
+            pass
+        self.process.join()
+        for connection in self.connections:
+            connection.close()
+        self.process = None
+        self.connections = None
+
+    def _get_wait_time(self, now, deadline, last_progress_time):
+        """seconds until the job times out, None if it can't"""
+        wait_times = []
+        if deadline is not None:
+            wait_times.append(deadline - now)
+        if self.stall_timeout is not None:
+            wait_times.append(last_progress_time + self.stall_timeout - now)
+        return min(wait_times) if len(wait_times) > 0 else None
+
+    def _get_deadline(self, begin, expected_frames):
+        if expected_frames is not None and self.timeout_per_frame is not None:
+            return begin + (self.stall_timeout or 0) + expected_frames * self.timeout_per_frame
+        return begin + self.timeout if self.timeout is not None else None
+
+    def run(self, session, *job):
+        """runs job on the session-th connection, returns the result sent back by func, None if the process crashed, stalled or timed out"""
+        with self.lock:
+            if self.process is None or not self.process.is_alive():
+                self._terminate()
+                self._start()
+            process, connection = self.process, self.connections[session]
+        try:
+            connection.send(job)
+            begin = last_progress_time = self.clock()
+            deadline = self._get_deadline(begin, None)
+            progress = None
+            while True:
+                now = self.clock()
+                wait_time = self._get_wait_time(now, deadline, last_progress_time)
+                if wait_time is not None and wait_time <= 0:
+                    if deadline is not None and now >= deadline:
+                        print(f'{job[0]}: timed out after {now - begin:.0f}s, worker killed')
+                    else:
+                        print(f'{job[0]}: no progress for {now - last_progress_time:.0f}s, worker killed')
+                    break
+                if not connection.poll(wait_time):
+                    continue
+                kind, value = connection.recv()
+                if kind == 'result':
+                    return value
+                frames, expected_frames = value
+                if frames != progress:
+                    progress, last_progress_time = frames, self.clock()
+                deadline = self._get_deadline(begin, expected_frames)
+        except (EOFError, OSError):
+            pass
+        # crashed or timed out, the next job gets a fresh process, unless another session already started it
+        with self.lock:
+            if self.process is process:
+                self._terminate()
+        return None
+
+    def close(self):
+        with self.lock:
+            if self.process is None:
+                return
+            for connection in self.connections:
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+            self.process.join(self.timeout)
+            self._terminate()
+
+
+class WorkerPool:
+    def __init__(self, workers, func, args=(), timeout=None, stall_timeout=None, timeout_per_frame=None, sessions=None):
+        """
+        workers: the device of each worker process, e.g. (0, 0, 1, 1, 'cpu'), see PersistentWorker for the timeouts,
+        sessions: {device: number of jobs run at once by each worker process of the device}, 1 by default
+        """
+        if sessions is None:
+            sessions = {}
+        self.workers = {}
+        self.idle_workers = {}
+        for device in dict.fromkeys(workers):
+            num_sessions = sessions.get(device, 1)
+            self.workers[device] = tuple(PersistentWorker(func, (device, *args), timeout, stall_timeout, timeout_per_frame, num_sessions=num_sessions) for worker_device in workers if worker_device == device)
+            idle_workers = Queue()
+            for worker in self.workers[device]:
+                for session in range(num_sessions):
+                    idle_workers.put((worker, session))
+            self.idle_workers[device] = idle_workers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def run(self, device, *job):
+        worker, session = self.idle_workers[device].get()
+        try:
+            return worker.run(session, *job)
+        finally:
+            self.idle_workers[device].put((worker, session))
+
+    def close(self):
+        for workers in self.workers.values():
+            for worker in workers:
+                worker.close()
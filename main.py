@@ -1,93 +1,238 @@
 import argparse
 import multiprocessing
-import pycuda.driver as cuda
 import os
+import threading
 import tqdm
-from concurrent.futures import ThreadPoolExecutor
-import itertools
+from impl.manifest import get_input_fingerprint, remove_partial_output
+from impl.utils.yuv_resize import parse_resize, parse_crop
 
 
 def _get_arg_parser():
     arg_parser = argparse.ArgumentParser(description='High-performance Video to JPG (image sequence) converter, NVDEC accelerated', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    arg_parser.add_argument('input_video_list', type=str, help="Path to the input video list file")
+    arg_parser.add_argument('input_video_list', type=str, help="Path to the input video list file, one path per line, '-' reads the list from stdin")
     arg_parser.add_argument('output_dir', type=str, help="Output path")
     arg_parser.add_argument('--log_dir', type=str, help="Logging path")
-    arg_parser.add_argument('--device_ids', default='all', type=str, help="Select the CUDA devices by indices (e.g. '0,1') or 'all'")
+    arg_parser.add_argument('--output_naming', default='basename', choices=('basename', 'relative', 'hash'), help="Name of the output directory of a video: 'basename' is its file name, a file name already used by a previous video in the list gets the 'hash' name, 'relative' mirrors its path relative to --input_root, 'hash' is its file name and a hash of its absolute path (clip.mp4_3f2a9c01b4e7)")
+    arg_parser.add_argument('--input_root', type=str, help="Root of the video paths with --output_naming relative, the videos outside of it get the 'hash' name, default: the current directory")
+    arg_parser.add_argument('--max_queued_jobs', default=10000, type=int, help="With --schedule_order input (and neither --probe nor --coordinator), the list is read while the videos are processed, at most this many videos ahead")
+    arg_parser.add_argument('--device_ids', default='all', type=str, help="Select the CUDA devices by indices (e.g. '0,1'), 'all' or 'none'")
     arg_parser.add_argument('--num_enc_threads', default='4', type=int, help="Number of jpeg image encoding threads (per GPU)")
     arg_parser.add_argument('--num_io_threads', default='4', type=int, help="Number of jpeg image write threads (per GPU)")
     arg_parser.add_argument('--jpeg_enc_quality', default='85', type=int, help="JPEG encoding quality (1 = worst, 100 = best)")
     arg_parser.add_argument('--extract_interval', default=1, type=int, help="Frame extraction interval")
-    arg_parser.add_argument('--timeout', default=60*60, type=int, help="Max wait time for a single video decoding task (in seconds)")
+    arg_parser.add_argument('--sample_fps', type=float, help="Extract frames at this frame rate, based on the frame timestamps, instead of --extract_interval")
+    arg_parser.add_argument('--sample_timestamps', type=str, help="Extract the first frame at or after each of the timestamps (in seconds, e.g. '0.5,10,60'), instead of --extract_interval")
+    arg_parser.add_argument('--keyframes_only', action='store_true', help="Extract only the keyframes, instead of --extract_interval")
+    arg_parser.add_argument('--output_name', default='index', choices=('index', 'timestamp'), help="Name the output frames by frame index (000001.jpg) or by timestamp in milliseconds (000040000.jpg)")
+    arg_parser.add_argument('--resize', type=str, help="Resize the frames before encoding, '256' scales the short side to 256, 'max:512' limits the long side to 512, '640x360' is an exact size")
+    arg_parser.add_argument('--crop', type=str, help="Crop the (resized) frames, '224x224' is a center crop, '224x224+16+8' crops at x=16, y=8")
+    arg_parser.add_argument('--dedup_threshold', type=float, help="Drop the near-duplicate frames (static scenes) before encoding: a frame is kept if its luma block means differ from the last kept frame by this much on average (in luma levels, e.g. 2), the kept frames are listed in kept_frames.json")
+    arg_parser.add_argument('--rendition', action='append', default=[], help="Additional output of the same decoded frames, e.g. 'output_dir=/data/train,quality=80,resize=256,crop=224x224,interval=5', output_dir is required, quality and sampling (interval or fps) default to the main output ones, can be repeated, each rendition has its own encoding and write threads")
+    arg_parser.add_argument('--timeout', default=60*60, type=int, help="Max wait time for a single video decoding task (in seconds), until its frame count is known, see --timeout_per_frame, 0 = no limit")
+    arg_parser.add_argument('--timeout_per_frame', default=0.1, type=float, help="Time budget of a video per frame (in seconds), replacing --timeout once the frame count is known: --stall_timeout + frames x this, 0 = always use --timeout")
+    arg_parser.add_argument('--stall_timeout', default=300, type=int, help="Kill a worker whose video made no progress (no frame decoded, encoded or written) for this long (in seconds), 0 = no limit")
+    arg_parser.add_argument('--max_retries', default=0, type=int, help="Number of times a failed video is retried, its partial output is removed first, a broken input is decoded 1 + max_retries times, the output of a video failed for good is kept for --resume")
+    arg_parser.add_argument('--retry_other_device', action='store_true', help="Retry a failed video on another device than the one it failed on, when there is one")
     arg_parser.add_argument('--vpf_path', type=str, help="Path to the Video Processing Framework installation path")
     arg_parser.add_argument('--libturbojpeg_path', type=str, help="Override the system default path to the turbojpeg shared library, e.g. libturbojpeg.so or turbojpeg.dll")
     arg_parser.add_argument('--thread_max_queue', default=4, type=int, help="Adjust the max queue size for worker threads")
+    arg_parser.add_argument('--auto_tune', action='store_true', help="Tune the numbers of encoding and write threads and the queue sizes at runtime, starting from --num_enc_threads, --num_io_threads and --thread_max_queue, the decisions are logged")
+    arg_parser.add_argument('--max_enc_threads', default=os.cpu_count(), type=int, help="Max number of jpeg image encoding threads (per worker) with --auto_tune")
+    arg_parser.add_argument('--max_io_threads', default=16, type=int, help="Max number of jpeg image write threads (per worker) with --auto_tune")
+    arg_parser.add_argument('--max_thread_queue', default=32, type=int, help="Max queue size for worker threads with --auto_tune")
+    arg_parser.add_argument('--thread_dispatch', default='round_robin', choices=('round_robin', 'least_loaded', 'shared'), help="How encoding and write tasks are dispatched to the worker threads, 'least_loaded' and 'shared' keep a slow write or frame from blocking the decoder while other threads are idle")
+    arg_parser.add_argument('--frame_pool_memory', default=256, type=int, help="Memory budget of the raw frame buffers waiting to be encoded (in MB, per worker)")
+    arg_parser.add_argument('--frame_pool_overflow', default=0, type=int, help="Number of frame buffers allocated over --frame_pool_memory (per decode session) when the encoders hold every buffer, instead of stalling the decoder, they are freed once encoded")
+    arg_parser.add_argument('--num_workers_per_device', default=1, type=int, help="Number of persistent decoding worker processes (per GPU)")
+    arg_parser.add_argument('--sessions_per_device', default=1, type=int, help="Number of videos decoded at once by each GPU worker process, the sessions share its encoding and write threads (--num_enc_threads, --num_io_threads) and its --frame_pool_memory")
+    arg_parser.add_argument('--schedule_order', default='size', choices=('size', 'pixels', 'input'), help="Job ordering, 'size' processes the largest files first, 'pixels' the videos with the most decoded pixels (frames x resolution) first, requires --probe, 'input' keeps the list order")
+    arg_parser.add_argument('--device_weights', type=str, help="Relative throughput of the selected devices (e.g. '1,2.5'), faster devices get the longer videos")
+    arg_parser.add_argument('--num_cpu_workers', default=0, type=int, help="Number of CPU (FFmpeg/PyAV) decoding worker processes, taking jobs from the same list as the GPU workers")
+    arg_parser.add_argument('--num_cpu_decode_threads', default=2, type=int, help="Number of FFmpeg decoding threads (per CPU worker)")
+    arg_parser.add_argument('--cpu_worker_weight', default=0.25, type=float, help="Relative throughput of a CPU worker, see --device_weights")
+    arg_parser.add_argument('--jpeg_buffer_pool_size', type=int, help="Number of preallocated jpeg output buffers (per worker), limits the encoded frames waiting to be written, default: enough to keep the write threads busy")
+    arg_parser.add_argument('--output_mode', default='files', choices=('files', 'shards', 'raw'), help="'files' writes one jpg file per frame, 'shards' appends the frames of a video into tar shards with a (offset, length) index, see impl/shard_writer.py, 'raw' writes the uncompressed frames of a video into a memory-mappable frames.npy, see impl/raw_writer.py")
+    arg_parser.add_argument('--shard_size', default=0, type=int, help="Max size of a shard (in MB), 0 = one shard per video")
+    arg_parser.add_argument('--io_backend', default='stdio', choices=('stdio', 'dirfd'), help="How the 'files' output mode writes the jpg files: 'stdio' opens each file by its full path (fopen), 'dirfd' opens each output directory once and creates the files relative to it (openat), written by os.write straight from the encoder buffers, POSIX only")
+    arg_parser.add_argument('--sync_policy', default='none', choices=('none', 'writeback', 'dontneed', 'fsync'), help="With --io_backend dirfd: 'none' leaves the write back to the kernel, 'writeback' writes back every --sync_batch_size files of a video (sync_file_range) to keep the dirty page cache small, 'dontneed' also drops the written pages from the page cache (posix_fadvise), 'fsync' syncs the files and the directory of a video before it is recorded as done, see impl/utils/native_file_ops.py")
+    arg_parser.add_argument('--sync_batch_size', default=64, type=int, help="Files of a video written back at once by --sync_policy, they stay open until then")
+    arg_parser.add_argument('--raw_format', default='yuv420', choices=('yuv420', 'rgb'), help="Pixel format of the 'raw' output mode")
+    arg_parser.add_argument('--pixel_format', default='yuv420', choices=('yuv420', 'nv12', 'gray'), help="Frame layout from the decoder to the encoders, 'nv12' skips the NV12 to YUV420 conversion on the GPU (the encoder threads deinterleave the chroma), 'gray' downloads and encodes only the luma plane (grayscale jpg files, (frames, height, width) raw frames)")
+    arg_parser.add_argument('--probe', action='store_true', help="Read the metadata of the videos on a CPU process pool before processing: the broken or empty videos are rejected, the ones NVDEC can't decode go to the CPU workers, the progress and ETA are weighted by frames")
+    arg_parser.add_argument('--probe_index', type=str, help="Path to the cache of the --probe results, keyed by path, size and mtime, default: output_dir/probe_index.jsonl")
+    arg_parser.add_argument('--num_probe_processes', default=os.cpu_count(), type=int, help="Number of --probe processes")
+    arg_parser.add_argument('--resume', action='store_true', help="Skip the videos already done with the same input size, mtime and output settings, continue interrupted videos from their written frames")
+    arg_parser.add_argument('--manifest', type=str, help="Path to the manifest recording the processed videos, read by --resume, default: output_dir/manifest.jsonl")
+    arg_parser.add_argument('--cpu_fallback', action='store_true', help="Retry the videos failed on GPU with a CPU worker")
+    arg_parser.add_argument('--metrics_textfile', type=str, help="Export the per-device stage metrics to this file in the Prometheus text format (e.g. for the node_exporter textfile collector), updated after each video")
+    arg_parser.add_argument('--coordinator', type=str, help="Path to a SQLite job queue shared by several nodes (e.g. on shared storage), each node adds the input list to it and claims the jobs, see impl/job_queue.py")
+    arg_parser.add_argument('--node_id', type=str, help="Name of this node in the --coordinator queue, default: hostname-pid")
+    arg_parser.add_argument('--lease_time', default=300, type=float, help="A job claimed from the --coordinator queue is claimed again by another node if not renewed for this long (in seconds)")
     return arg_parser
 
 
 class Runner:
-    def __init__(self,
-                 output_dir, log_dir,
-                 num_jpeg_encoding_threads, num_io_threads,
-                 jpeg_encoding_quality, extract_interval,
-                 timeout, thread_max_queue,
-                 libturbojpeg_path):
+    def __init__(self, worker_pool, scheduler, output_dir, log_dir, cpu_fallback, manifest, settings_hash, resume, metrics_recorder, max_retries=0, retry_other_device=False, rendition_output_dirs=(), output_names=None):
+        self.worker_pool = worker_pool
+        self.scheduler = scheduler
         self.output_dir = output_dir
         self.log_dir = log_dir
-        self.num_jpeg_encoding_threads = num_jpeg_encoding_threads
-        self.num_io_threads = num_io_threads
-        self.jpeg_encoding_quality = jpeg_encoding_quality
-        self.extract_interval = extract_interval
-        self.timeout = timeout
-        self.thread_max_queue = thread_max_queue
-        self.libturbojpeg_path = libturbojpeg_path
-
-    def __call__(self, video_file_path, device_index):
-        from impl.launch_worker import launch_worker
-        from impl.entry import entry
-        video_file_name = os.path.basename(video_file_path)
-        output_dir = os.path.join(self.output_dir, video_file_name)
+        self.cpu_fallback = cpu_fallback
+        self.manifest = manifest
+        self.settings_hash = settings_hash
+        self.resume = resume
+        self.metrics_recorder = metrics_recorder
+        self.max_retries = max_retries
+        self.retry_other_device = retry_other_device
+        self.rendition_output_dirs = rendition_output_dirs
+        self.output_names = output_names
+        self.num_retries = {}
+        self.lock = threading.Lock()
+
+    def _remove_partial_output(self, output_dir, video_name):
+        # a retry starts from scratch, the frames of a killed worker may be truncated,
+        # the output of a video failed for good is left to --resume
+        for video_output_dir in (output_dir, *(os.path.join(rendition_output_dir, video_name) for rendition_output_dir in self.rendition_output_dirs)):
+            remove_partial_output(video_output_dir)
+
+    def __call__(self, video_file_path, device):
+        video_name = self.output_names.get(video_file_path) if self.output_names is not None else os.path.basename(video_file_path)
+        output_dir = os.path.join(self.output_dir, video_name)
         os.makedirs(output_dir, exist_ok=True)
 
         if self.log_dir is not None:
-            log_dir = os.path.join(self.log_dir, video_file_name)
+            log_dir = os.path.join(self.log_dir, video_name)
             os.makedirs(log_dir, exist_ok=True)
         else:
             log_dir = None
 
-        is_success = launch_worker(entry, args=(
-                                   device_index, video_file_path, output_dir, log_dir,
-                                   self.num_jpeg_encoding_threads, self.num_io_threads,
-                                   self.jpeg_encoding_quality, self.extract_interval, self.thread_max_queue,
-                                   self.libturbojpeg_path),
-                                   timeout=self.timeout)
+        try:
+            fingerprint = get_input_fingerprint(video_file_path)
+        except OSError:
+            fingerprint = None
+        # the frames of an interrupted run with the same input and settings are kept
+        resume = self.resume and self.manifest.is_started(video_file_path, fingerprint, self.settings_hash)
+        if not resume:
+            self.manifest.mark_started(video_file_path, fingerprint, self.settings_hash)
+
+        result = self.worker_pool.run(device, video_file_path, output_dir, log_dir, resume, video_name)
+        is_success, metrics = result if result is not None else (False, None)
+        self.metrics_recorder.record(video_file_path, device, is_success, metrics)
+        if is_success:
+            self.manifest.mark_done(video_file_path, fingerprint, self.settings_hash)
+        if not is_success:
+            with self.lock:
+                num_retries = self.num_retries.get(video_file_path, 0)
+                if not (self.cpu_fallback and device != 'cpu') and num_retries < self.max_retries:
+                    self.num_retries[video_file_path] = num_retries + 1
+                else:
+                    num_retries = None
+            if self.cpu_fallback and device != 'cpu':
+                self._remove_partial_output(output_dir, video_name)
+                self.scheduler.add_job(video_file_path, devices=('cpu',))
+                # retrying, not counted yet
+                is_success = None
+            elif num_retries is not None:
+                other_devices = tuple(other_device for other_device in dict.fromkeys(self.scheduler.workers) if other_device != device)
+                devices = other_devices if self.retry_other_device and len(other_devices) > 0 else None
+                print(f'{video_file_path}: failed on device {device}, retry {num_retries + 1}/{self.max_retries}' + (f" on {', '.join(map(str, devices))}" if devices is not None else ''))
+                self._remove_partial_output(output_dir, video_name)
+                self.scheduler.add_job(video_file_path, devices=devices)
+                is_success = None
         return video_file_path, is_success
 
 
+def _get_output_settings(args):
+    # the settings that change the output of a video, a finished video is redone if any of them differs
+    return {'jpeg_enc_quality': args.jpeg_enc_quality, 'extract_interval': args.extract_interval,
+            'sample_fps': args.sample_fps, 'sample_timestamps': args.sample_timestamps, 'keyframes_only': args.keyframes_only,
+            'output_name': args.output_name, 'output_mode': args.output_mode, 'shard_size': args.shard_size, 'raw_format': args.raw_format,
+            'pixel_format': args.pixel_format, 'resize': args.resize, 'crop': args.crop, 'dedup_threshold': args.dedup_threshold,
+            'renditions': args.rendition}
+
+
 def main():
     args = _get_arg_parser().parse_args()
     multiprocessing.set_start_method('spawn', force=True)
-    cuda.init()
-    num_devices = cuda.Device.count()
+    if args.device_ids == 'none':
+        num_devices = 0
+    else:
+        import pycuda.driver as cuda
+        cuda.init()
+        num_devices = cuda.Device.count()
     if args.device_ids == 'all':
         device_indices = tuple(range(num_devices))
+    elif args.device_ids == 'none':
+        device_indices = ()
     else:
         device_indices = tuple(int(idx) for idx in args.device_ids.split(','))
         assert all(idx in range(num_devices) for idx in device_indices)
+    if args.device_weights is not None:
+        device_weights = tuple(float(weight) for weight in args.device_weights.split(','))
+        assert len(device_weights) == len(device_indices)
+        assert all(weight > 0 for weight in device_weights)
+        device_weights = dict(zip(device_indices, device_weights))
+    else:
+        device_weights = {}
+    assert args.cpu_worker_weight > 0
+    assert args.num_probe_processes > 0
+    assert args.schedule_order != 'pixels' or args.probe
+    device_weights['cpu'] = args.cpu_worker_weight
 
     assert args.extract_interval > 0
+    if args.sample_fps is not None:
+        assert args.sample_fps > 0
+    if args.sample_timestamps is not None:
+        sample_timestamps = tuple(float(timestamp) for timestamp in args.sample_timestamps.split(','))
+        assert all(timestamp >= 0 for timestamp in sample_timestamps)
+    else:
+        sample_timestamps = None
+    resize = parse_resize(args.resize) if args.resize is not None else None
+    if resize is not None:
+        assert all(size > 0 for size in resize[1:])
+    crop = parse_crop(args.crop) if args.crop is not None else None
+    if crop is not None:
+        assert crop[0] > 0 and crop[1] > 0
+    assert args.dedup_threshold is None or args.dedup_threshold >= 0
     assert 1 <= args.jpeg_enc_quality <= 100
     assert args.timeout >= 0
     if args.timeout == 0:
         args.timeout = None
+    assert args.timeout_per_frame >= 0 and args.stall_timeout >= 0 and args.max_retries >= 0
     assert args.num_enc_threads > 0
     assert args.num_io_threads > 0
     assert args.thread_max_queue > 0
+    if args.auto_tune:
+        assert args.max_enc_threads > 0 and args.max_io_threads > 0 and args.max_thread_queue > 0
+        auto_tune_limits = (args.max_enc_threads, args.max_io_threads, args.max_thread_queue)
+    else:
+        auto_tune_limits = None
+    assert args.frame_pool_memory > 0
+    assert args.frame_pool_overflow >= 0
+    assert args.num_workers_per_device > 0
+    assert args.sessions_per_device > 0
+    # the tuner resizes the threads between the jobs, the sessions never stop together
+    assert args.sessions_per_device == 1 or not args.auto_tune
+    assert args.num_cpu_workers >= 0
+    assert args.num_cpu_decode_threads >= 0
+    assert len(device_indices) > 0 or args.num_cpu_workers > 0
+    if args.cpu_fallback:
+        assert args.num_cpu_workers > 0
+    if args.jpeg_buffer_pool_size is not None:
+        assert args.jpeg_buffer_pool_size > 0
+    assert args.shard_size >= 0
+    assert args.sync_batch_size > 0
+    if args.sync_policy != 'none':
+        assert args.io_backend == 'dirfd', '--sync_policy requires --io_backend dirfd'
+    if args.io_backend == 'dirfd':
+        assert os.open in os.supports_dir_fd, '--io_backend dirfd requires openat'
+    max_shard_size = args.shard_size * 1024 * 1024 if args.shard_size > 0 else None
     if args.vpf_path is not None:
         assert os.path.isdir(args.vpf_path)
     if args.libturbojpeg_path is not None:
         assert os.path.isfile(args.libturbojpeg_path)
 
-    print(f'Device found: {list(range(num_devices))}, using: {list(device_indices)}')
+    print(f'Device found: {list(range(num_devices))}, using: {list(device_indices)}, CPU workers: {args.num_cpu_workers}')
 
     if args.vpf_path is not None:
         import sys
@@ -104,29 +249,161 @@ def main():
         else:
             os.environ['LD_LIBRARY_PATH'] = libturbojpeg_dir_path + ':' + os.environ['LD_LIBRARY_PATH']
 
-    vid_files = tuple(l.strip() for l in open(args.input_video_list, 'r', encoding='utf-8'))
-    vid_files = tuple(l[1: -1] if l.startswith('"') and l.endswith('"') else l for l in vid_files)
-    vid_files = tuple(l for l in vid_files if len(l) > 0)
-    vid_files = set(vid_files)
-    vid_files = tuple(vid_files)
+    assert args.input_video_list == '-' or os.path.isfile(args.input_video_list)
+    assert args.max_queued_jobs > 0
+    if args.input_root is not None:
+        assert args.output_naming == 'relative' and os.path.isdir(args.input_root)
     output_dir = args.output_dir
     os.makedirs(output_dir, exist_ok=True)
     log_dir = args.log_dir
     if log_dir is not None:
         os.makedirs(log_dir, exist_ok=True)
 
-    runner = Runner(output_dir, log_dir,
-                    args.num_enc_threads, args.num_io_threads,
-                    args.jpeg_enc_quality, args.extract_interval,
-                    args.timeout, args.thread_max_queue,
-                    args.libturbojpeg_path)
+    from impl.worker_pool import WorkerPool
+    from impl.scheduler import Scheduler, run_scheduled, get_file_size_cost
+    from impl.manifest import Manifest, get_settings_hash
+    from impl.sampling import create_sampler
+    from impl.frame_filter import DuplicateFrameFilter
+    from impl.renditions import parse_rendition
+    from impl.metrics import MetricsRecorder
+    from impl.entry import worker_entry
+    from impl.input_list import OutputNames, read_input_list, unique
+
+    if args.coordinator is not None:
+        from impl.job_queue import SQLiteJobQueue, DistributedScheduler
+        job_queue = SQLiteJobQueue(args.coordinator, args.node_id, args.lease_time)
+    else:
+        job_queue = None
+
+    if args.manifest is not None:
+        manifest_path = args.manifest
+    elif job_queue is not None:
+        # one manifest per node, the nodes may share the output directory
+        manifest_path = os.path.join(output_dir, f'manifest_{job_queue.node_id}.jsonl')
+    else:
+        manifest_path = os.path.join(output_dir, 'manifest.jsonl')
+    manifest = Manifest(manifest_path)
+    settings_hash = get_settings_hash(_get_output_settings(args))
+
+    # in list order, without the duplicates, named before the videos already done are skipped
+    output_names = OutputNames(args.output_naming, args.input_root)
+    # the list is read while the videos are processed, unless they have to be ordered or probed first
+    is_streaming = args.schedule_order == 'input' and not args.probe and job_queue is None
+    num_done = 0
+
+    def get_videos():
+        nonlocal num_done
+        for vid_file in unique(read_input_list(args.input_video_list)):
+            output_names.add(vid_file)
+            if args.resume and os.path.exists(vid_file) and manifest.is_done(vid_file, get_input_fingerprint(vid_file), settings_hash):
+                num_done += 1
+                continue
+            yield vid_file
 
-    with ThreadPoolExecutor(max_workers=len(device_indices)) as ex, tqdm.tqdm(total=len(vid_files)) as progress_bar:
+    if not is_streaming:
+        vid_files = tuple(get_videos())
+        if args.resume:
+            print(f'Resuming, {num_done} videos already done')
+
+    # frames of each video, weighting the progress
+    job_weights = {}
+    cpu_only_files = ()
+    if args.probe:
+        from impl.probe import ProbeIndex, probe_videos, get_probe_error, is_nvdec_supported, get_probed_frames
+        with ProbeIndex(args.probe_index if args.probe_index is not None else os.path.join(output_dir, 'probe_index.jsonl')) as probe_index:
+            probe_infos = probe_videos(vid_files, probe_index, args.num_probe_processes)
+        rejected = {vid_file: get_probe_error(info) for vid_file, info in probe_infos.items()}
+        rejected = {vid_file: reason for vid_file, reason in rejected.items() if reason is not None}
+        if len(device_indices) > 0 and job_queue is None:
+            nvdec_rejected = tuple(vid_file for vid_file in vid_files if vid_file not in rejected and not is_nvdec_supported(probe_infos[vid_file]))
+            if args.num_cpu_workers > 0:
+                cpu_only_files = frozenset(nvdec_rejected)
+            else:
+                rejected.update((vid_file, f"{probe_infos[vid_file]['codec']} {probe_infos[vid_file]['pixel_format']} not supported by NVDEC, add --num_cpu_workers") for vid_file in nvdec_rejected)
+        for vid_file, reason in rejected.items():
+            print(f'{vid_file}: rejected, {reason}')
+        if log_dir is not None and len(rejected) > 0:
+            with open(os.path.join(log_dir, 'rejected'), 'a') as f:
+                f.writelines(f'{vid_file}\t{reason}\n' for vid_file, reason in rejected.items())
+        vid_files = tuple(vid_file for vid_file in vid_files if vid_file not in rejected)
+        job_weights = {vid_file: get_probed_frames(probe_infos[vid_file]) for vid_file in vid_files}
+        known_weights = [weight for weight in job_weights.values() if weight is not None]
+        default_weight = sum(known_weights) // len(known_weights) if len(known_weights) > 0 else 1
+        job_weights = {vid_file: weight if weight is not None else default_weight for vid_file, weight in job_weights.items()}
+        print(f'Probed {len(probe_infos)} videos: {len(rejected)} rejected, {len(cpu_only_files)} for the CPU workers only, {sum(job_weights.values())} frames')
+
+    sampler = create_sampler(args.extract_interval, args.sample_fps, sample_timestamps, args.keyframes_only)
+    frame_filter = DuplicateFrameFilter(args.dedup_threshold) if args.dedup_threshold is not None else None
+    renditions = tuple(parse_rendition(spec, args.jpeg_enc_quality, sampler) for spec in args.rendition)
+    # a keyframe sampler accepts every frame it is given
+    assert len(renditions) == 0 or not args.keyframes_only
+    for rendition in renditions:
+        os.makedirs(rendition.output_dir, exist_ok=True)
+    workers = tuple(device_index for device_index in device_indices for _ in range(args.num_workers_per_device)) + ('cpu',) * args.num_cpu_workers
+    sessions = {device_index: args.sessions_per_device for device_index in device_indices}
+    # a scheduler slot per session
+    worker_slots = tuple(worker for worker in workers for _ in range(sessions.get(worker, 1)))
+    worker_pool = WorkerPool(workers, worker_entry,
+                             (args.num_enc_threads, args.num_io_threads,
+                              args.jpeg_enc_quality, sampler, args.thread_max_queue,
+                              args.libturbojpeg_path, args.num_cpu_decode_threads, args.jpeg_buffer_pool_size,
+                              args.output_mode, max_shard_size, args.frame_pool_memory * 1024 * 1024,
+                              args.thread_dispatch, args.output_name, resize, crop, auto_tune_limits, args.raw_format, frame_filter, renditions, args.pixel_format,
+                              args.io_backend, args.sync_policy, args.sync_batch_size, args.frame_pool_overflow),
+                             args.timeout, args.stall_timeout if args.stall_timeout > 0 else None, args.timeout_per_frame if args.timeout_per_frame > 0 else None, sessions)
+
+    if is_streaming:
+        costs = None
+    elif args.schedule_order == 'size':
+        costs = tuple(get_file_size_cost(vid_file) for vid_file in vid_files)
+    elif args.schedule_order == 'pixels':
+        costs = tuple(job_weights[vid_file] * probe_infos[vid_file]['width'] * probe_infos[vid_file]['height'] for vid_file in vid_files)
+    else:
+        costs = (0,) * len(vid_files)
+    if is_streaming:
+        scheduler = Scheduler((), (), worker_slots, device_weights)
+        scheduler.open_input()
+        total, initial = None, 0
+
+        def feed_input():
+            try:
+                for vid_file in get_videos():
+                    if not scheduler.add_input_job(vid_file, max_pending=args.max_queued_jobs):
+                        break
+            finally:
+                scheduler.close_input()
+        feeder = threading.Thread(target=feed_input, daemon=True)
+    elif job_queue is not None:
+        num_added = job_queue.add_jobs(vid_files, costs)
+        print(f'Node {job_queue.node_id}: {num_added} videos added to {args.coordinator}')
+        scheduler = DistributedScheduler(job_queue, worker_slots)
+        progress = job_queue.get_progress()
+        total, initial = progress['total'], progress['done'] + progress['failed']
+    else:
+        gpu_jobs = tuple((vid_file, cost) for vid_file, cost in zip(vid_files, costs) if vid_file not in cpu_only_files)
+        scheduler = Scheduler(tuple(vid_file for vid_file, _ in gpu_jobs), tuple(cost for _, cost in gpu_jobs), worker_slots, device_weights)
+        for vid_file, cost in zip(vid_files, costs):
+            if vid_file in cpu_only_files:
+                scheduler.add_job(vid_file, cost, devices=('cpu',))
+        total, initial = sum(job_weights.values()) if args.probe else len(vid_files), 0
+    # the frames of the videos in the local queue, the jobs of all the nodes with --coordinator
+    progress_unit = {'unit': 'frame'} if args.probe and job_queue is None else {}
+    metrics_recorder = MetricsRecorder(log_dir, args.metrics_textfile)
+    runner = Runner(worker_pool, scheduler, output_dir, log_dir, args.cpu_fallback, manifest, settings_hash, args.resume, metrics_recorder,
+                    args.max_retries, args.retry_other_device, tuple(rendition.output_dir for rendition in renditions), output_names)
+
+    with manifest, metrics_recorder, worker_pool, scheduler, tqdm.tqdm(total=total, initial=initial, **progress_unit) as progress_bar:
         success_count = 0
         failure_count = 0
         progress_bar.set_description('Processing', refresh=False)
         progress_bar.set_postfix({'success': success_count, 'fail': failure_count}, refresh=True)
-        for vid_file, success_flag in ex.map(runner, vid_files, itertools.cycle(device_indices)):
+        if is_streaming:
+            feeder.start()
+        for vid_file, success_flag in run_scheduled(scheduler, runner):
+            if success_flag is None:
+                continue
+            if job_queue is not None:
+                scheduler.complete(vid_file, success_flag)
             progress_bar.set_postfix({'last': os.path.basename(vid_file), 'success': success_count, 'fail': failure_count}, refresh=False)
 
             if success_flag:
@@ -139,7 +416,25 @@ def main():
                 if log_dir is not None:
                     with open(os.path.join(log_dir, 'fail'), 'a') as f:
                         f.write(f'{vid_file}\n')
-            progress_bar.update()
+            if job_queue is not None:
+                # progress of all the nodes
+                progress = job_queue.get_progress()
+                progress_bar.n = progress['done'] + progress['failed']
+                progress_bar.refresh()
+            else:
+                progress_bar.update(job_weights.get(vid_file, 1))
+
+    if is_streaming and args.resume:
+        print(f'Resumed, {num_done} videos already done')
+    if job_queue is not None:
+        progress = job_queue.get_progress()
+        print(f"{args.coordinator}: {progress['done']} done, {progress['failed']} failed, {progress['pending'] + progress['running']} left")
+        for node, (done, failed, last_seen) in sorted(progress['nodes'].items()):
+            print(f'node {node}: {done} done, {failed} failed, last seen {last_seen:.0f}s ago')
+        job_queue.close()
+
+    for line in metrics_recorder.get_summary():
+        print(line)
 
 
 if __name__ == "__main__":
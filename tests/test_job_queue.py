@@ -0,0 +1,73 @@
+import itertools
+import multiprocessing
+import os
+import time
+
+from impl.job_queue import SQLiteJobQueue, DistributedScheduler
+from impl.scheduler import run_scheduled
+
+LEASE_TIME = 1.
+NUM_JOBS = 60
+
+
+def _run_node(db_path, node_id, log_path, kill_after=None):
+    """processes the jobs of the queue on 2 workers, killed like a crashed host while running its job kill_after + 1"""
+    num_started = itertools.count()
+    with SQLiteJobQueue(db_path, node_id, LEASE_TIME) as job_queue, DistributedScheduler(job_queue, ('cpu', 'cpu'), poll_interval=0.1) as scheduler:
+        def run(job, device):
+            if kill_after is not None and next(num_started) >= kill_after:
+                # no cleanup, the leases of the node are left to expire
+                os._exit(1)
+            time.sleep(0.02)
+            return job
+
+        with open(log_path, 'a', encoding='utf-8') as log:
+            for job in run_scheduled(scheduler, run):
+                scheduler.complete(job, True)
+                log.write(job + '\n')
+                log.flush()
+
+
+def test_every_job_done_once_with_a_killed_node(tmp_path):
+    db_path = str(tmp_path / 'queue.db')
+    jobs = [f'video{index}.mp4' for index in range(NUM_JOBS)]
+    with SQLiteJobQueue(db_path, 'setup', LEASE_TIME) as job_queue:
+        assert job_queue.add_jobs(jobs, range(NUM_JOBS)) == NUM_JOBS
+
+    context = multiprocessing.get_context('spawn')
+    nodes = [context.Process(target=_run_node, args=(db_path, f'node{index}', str(tmp_path / f'node{index}.log'), kill_after))
+             for index, kill_after in enumerate((None, None, 5))]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join(60)
+        assert not node.is_alive()
+    assert [node.exitcode for node in nodes] == [0, 0, 1]
+
+    done = []
+    for index in range(len(nodes)):
+        with open(tmp_path / f'node{index}.log', encoding='utf-8') as log:
+            done.extend(log.read().split())
+    assert sorted(done) == sorted(jobs)
+    with SQLiteJobQueue(db_path, 'check', LEASE_TIME) as job_queue:
+        progress = job_queue.get_progress()
+    assert progress['done'] == NUM_JOBS and progress['total'] == NUM_JOBS
+    assert sum(progress['nodes'][f'node{index}'][0] for index in range(len(nodes))) == NUM_JOBS
+
+
+def test_failure_of_a_lost_lease_not_counted(tmp_path):
+    now = [0.]
+    db_path = str(tmp_path / 'queue.db')
+    with SQLiteJobQueue(db_path, 'node0', LEASE_TIME, clock=lambda: now[0]) as first, \
+            SQLiteJobQueue(db_path, 'node1', LEASE_TIME, clock=lambda: now[0]) as second:
+        first.add_jobs(['video.mp4'], [1])
+        assert first.claim() == 'video.mp4'
+        now[0] += 2 * LEASE_TIME
+        assert second.claim() == 'video.mp4'
+        # the first node reports its failure after losing the lease
+        first.complete('video.mp4', False)
+        progress = first.get_progress()
+        assert progress['running'] == 1
+        assert progress['nodes']['node0'][1] == 0
+        second.complete('video.mp4', False)
+        assert second.get_progress()['nodes']['node1'][1] == 1
@@ -0,0 +1,128 @@
+import av
+import numpy as np
+import pytest
+
+from impl.frame_pool import FrameBufferPool
+from impl.jpeg_encoder import JPEGEncoderWorkerThread
+from impl.pyav_decoder import PyAVDecoder
+from impl.sampling import create_sampler
+from impl.utils.pixel_formats import get_frame_size, get_planes, nv12_to_yuv420
+from impl.utils.yuv_jpeg_encoding import TJSAMP_420, TJSAMP_GRAY
+from impl.utils.yuv_resize import create_resizer
+
+
+def _random_i420(width, height, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, get_frame_size(width, height), dtype=np.uint8)
+
+
+def _to_nv12(i420, width, height):
+    luma, u, v = get_planes(i420, width, height)
+    return np.concatenate((luma.ravel(), np.stack((u, v), axis=-1).ravel()))
+
+
+class _FakeJpegEncoder:
+    """records the planes given to libjpeg-turbo, with the row strides it would read them with"""
+    def __init__(self):
+        self.calls = []
+
+    def compress(self, data, width, height, subsample=TJSAMP_420, quality=85, flags=0, buffer_pool=None):
+        if subsample == TJSAMP_GRAY:
+            planes = get_planes(data[: width * height], width, height, 'gray')
+        else:
+            planes = get_planes(data, width, height)
+        self.calls.append((subsample, [plane.copy() for plane in planes]))
+
+    def compress_planes(self, planes, strides, width, height, subsample=TJSAMP_420, quality=85, flags=0, buffer_pool=None):
+        chroma_height = (height + 1) // 2
+        shapes = [(height, strides[0])] + [(chroma_height, stride) for stride in strides[1:]]
+        self.calls.append((subsample, [plane.ravel()[: rows * stride].reshape(rows, stride).copy() for plane, (rows, stride) in zip(planes, shapes)]))
+
+
+def _create_worker():
+    # no libjpeg-turbo, __enter__() is not called
+    worker = JPEGEncoderWorkerThread(85, None, None, None)
+    worker.jpeg_encoder = _FakeJpegEncoder()
+    worker.resized = None
+    worker.chroma = None
+    return worker
+
+
+def _assert_same_planes(planes, expected_planes):
+    assert len(planes) == len(expected_planes)
+    for plane, expected_plane in zip(planes, expected_planes):
+        np.testing.assert_array_equal(plane, expected_plane)
+
+
+@pytest.mark.parametrize('width, height', [(8, 6), (7, 5), (33, 17)])
+def test_nv12_planes_match_i420(width, height):
+    i420 = _random_i420(width, height)
+    nv12 = _to_nv12(i420, width, height)
+    np.testing.assert_array_equal(nv12_to_yuv420(nv12, width, height, np.empty_like(i420)), i420)
+
+    worker = _create_worker()
+    worker._compress(nv12, width, height, None, None, 'nv12')
+    worker._compress(i420, width, height, None, None, 'yuv420')
+    (nv12_subsample, nv12_planes), (i420_subsample, i420_planes) = worker.jpeg_encoder.calls
+    assert nv12_subsample == i420_subsample == TJSAMP_420
+    _assert_same_planes(nv12_planes, get_planes(i420, width, height))
+    _assert_same_planes(i420_planes, get_planes(i420, width, height))
+
+
+def test_nv12_resized_planes_match_i420():
+    width, height = 32, 18
+    i420 = _random_i420(width, height)
+    nv12 = _to_nv12(i420, width, height)
+    worker = _create_worker()
+    worker._compress(nv12, width, height, None, create_resizer(width, height, 16, 10, (0, 0, 16, 10), 'nv12'), 'nv12')
+    worker._compress(i420, width, height, None, create_resizer(width, height, 16, 10, (0, 0, 16, 10), 'yuv420'), 'yuv420')
+    (_, nv12_planes), (_, i420_planes) = worker.jpeg_encoder.calls
+    _assert_same_planes(nv12_planes, i420_planes)
+
+
+@pytest.mark.parametrize('width, height', [(8, 6), (7, 5)])
+def test_gray_plane_matches_i420_luma(width, height):
+    i420 = _random_i420(width, height)
+    worker = _create_worker()
+    # the gray frames of the decoders are the luma plane only
+    worker._compress(i420[: width * height].copy(), width, height, None, None, 'gray')
+    subsample, planes = worker.jpeg_encoder.calls[0]
+    assert subsample == TJSAMP_GRAY
+    _assert_same_planes(planes, get_planes(i420, width, height)[:1])
+
+
+def _decode(path, pixel_format):
+    with PyAVDecoder().open(path) as stream:
+        if pixel_format != 'yuv420':
+            assert stream.set_output_format(pixel_format)
+        width, height = stream.output_width, stream.output_height
+        frame_pool = FrameBufferPool(get_frame_size(width, height, pixel_format), 1 << 20)
+        frames = []
+        for _, _, frame in stream.frames(frame_pool, create_sampler()):
+            frames.append(frame.copy())
+            frame_pool.release(frame)
+        return frames
+
+
+def test_decoded_nv12_and_gray_match_i420(tmp_path):
+    width, height, num_frames = 48, 32, 3
+    path = str(tmp_path / 'video.mkv')
+    i420_frames = [_random_i420(width, height, seed) for seed in range(num_frames)]
+    # lossless, the decoded frames are the input ones
+    with av.open(path, 'w') as container:
+        stream = container.add_stream('ffv1', rate=25)
+        stream.width, stream.height, stream.pix_fmt = width, height, 'yuv420p'
+        for i420 in i420_frames:
+            video_frame = av.VideoFrame(width, height, 'yuv420p')
+            for plane, data in zip(video_frame.planes, get_planes(i420, width, height)):
+                plane.update(np.pad(data, ((0, 0), (0, plane.line_size - data.shape[1]))).tobytes())
+            for packet in stream.encode(video_frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+    decoded = {pixel_format: _decode(path, pixel_format) for pixel_format in ('yuv420', 'nv12', 'gray')}
+    assert [len(frames) for frames in decoded.values()] == [num_frames] * 3
+    for i420, decoded_i420, nv12, gray in zip(i420_frames, decoded['yuv420'], decoded['nv12'], decoded['gray']):
+        np.testing.assert_array_equal(decoded_i420, i420)
+        np.testing.assert_array_equal(nv12, _to_nv12(i420, width, height))
+        np.testing.assert_array_equal(gray, i420[: width * height])
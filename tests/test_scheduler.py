@@ -0,0 +1,66 @@
+import time
+
+from impl.scheduler import Scheduler, run_scheduled
+
+# seconds per unit of cost on a device of weight 1
+TIME_PER_COST = 0.004
+
+
+class _RecordingScheduler(Scheduler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (job, device) in dispatch order
+        self.started = []
+
+    def _start(self, worker_index, job, cost, now):
+        # under the lock of the scheduler, the order is the one of the dispatch
+        self.started.append((job, self.workers[worker_index]))
+        return super()._start(worker_index, job, cost, now)
+
+
+def _run(scheduler, device_weights=None):
+    """runs the jobs with a sleep of their cost on the device, returns the (job, device) in dispatch order and the elapsed time"""
+    if device_weights is None:
+        device_weights = {}
+
+    def run(job, device):
+        time.sleep(job * TIME_PER_COST / device_weights.get(device, 1.))
+        return job
+
+    begin = time.monotonic()
+    assert sorted(run_scheduled(scheduler, run)) == sorted(job for job, _ in scheduler.started)
+    return scheduler.started, time.monotonic() - begin
+
+
+def test_longest_first():
+    # the jobs are their cost
+    jobs = [3, 10, 1, 7, 7, 5, 2, 10, 4]
+    started, _ = _run(_RecordingScheduler(jobs, jobs, ('cpu',)))
+    assert [job for job, _ in started] == sorted(jobs, reverse=True)
+    # same cost, input order
+    scheduler = Scheduler(['a', 'b', 'c'], [1, 1, 1], ('cpu',))
+    assert list(run_scheduled(scheduler, lambda job, device: job)) == ['a', 'b', 'c']
+
+
+def test_longest_first_on_several_workers():
+    jobs = list(range(1, 25))
+    started, _ = _run(_RecordingScheduler(jobs, jobs, (0, 0, 0)))
+    assert [job for job, _ in started] == sorted(jobs, reverse=True)
+
+
+def test_device_share():
+    # the gpu is 4 times faster, once the rate is known the cpu only takes the jobs it finishes before the gpu would
+    jobs = list(range(1, 31))
+    device_weights = {'gpu': 4.}
+    started, elapsed = _run(_RecordingScheduler(jobs, jobs, ('gpu', 'cpu'), device_weights), device_weights)
+    cost_by_device = {'gpu': 0, 'cpu': 0}
+    for job, device in started:
+        cost_by_device[device] += job
+    share = cost_by_device['gpu'] / sum(jobs)
+    assert 0.7 < share < 0.9
+    # before the rate is known, both devices start with one of the largest jobs, then the cpu only gets the small ones
+    assert sorted(job for job, _ in started[:2]) == [29, 30]
+    cpu_jobs = [job for job, device in started[2:] if device == 'cpu']
+    assert len(cpu_jobs) > 0 and max(cpu_jobs) < 15
+    # faster than the gpu alone
+    assert elapsed < sum(jobs) * TIME_PER_COST / device_weights['gpu']